@@ -7,17 +7,19 @@
 import json
 
 from time import sleep
+from typing import Mapping
 
 from azure.cli.command_modules.role.custom import create_role_assignment
 from azure.cli.core.commands import LongRunningOperation
 from azure.cli.core.commands.client_factory import get_subscription_id
 from azure.cli.core.profiles import ResourceType, get_sdk
 from azure.cli.core.util import random_string, sdk_no_wait
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from knack.util import CLIError
 from msrestazure.tools import parse_resource_id, resource_id
 
 from ._client_factory import cf_compute, cf_msi, cf_network, cf_resources
+from ._constants import PKR_BUILD_VM_PREFIX
 from ._utils import get_logger
 
 TRIES = 3
@@ -245,6 +247,173 @@ def image_version_exists(cmd, resource_group_name: str, gallery_name: str, galle
     version = get_image_version(cmd, resource_group_name, gallery_name, gallery_image_name, gallery_image_version_name)
     return version is not None
 
+
+def get_latest_image_version(cmd, resource_group_name: str, gallery_name: str, gallery_image_name: str):
+    '''Gets the highest version of an image definition that was published successfully'''
+    logger.info(f'Getting the latest version of {gallery_image_name} in gallery {gallery_name}')
+    client = cf_compute(cmd.cli_ctx)
+    try:
+        versions = [v for v in client.gallery_image_versions.list_by_gallery_image(
+            resource_group_name, gallery_name, gallery_image_name) if v.provisioning_state == 'Succeeded']
+    except ResourceNotFoundError:
+        logger.info(f'Image definition {gallery_image_name} not found in {gallery_name}')
+        return None
+    if not versions:
+        return None
+    return max(versions, key=lambda v: [int(p) for p in v.name.split('.')])
+
+
+def list_image_versions(cmd, resource_group_name: str, gallery_name: str, gallery_image_name: str):
+    '''Gets the versions of an image definition, or an empty list if the definition doesn't exist'''
+    logger.info(f'Getting the versions of {gallery_image_name} in gallery {gallery_name}')
+    client = cf_compute(cmd.cli_ctx)
+    try:
+        versions = client.gallery_image_versions.list_by_gallery_image(resource_group_name, gallery_name,
+                                                                       gallery_image_name)
+        return list(versions)
+    except ResourceNotFoundError:
+        logger.info(f'Image definition {gallery_image_name} not found in {gallery_name}')
+        return []
+
+
+def delete_image_version(cmd, resource_group_name: str, gallery_name: str, gallery_image_name: str,
+                         gallery_image_version_name: str):
+    '''Starts deleting a gallery image version without waiting for the delete to finish.
+    Returns True if the delete started'''
+    logger.warning(f'Deleting version {gallery_image_version_name} of {gallery_image_name} in gallery {gallery_name}')
+    client = cf_compute(cmd.cli_ctx)
+    try:
+        client.gallery_image_versions.begin_delete(resource_group_name, gallery_name, gallery_image_name,
+                                                   gallery_image_version_name)
+    except HttpResponseError as e:
+        logger.warning(f'Unable to delete version {gallery_image_version_name} of {gallery_image_name}: {e.message}')
+        return False
+    return True
+
+
+def get_marketplace_image_version(cmd, location: str, publisher: str, offer: str, sku: str, version: str = 'latest'):
+    '''Gets the name of a marketplace image version, resolving latest to the highest version in the location'''
+    if version != 'latest':
+        return version
+    logger.info(f'Getting the latest version of marketplace image {publisher}:{offer}:{sku} in {location}')
+    client = cf_compute(cmd.cli_ctx)
+    try:
+        versions = client.virtual_machine_images.list(location, publisher, offer, sku)
+    except ResourceNotFoundError:
+        logger.info(f'Marketplace image {publisher}:{offer}:{sku} not found in {location}')
+        return None
+    if not versions:
+        return None
+    return max(versions, key=lambda v: [int(p) if p.isdigit() else 0 for p in v.name.split('.')]).name
+
+
+def tag_image_version(cmd, resource_group_name: str, gallery_name: str, gallery_image_name: str,
+                      gallery_image_version_name: str, tags, subscription: str = None):
+    Tags, TagsPatchResource = cmd.get_models(
+        'Tags', 'TagsPatchResource', resource_type=ResourceType.MGMT_RESOURCE_RESOURCES)
+
+    sub = subscription or get_subscription_id(cmd.cli_ctx)
+    scope = resource_id(subscription=sub, resource_group=resource_group_name, namespace='Microsoft.Compute',
+                        type='galleries', name=gallery_name, child_type_1='images', child_name_1=gallery_image_name,
+                        child_type_2='versions', child_name_2=gallery_image_version_name)
+
+    properties = Tags(tags=tags)
+    paramaters = TagsPatchResource(operation='Merge', properties=properties)
+
+    client = cf_resources(cmd.cli_ctx).tags
+    result = client.update_at_scope(scope, paramaters)
+    return result
+
+
+def _normalize_region(region: str) -> str:
+    return region.replace(' ', '').lower()
+
+
+def replicate_image_version(cmd, resource_group_name: str, gallery_name: str, gallery_image_name: str,
+                            gallery_image_version_name: str, regions, replica_counts: Mapping[str, int] = None):
+    '''Starts replicating a gallery image version to additional regions. Regions the version already targets keep their
+    settings, unless replica_counts (region: count) has a different count for them. New regions use the count in
+    replica_counts or the version's default. Returns the poller (None if nothing changed) and the new regions'''
+    logger.info(f'Getting version {gallery_image_version_name} of {gallery_image_name} in gallery {gallery_name}')
+    client = cf_compute(cmd.cli_ctx)
+    version = client.gallery_image_versions.get(resource_group_name, gallery_name, gallery_image_name,
+                                                gallery_image_version_name)
+
+    TargetRegion = cmd.get_models('TargetRegion', resource_type=ResourceType.MGMT_COMPUTE,
+                                  operation_group='gallery_image_versions')
+
+    profile = version.publishing_profile
+    counts = {_normalize_region(r): c for r, c in (replica_counts or {}).items()}
+    targeted = [_normalize_region(r.name) for r in profile.target_regions or []]
+    new_regions = [r for r in regions if _normalize_region(r) not in targeted]
+
+    rescaled = []
+    for target in profile.target_regions or []:
+        count = counts.get(_normalize_region(target.name))
+        if count and count != target.regional_replica_count:
+            target.regional_replica_count = count
+            rescaled.append(f'{target.name} ({count})')
+
+    unknown = set(counts) - set(targeted) - {_normalize_region(r) for r in new_regions}
+    if unknown:
+        logger.warning(f'Ignoring replica counts for {", ".join(sorted(unknown))}, '
+                       f'version {gallery_image_version_name} of {gallery_image_name} is not replicated there')
+
+    if not new_regions and not rescaled:
+        logger.info(f'Version {gallery_image_version_name} of {gallery_image_name} already targets all regions')
+        return None, []
+
+    if rescaled:
+        logger.warning(f'Setting the replica counts of version {gallery_image_version_name} of {gallery_image_name} '
+                       f'in {", ".join(rescaled)}')
+    if new_regions:
+        logger.warning(f'Replicating version {gallery_image_version_name} of {gallery_image_name} to '
+                       f'{", ".join(new_regions)}')
+    profile.target_regions = (profile.target_regions or []) + [
+        TargetRegion(name=r, regional_replica_count=counts.get(_normalize_region(r)),
+                     storage_account_type=profile.storage_account_type) for r in new_regions]
+
+    poller = client.gallery_image_versions.begin_create_or_update(
+        resource_group_name, gallery_name, gallery_image_name, gallery_image_version_name, version)
+    return poller, new_regions
+
+
+def get_image_version_replication(cmd, resource_group_name: str, gallery_name: str, gallery_image_name: str,
+                                  gallery_image_version_name: str):
+    '''Gets the replication status of a gallery image version'''
+    client = cf_compute(cmd.cli_ctx)
+    version = client.gallery_image_versions.get(resource_group_name, gallery_name, gallery_image_name,
+                                                gallery_image_version_name, expand='ReplicationStatus')
+    return version.replication_status
+
+
+def delete_managed_image(cmd, resource_group_name: str, image_name: str, build_resource_group_name: str):
+    '''Starts deleting a managed image (if it exists) without waiting for the delete to finish. Only images packer
+    captured from a build vm in the build resource group (the sandbox) are deleted.
+    Returns True if the image was deleted'''
+    logger.info(f'Getting managed image {image_name} in resource group {resource_group_name}')
+    client = cf_compute(cmd.cli_ctx)
+    try:
+        image = client.images.get(resource_group_name, image_name)
+    except ResourceNotFoundError:
+        logger.info(f'Managed image {image_name} not found in resource group {resource_group_name}')
+        return False
+
+    source = parse_resource_id(image.source_virtual_machine.id) if image.source_virtual_machine else {}
+    if not source.get('name', '').startswith(PKR_BUILD_VM_PREFIX) \
+            or source.get('resource_group', '').lower() != build_resource_group_name.lower():
+        logger.info(f'Keeping managed image {image_name} in resource group {resource_group_name}, '
+                    'it was not captured by a bake build')
+        return False
+
+    logger.warning(f'Deleting managed image {image_name} in resource group {resource_group_name}')
+    try:
+        client.images.begin_delete(resource_group_name, image_name)
+    except HttpResponseError as e:
+        logger.warning(f'Unable to delete managed image {image_name}: {e.message}')
+        return False
+    return True
+
 # pylint: disable=unused-argument, unused-variable
 
 
@@ -0,0 +1,157 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import copy
+import json
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Mapping, Optional, Sequence, Tuple
+
+from ._constants import IMAGE_CHECKPOINT_STEPS, tag_key
+from ._data import Image, ImagePublish, PowershellScript, WingetPackage, get_dict
+from ._hcl import PackerBuildFile
+from ._incremental import get_base_hash, get_script_path, hash_inputs
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+# gallery image version tags written on checkpoints
+CHECKPOINT_TAG = tag_key('checkpoint')
+CHECKPOINT_AFTER_TAG = tag_key('checkpoint-after')
+
+
+@dataclass
+class BuildStage:
+    '''A packer build of some of the image's install steps. Every stage but the last ends with a checkpoint, a gallery
+    version of the checkpoint image definition the next stage starts from. By default a stage includes every step'''
+    update: bool = True
+    # the install scripts in the stage (start and end index)
+    scripts_start: int = 0
+    scripts_end: Optional[int] = None
+    choco: bool = True
+    winget: bool = True
+    # the image (definition) and version the stage starts from, or None for the base image
+    source_image: str = None
+    source_version: str = None
+    # the install step the checkpoint is taken after, the hash of its inputs and its version (None for the last)
+    after: str = None
+    checkpoint: str = None
+    version: str = None
+    build_file: PackerBuildFile = None
+
+    def get_scripts(self, powershell_scripts: Sequence[PowershellScript]) -> List[PowershellScript]:
+        return list(powershell_scripts or [])[self.scripts_start:self.scripts_end]
+
+
+def get_checkpoint_definition_name(image: Image) -> str:
+    return f'{image.name}-checkpoints'
+
+
+def get_checkpoint_image(image: Image, version: str) -> Image:
+    '''Gets a copy of the image that packer publishes as a checkpoint version, only to the build region'''
+    checkpoint = copy.copy(image)
+    checkpoint.name = get_checkpoint_definition_name(image)
+    checkpoint.version = version
+    checkpoint.replica_locations = []
+    checkpoint.publish = ImagePublish({})
+    return checkpoint
+
+
+def _resolve_script(image: Image, path: str) -> str:
+    return str(Path(path.replace('${path.root}', str(image.dir))).resolve()) if image.dir else path
+
+
+def plan_build_stages(image: Image, powershell_scripts: Sequence[PowershellScript] = None,
+                      choco_configs: Mapping[str, str] = None, winget_packages: Sequence[WingetPackage] = None,
+                      update: bool = False, source_version: str = None, now: datetime = None) -> List[BuildStage]:
+    '''Splits the build into stages that end with the checkpoints.after install steps. The install steps run in the
+    same order as one build: windows updates, scripts, choco packages, and winget packages. Each checkpoint has a hash
+    of the inputs of every step before it, so a failed build can resume from a checkpoint of the same steps'''
+    now = now or datetime.now(timezone.utc)
+    after = [a if a in IMAGE_CHECKPOINT_STEPS else _resolve_script(image, f'${{path.root}}/{a}')
+             for a in (image.checkpoints.after if image.checkpoints else [])]
+
+    # the install steps in build order (name, hash of the inputs, and the index of the script)
+    steps = []
+    if update:
+        steps.append(('update', hash_inputs(json.dumps(get_dict(image.update), sort_keys=True)), None))
+    for i, script in enumerate(powershell_scripts or []):
+        path = _resolve_script(image, script.path)
+        steps.append((path, hash_inputs(Path(path).read_bytes(), script.restart, script.group), i))
+    if any((choco_configs or {}).values()):
+        steps.append(('choco', hash_inputs(choco_configs.get('user'), choco_configs.get('machine')), None))
+    if winget_packages:
+        steps.append(('winget', hash_inputs(json.dumps([get_dict(p) for p in winget_packages], sort_keys=True)), None))
+
+    def _stage(scripts, source_image, version):
+        return BuildStage(update=False, scripts_start=scripts, scripts_end=scripts, choco=False, winget=False,
+                          source_image=source_image, source_version=version)
+
+    stages = []
+    checkpoint = hash_inputs(get_base_hash(image), source_version or '')
+    stage = _stage(0, image.name if source_version else None, source_version)
+
+    for index, (name, inputs, script) in enumerate(steps):
+        if script is not None:
+            stage.scripts_end = script + 1
+        else:
+            # the update, choco, and winget steps are flags of the stage
+            setattr(stage, name, True)
+        # checkpoints are named after the script's path relative to the image, not where the repository is
+        step = name if script is None else get_script_path(image, powershell_scripts[script])
+        checkpoint = hash_inputs(checkpoint, step, inputs)
+
+        # the last step doesn't need a checkpoint, the build publishes the image after it
+        if name in after and index < len(steps) - 1:
+            stage.after = step
+            stage.checkpoint = checkpoint
+            # gallery version names are three integers, so the stage number and the time the build was planned
+            stage.version = f'{len(stages) + 1}.{int(now.strftime("%y%m%d"))}.{int(now.strftime("%H%M%S"))}'
+            stages.append(stage)
+            stage = _stage(stage.scripts_end, get_checkpoint_definition_name(image), stage.version)
+
+    stages.append(stage)
+    return stages
+
+
+def find_checkpoint(image: Image, stages: Sequence[BuildStage], versions, location: str = None,
+                    now: datetime = None) -> Tuple[int, Optional[object]]:
+    '''Finds the latest checkpoint version a build can resume from. Checkpoints must have the same install steps as a
+    stage, be published successfully to the build region, and be newer than checkpoints.maxAgeDays.
+    Returns the index of the stage the checkpoint ends and the version, or -1 and None'''
+    now = now or datetime.now(timezone.utc)
+    valid = {}
+    for version in versions or []:
+        tags = version.tags or {}
+        if version.provisioning_state != 'Succeeded' or not tags.get(CHECKPOINT_TAG):
+            continue
+        published = version.publishing_profile.published_date if version.publishing_profile else None
+        if published is None or (now - published).days >= image.checkpoints.max_age_days:
+            continue
+        if location:
+            regions = [r.name.replace(' ', '').lower() for r in version.publishing_profile.target_regions or []]
+            if location.replace(' ', '').lower() not in regions:
+                continue
+        valid.setdefault(tags[CHECKPOINT_TAG], version)
+
+    for index in reversed(range(len(stages))):
+        if stages[index].checkpoint and stages[index].checkpoint in valid:
+            return index, valid[stages[index].checkpoint]
+    return -1, None
+
+
+def resume_build_stages(image: Image, stages: Sequence[BuildStage], index: int, version) -> List[BuildStage]:
+    '''Skips the stages before and including the checkpoint, the next stage starts from the checkpoint version'''
+    remaining = list(stages[index + 1:])
+    remaining[0].source_image = get_checkpoint_definition_name(image)
+    remaining[0].source_version = version.name
+    return remaining
+
+
+def get_checkpoint_tags(stage: BuildStage) -> dict:
+    return {CHECKPOINT_TAG: stage.checkpoint, CHECKPOINT_AFTER_TAG: stage.after}
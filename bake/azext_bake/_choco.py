@@ -0,0 +1,194 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import io
+import re
+import zipfile
+
+from pathlib import Path
+from typing import List, Mapping, Sequence
+from xml.etree import ElementTree
+
+import requests
+
+from azure.cli.core.azclierror import ClientRequestError, FileOperationError
+from azure.cli.core.util import should_disable_connection_verify
+from azure.core.exceptions import ResourceExistsError
+
+from ._constants import CHOCO_CACHE_VM_DIR, CHOCO_COMMUNITY_FEED
+from ._data import ChocoPackage, get_dict
+from ._storage import list_share_root, upload_share_file
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+# a dependency on an exact version (i.e. [2.39.0]), other ranges use the latest version
+CHOCO_EXACT_VERSION = re.compile(r'^\[(?P<version>[^,\]]+)\]$')
+
+
+def get_nupkg_name(package_id: str, version: str) -> str:
+    '''Gets the file name of a package in a folder feed (i.e. git.install.2.39.0.nupkg)'''
+    return f'{package_id.lower()}.{version}.nupkg'
+
+
+def _version_key(version: str):
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'[.-]', version)]
+
+
+def find_cached_version(names: Sequence[str], package_id: str, version: str = None) -> str:
+    '''Gets the cached version of a package (the highest if no version is given) or None if it isn't cached'''
+    if version:
+        return version if get_nupkg_name(package_id, version) in names else None
+    prefix = f'{package_id.lower()}.'
+    # package ids can contain dots (i.e. git.install), but versions always start with a number
+    versions = [n[len(prefix):-len('.nupkg')] for n in names
+                if n.startswith(prefix) and n.endswith('.nupkg') and n[len(prefix):len(prefix) + 1].isdigit()]
+    return max(versions, key=_version_key) if versions else None
+
+
+def read_nuspec(data: bytes):
+    '''Gets the id, version, and dependencies (id, version range) of a package from its nupkg'''
+    with zipfile.ZipFile(io.BytesIO(data)) as nupkg:
+        name = next((n for n in nupkg.namelist() if n.endswith('.nuspec') and '/' not in n), None)
+        if name is None:
+            raise FileOperationError('Package does not contain a nuspec file')
+        root = ElementTree.fromstring(nupkg.read(name))
+
+    def _find(elem, tag):
+        return [e for e in elem.iter() if e.tag.split('}')[-1] == tag]
+
+    metadata = _find(root, 'metadata')[0]
+    package_id = _find(metadata, 'id')[0].text.strip()
+    version = _find(metadata, 'version')[0].text.strip()
+    dependencies = [(d.get('id'), d.get('version')) for d in _find(metadata, 'dependency')]
+    return package_id, version, dependencies
+
+
+def download_package(package_id: str, version: str = None) -> bytes:
+    '''Downloads a package (the latest version if no version is given) from the chocolatey community feed'''
+    url = f'{CHOCO_COMMUNITY_FEED}package/{package_id}' + (f'/{version}' if version else '')
+    logger.info(f'Downloading {url}')
+    try:
+        response = requests.get(url, verify=not should_disable_connection_verify(), timeout=300)
+    except requests.RequestException as e:
+        raise ClientRequestError(f'Unable to download choco package {package_id}: {e}') from e
+    if response.status_code != 200:
+        raise ClientRequestError(f'Unable to download choco package {package_id}. '
+                                 f'Server returned status code {response.status_code} for {url}')
+    return response.content
+
+
+def is_cacheable(package: ChocoPackage) -> bool:
+    '''Only packages from the community feed are cached'''
+    return not package.user and (package.source is None
+                                 or package.source.rstrip('/') == CHOCO_COMMUNITY_FEED.rstrip('/'))
+
+
+class LocalChocoCache:
+    '''A package cache in a local directory (i.e. .local/choco in the repository)'''
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self.name = str(cache_dir)
+
+    def list_names(self) -> List[str]:
+        return [f.name for f in self.cache_dir.glob('*.nupkg')] if self.cache_dir.is_dir() else []
+
+    def add(self, name: str, data: bytes):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / name).write_bytes(data)
+
+
+class ShareChocoCache:
+    '''A package cache on a file share in the sandbox storage account (mounted by the builders)'''
+
+    def __init__(self, share_client):
+        self.share = share_client
+        self.name = share_client.share_name
+
+    def list_names(self) -> List[str]:
+        try:
+            self.share.create_share()
+        except ResourceExistsError:
+            pass
+        return [i['name'] for i in list_share_root(self.share) if not i['is_directory']]
+
+    def add(self, name: str, data: bytes):
+        upload_share_file(self.share, name, data, length=len(data))
+
+
+def cache_choco_packages(cache, packages: Sequence[ChocoPackage]) -> List[dict]:
+    '''Downloads the packages and their dependencies from the community feed into the cache, skipping the packages
+    that are already cached. Packages without a version are cached at the latest version'''
+    names = set(cache.list_names())
+    results = []
+    seen = set()
+    pending = [(p.id, p.version, p.id) for p in packages if is_cacheable(p)]
+
+    while pending:
+        package_id, version, parent = pending.pop(0)
+        if (package_id.lower(), version) in seen:
+            continue
+        seen.add((package_id.lower(), version))
+
+        cached = find_cached_version(names, package_id, version)
+        if cached:
+            data = None
+            results.append({'id': package_id, 'version': cached, 'package': parent, 'action': 'exists'})
+        else:
+            try:
+                data = download_package(package_id, version)
+                package_id, cached, _ = read_nuspec(data)
+            except (ClientRequestError, FileOperationError, zipfile.BadZipFile) as e:
+                logger.warning(str(e))
+                results.append({'id': package_id, 'version': version, 'package': parent, 'action': 'failed'})
+                continue
+            name = get_nupkg_name(package_id, cached)
+            cache.add(name, data)
+            names.add(name)
+            results.append({'id': package_id, 'version': cached, 'package': parent, 'action': 'cached',
+                            'size': len(data)})
+
+        # dependencies of packages that were already cached were cached with them
+        for dep_id, dep_range in read_nuspec(data)[2] if data else []:
+            match = CHOCO_EXACT_VERSION.match(dep_range or '')
+            pending.append((dep_id, match.group('version') if match else None, parent))
+
+    return results
+
+
+def apply_choco_cache(packages: Sequence[ChocoPackage], cache_dir: Path):
+    '''Pins the packages found in the cache directory to the cached version with the cache as their primary source.
+    Returns the packages and the cached files (bundle name: path) to upload to the build vm, which include the
+    cached dependencies of the packages'''
+    names = [f.name for f in cache_dir.glob('*.nupkg')] if cache_dir and cache_dir.is_dir() else []
+    if not names:
+        return list(packages), {}
+
+    source = f'{CHOCO_CACHE_VM_DIR};{CHOCO_COMMUNITY_FEED}'
+    files: Mapping[str, Path] = {}
+    result = []
+
+    def _add_file(package_id, version):
+        name = get_nupkg_name(package_id, version)
+        if f'choco/{name}' in files:
+            return
+        files[f'choco/{name}'] = cache_dir / name
+        for dep_id, dep_range in read_nuspec((cache_dir / name).read_bytes())[2]:
+            match = CHOCO_EXACT_VERSION.match(dep_range or '')
+            dep_version = find_cached_version(names, dep_id, match.group('version') if match else None)
+            if dep_version:
+                _add_file(dep_id, dep_version)
+
+    for package in packages:
+        version = find_cached_version(names, package.id, package.version) if is_cacheable(package) else None
+        if version:
+            _add_file(package.id, version)
+            package = ChocoPackage({**get_dict(package), 'version': version, 'source': source})
+        result.append(package)
+
+    logger.info(f'Using {len(files)} cached choco packages from {cache_dir}')
+    return result, files
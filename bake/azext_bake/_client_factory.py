@@ -15,6 +15,14 @@ def cf_storage(cli_ctx, **_):
     return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_STORAGE)
 
 
+def cf_share_service(cli_ctx, account_name, account_key):
+    from azure.cli.core.profiles import get_sdk
+    ShareServiceClient = get_sdk(cli_ctx, ResourceType.DATA_STORAGE_FILESHARE,
+                                 '_share_service_client#ShareServiceClient')
+    account_url = f'https://{account_name}.file.{cli_ctx.cloud.suffixes.storage_endpoint}'
+    return ShareServiceClient(account_url=account_url, credential=account_key)
+
+
 def cf_network(cli_ctx, **_):
     return get_mgmt_service_client(cli_ctx, ResourceType.MGMT_NETWORK)
 
@@ -14,8 +14,10 @@ timestamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
 AZ_BAKE_IMAGE_BUILDER = 'AZ_BAKE_IMAGE_BUILDER'
 AZ_BAKE_BUILD_IMAGE_NAME = 'AZ_BAKE_BUILD_IMAGE_NAME'
 AZ_BAKE_IMAGE_BUILDER_VERSION = 'AZ_BAKE_IMAGE_BUILDER_VERSION'
+AZ_BAKE_STATUS_TOKEN = 'AZ_BAKE_STATUS_TOKEN'
 AZ_BAKE_REPO_VOLUME = '/mnt/repo'
 AZ_BAKE_STORAGE_VOLUME = '/mnt/storage'
+AZ_BAKE_CHOCO_VOLUME = '/mnt/choco'
 
 IN_BUILDER = os.environ.get(AZ_BAKE_IMAGE_BUILDER)
 IN_BUILDER = bool(IN_BUILDER)
@@ -38,6 +40,21 @@ if IN_BUILDER:
 
 BAKE_PLACEHOLDER = '###BAKE###'
 
+STATUS_SERVER_PORT = 80
+STATUS_LOG_LINES = 200
+STATUS_MANIFEST_FILE = 'status.json'
+STATUS_TIMELINE_FILE = 'timeline.json'
+
+ARTIFACTS_ARCHIVE_FILE = 'artifacts.zip'
+ARTIFACTS_INDEX_FILE = 'artifacts.json'
+
+
+# default builder container resources are sized from the number of images it builds (limited to the aci maximums)
+BUILDER_CPU_PER_IMAGE = 2
+BUILDER_MEMORY_PER_IMAGE = 4
+BUILDER_CPU_MAX = 4
+BUILDER_MEMORY_MAX = 16
+
 
 PKR_BUILD_FILE = 'build.pkr.hcl'
 PKR_VARS_FILE = 'variable.pkr.hcl'
@@ -53,6 +70,29 @@ IMAGE_DEFAULT_BASE_WINDOWS = {
     'version': 'latest'
 }
 
+IMAGE_DEFAULT_VM = {
+    'size': 'Standard_D8s_v3',
+    'osDiskType': 'Standard_LRS',
+    'osDiskSizeGb': 0,  # 0 uses the size of the base image's os disk
+    'diskCaching': 'ReadWrite'
+}
+
+IMAGE_VM_OS_DISK_TYPES = ['Standard_LRS', 'Premium_LRS']
+IMAGE_VM_DISK_CACHING_TYPES = ['None', 'ReadOnly', 'ReadWrite']
+
+# incremental builds start from the latest gallery version until its last full build is older than this
+IMAGE_INCREMENTAL_FULL_REBUILD_DAYS = 30
+# checkpoints older than this aren't used to resume a build (i.e. the windows updates they include are too old)
+IMAGE_CHECKPOINT_MAX_AGE_DAYS = 7
+# install steps that can be checkpointed, besides the install scripts (by path)
+IMAGE_CHECKPOINT_STEPS = ['update', 'choco', 'winget']
+# azure resources (i.e. gallery image versions) can have at most 50 tags
+IMAGE_VERSION_TAG_LIMIT = 50
+# gallery image versions are stored in one of these storage account types and have at most 100 replicas per region
+IMAGE_PUBLISH_STORAGE_ACCOUNT_TYPES = ['Standard_LRS', 'Standard_ZRS', 'Premium_LRS']
+IMAGE_PUBLISH_REPLICA_COUNT_MAX = 100
+# seconds between checks of a gallery image version's replication progress
+IMAGE_REPLICATION_POLL_INTERVAL = 30
 
 PKR_DEFAULT_VARS = {
     'image': [
@@ -60,7 +100,9 @@ PKR_DEFAULT_VARS = {
         'version',
         'replicaLocations',
         'os',
-        'base'
+        'base',
+        'vm',
+        'publish'
     ],
     'gallery': [
         'name',
@@ -102,74 +144,46 @@ DEFAULT_TAGS = {
 
 CHOCO_PACKAGES_CONFIG_FILE = 'packages.config'
 CHOCO_PACKAGES_USER_CONFIG_FILE = 'user.packages.config'
+CHOCO_COMMUNITY_FEED = 'https://community.chocolatey.org/api/v2/'
+# file share in the sandbox storage account with cached choco packages (az bake sandbox cache choco)
+CHOCO_CACHE_SHARE = 'choco'
 
-PKR_PROVISIONER_UPDATE = f'''
-  # Injected by az bake
-  # https://github.com/rgl/packer-plugin-windows-update
-  provisioner "windows-update" {{
-  }}
-  {BAKE_PLACEHOLDER}'''
-
-PKR_PROVISIONER_RESTART = f'''
-  # Injected by az bake
-  provisioner "windows-restart" {{
-    restart_timeout = "30m"
-    pause_before    = "2m"
-  }}
-  {BAKE_PLACEHOLDER}'''
-
-PKR_PROVISIONER_CHOCO = f'''
-  # Injected by az bake
-  provisioner "powershell" {{
-    environment_vars = ["chocolateyUseWindowsCompression=false"]
-    inline = [
-      "(new-object net.webclient).DownloadFile('https://chocolatey.org/install.ps1', 'C:/Windows/Temp/chocolatey.ps1')",
-      "& C:/Windows/Temp/chocolatey.ps1"
-    ]
-  }}
-
-  # Injected by az bake
-  provisioner "file" {{
-    source = "${{path.root}}/{CHOCO_PACKAGES_CONFIG_FILE}"
-    destination = "C:/Windows/Temp/{CHOCO_PACKAGES_CONFIG_FILE}"
-  }}
-
-  # Injected by az bake
-  provisioner "powershell" {{
-    elevated_user     = build.User
-    elevated_password = build.Password
-    inline = [
-      "choco install C:/Windows/Temp/{CHOCO_PACKAGES_CONFIG_FILE} --yes --no-progress"
-    ]
-  }}
-
-  # Injected by az bake
-  provisioner "file" {{
-    source = "C:/ProgramData/chocolatey/logs/chocolatey.log"
-    destination = "{OUTPUT_DIR}/chocolatey.log"
-    direction = "download"
-  }}
-  {BAKE_PLACEHOLDER}'''
-
-PKR_PROVISIONER_CHOCO_USER = f'''
-  # Injected by az bake
-  provisioner "file" {{
-    source = "${{path.root}}/{CHOCO_PACKAGES_USER_CONFIG_FILE}"
-    destination = "C:/Windows/Temp/{CHOCO_PACKAGES_USER_CONFIG_FILE}"
-  }}
-
-  # Injected by az bake
-  provisioner "powershell" {{
-    elevated_user     = build.User
-    elevated_password = build.Password
-    inline = [
-      "New-Item -Path 'HKLM:\\\\SOFTWARE\\\\Microsoft\\\\Active Setup\\\\Installed Components' -Name '7cc2318a-b226-4fdd-84c6-31e5f4dd9e4f' -Value 'Install Chocolatey Packages'",
-      "New-ItemProperty 'HKLM:\\\\SOFTWARE\\\\Microsoft\\\\Active Setup\\\\Installed Components\\\\7cc2318a-b226-4fdd-84c6-31e5f4dd9e4f' -Name StubPath -Value 'choco install C:/Windows/Temp/{CHOCO_PACKAGES_USER_CONFIG_FILE} --yes --no-progress'"
-    ]
-  }}
-  {BAKE_PLACEHOLDER}'''
+# install scripts and config files are uploaded to the build vm in one archive and extracted to this directory
+INSTALL_BUNDLE_FILE = 'install.zip'
+INSTALL_BUNDLE_DIR = 'C:/Windows/Temp/bake'
+# cached choco packages are uploaded in the install bundle and used as a folder source
+CHOCO_CACHE_VM_DIR = f'{INSTALL_BUNDLE_DIR}/choco'
+# runs the scripts in an image.yml script group in parallel (templates/install)
+INSTALL_SCRIPT_GROUP_FILE = 'Invoke-ScriptGroup.ps1'
+
+# the source in the packer build file template, image variants are built from copies of it
+PKR_BUILD_SOURCE = 'azure-arm.vm'
+
+# packer names the temporary build vm pkrvm followed by a random suffix (i.e. pkrvmabc123xyz)
+PKR_BUILD_VM_PREFIX = 'pkrvm'
+
+# minutes packer waits before each windows-restart provisioner
+PKR_RESTART_PAUSE_MINUTES = 2
 
 WINGET_SETTINGS_FILE = 'settings.json'
+WINGET_IMPORT_FILE = 'winget.packages.json'
+WINGET_IMPORT_SCHEMA = 'https://aka.ms/winget-packages.schema.2.0.json'
+
+# source details for the winget import file, packages from other sources are installed with winget install
+WINGET_IMPORT_SOURCES = {
+    'winget': {
+        'Argument': 'https://cdn.winget.microsoft.com/cache',
+        'Identifier': 'Microsoft.Winget.Source_8wekyb3d8bbwe',
+        'Name': 'winget',
+        'Type': 'Microsoft.PreIndexed.Package'
+    },
+    'msstore': {
+        'Argument': 'https://storeedgefd.dsx.mp.microsoft.com/v9.0',
+        'Identifier': 'StoreEdgeFD',
+        'Name': 'msstore',
+        'Type': 'Microsoft.Rest'
+    }
+}
 
 WINGET_INSTALLER_SRC = 'https://github.com/microsoft/winget-cli/releases/latest/download/Microsoft.DesktopAppInstaller_8wekyb3d8bbwe.msixbundle'
 WINGET_INSTALLER_DEST = 'C:/Windows/Temp/Microsoft.DesktopAppInstaller_8wekyb3d8bbwe.msixbundle'
@@ -189,39 +203,6 @@ WINGET_SETTINGS_JSON = '''{
 }
 '''
 
-PKR_PROVISIONER_WINGET_INSTALL = f'''
-  # Injected by az bake
-  provisioner "powershell" {{
-    elevated_user     = build.User
-    elevated_password = build.Password
-    inline = [
-      "Write-Host '>>> Downloading package: {WINGET_INSTALLER_SRC} to {WINGET_INSTALLER_DEST}'",
-      "(new-object net.webclient).DownloadFile('{WINGET_INSTALLER_SRC}', '{WINGET_INSTALLER_DEST}')",
-      "Write-Host '>>> Installing package: {WINGET_INSTALLER_DEST}'",
-      "Add-AppxPackage -InstallAllResources -ForceTargetApplicationShutdown -ForceUpdateFromAnyVersion -Path '{WINGET_INSTALLER_DEST}'",
-      # "Add-AppxProvisionedPackage -Online -SkipLicense -PackagePath '{WINGET_INSTALLER_DEST}'",
-
-      "Write-Host '>>> Downloading package: {WINGET_SOURCE_SRC} to {WINGET_SOURCE_DEST}'",
-      "(new-object net.webclient).DownloadFile('{WINGET_SOURCE_SRC}', '{WINGET_SOURCE_DEST}')",
-      "Write-Host '>>> Installing package: {WINGET_SOURCE_DEST}'",
-      "Add-AppxPackage -ForceTargetApplicationShutdown -ForceUpdateFromAnyVersion -Path '{WINGET_SOURCE_DEST}'",
-      # "Add-AppxProvisionedPackage -Online -SkipLicense -PackagePath '{WINGET_SOURCE_DEST}'",
-
-      "winget --info",
-
-      "Write-Host '>>> Resetting winget source'",
-      "winget source reset --force",
-      "winget source list"
-    ]
-  }}
-
-  # Injected by az bake
-  provisioner "file" {{
-    source = "${{path.root}}/{WINGET_SETTINGS_FILE}"
-    destination = "{WINGET_SETTINGS_PATH}"
-  }}
-'''
-
 GITHUB_PROVIDER_NAME = 'GitHub'
 GITHUB_WORKFLOW_FILE = 'bake_images.yml'
 GITHUB_WORKFLOW_DIR = '.github/workflows'
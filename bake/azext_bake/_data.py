@@ -4,15 +4,24 @@
 # ------------------------------------
 # pylint: disable=too-many-instance-attributes
 
+import re
+
 from dataclasses import MISSING, asdict, dataclass, field, fields
 from pathlib import Path
-from typing import List, Literal, Optional
+from typing import List, Literal, Mapping, Optional
 
 from azure.cli.core.azclierror import ValidationError
 from azure.cli.core.util import is_guid
 from azure.mgmt.core.tools import is_valid_resource_id
 
-from ._constants import IMAGE_DEFAULT_BASE_WINDOWS
+from ._constants import (BUILDER_CPU_MAX, BUILDER_MEMORY_MAX, IMAGE_CHECKPOINT_MAX_AGE_DAYS, IMAGE_CHECKPOINT_STEPS,
+                         IMAGE_DEFAULT_BASE_WINDOWS, IMAGE_DEFAULT_VM, IMAGE_INCREMENTAL_FULL_REBUILD_DAYS,
+                         IMAGE_PUBLISH_REPLICA_COUNT_MAX, IMAGE_PUBLISH_STORAGE_ACCOUNT_TYPES,
+                         IMAGE_VM_DISK_CACHING_TYPES, IMAGE_VM_OS_DISK_TYPES)
+
+
+# variant names are used as packer source names
+VARIANT_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_-]*$')
 
 
 def _snake_to_camel(name: str):
@@ -48,10 +57,19 @@ def _validate_data_object(data_type: type, obj: dict, path: Path = None, parent_
             raise ValidationError(f'{name} contains an invalid property: {key_prefix}{k}')
 
 
-def get_dict(instance):
+def _validate_builder_resources(parent_key: str, cpu, memory):
+    '''Validates the builder container cpu and memory against the container instance limits'''
+    for key, value, maximum in [('cpu', cpu, BUILDER_CPU_MAX), ('memory', memory, BUILDER_MEMORY_MAX)]:
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)
+                                  or value <= 0 or value > maximum):
+            raise ValidationError(f'{parent_key}.{key} must be a number greater than 0 '
+                                  f'and less than or equal to {maximum}')
+
+
+def get_dict(instance, keep_false: bool = False):
     # TODO: shoul we filter False values?  How can we convert back to string lists fo things like choco packages?
     return asdict(instance, dict_factory=lambda x: {_snake_to_camel(k): v for k,
-                                                    v in x if v is not None and v is not False})
+                                                    v in x if v is not None and (keep_false or v is not False)})
 
 
 # --------------------------------
@@ -65,24 +83,50 @@ class PowershellScript:
     path: str
     # optional
     restart: bool = False
+    after: Optional[List[str]] = None
+    group: Optional[str] = None
 
     def __init__(self, obj: dict, path: Path = None) -> None:
         _validate_data_object(PowershellScript, obj, path=path, parent_key='install.scripts.powershell')
 
         self.path = obj['path']
         self.restart = obj.get('restart', False)
+        self.after = obj.get('after', None)
+        self.group = obj.get('group', None)
+
+        if isinstance(self.after, str):
+            self.after = [self.after]
+
+        if self.after is not None and (not isinstance(self.after, list)
+                                       or not all(isinstance(a, str) for a in self.after)):
+            raise ValidationError('install.scripts.powershell.after must be a script path or list of script paths')
+
+        if self.group is not None and (not isinstance(self.group, str) or not self.group):
+            raise ValidationError('install.scripts.powershell.group must be a non-empty string')
 
 
 @dataclass
 class ImageInstallScripts:
     # optional
     powershell: List[PowershellScript] = field(default_factory=list)
+    coalesce_restarts: bool = False
 
     def __init__(self, obj: dict, path: Path = None) -> None:
         _validate_data_object(ImageInstallScripts, obj, path=path, parent_key='install.scripts')
 
         self.powershell = [PowershellScript({'path': s}, path) if isinstance(s, str)
                            else PowershellScript(s, path) for s in obj['powershell']]
+        self.coalesce_restarts = obj.get('coalesceRestarts', False)
+
+        script_groups = {s.path: s.group for s in self.powershell}
+        for script in self.powershell:
+            for after in script.after or []:
+                if after == script.path or after not in script_groups:
+                    raise ValidationError(f'install.scripts.powershell {script.path} has an invalid after value: '
+                                          f'{after} (must be the path of another script)')
+                if script.group and script_groups[after] == script.group:
+                    raise ValidationError(f'install.scripts.powershell {script.path} has an invalid after value: '
+                                          f'{after} (scripts in the same group run in parallel)')
 
 
 # --------------------------------
@@ -200,6 +244,7 @@ class ImageInstallWinget:
     packages: List[WingetPackage] = field(default_factory=list)
     # optional
     defaults: Optional[WingetDefaults] = None
+    mode: Literal['import', 'install'] = 'import'
 
     def __init__(self, obj: dict, path: Path = None) -> None:
         _validate_data_object(ImageInstallWinget, obj, path=path, parent_key='install.winget')
@@ -207,6 +252,10 @@ class ImageInstallWinget:
         self.packages = [WingetPackage({'any': p}, path) if isinstance(p, str)
                          else WingetPackage(p, path) for p in obj['packages']]
         self.defaults = WingetDefaults(obj['defaults'], path) if 'defaults' in obj else None
+        self.mode = obj.get('mode', 'import')
+
+        if self.mode not in ['import', 'install']:
+            raise ValidationError('install.winget.mode must be one of: import, install')
 
 
 # --------------------------------
@@ -229,6 +278,86 @@ class ImageInstall:
         self.winget = ImageInstallWinget(obj['winget'], path) if 'winget' in obj else None
 
 
+# --------------------------------
+# Image > Builder
+# --------------------------------
+
+
+@dataclass
+class ImageBuilder:
+    # optional
+    cpu: float = None
+    memory: float = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageBuilder, obj, path=path, parent_key='builder')
+
+        self.cpu = obj.get('cpu', None)
+        self.memory = obj.get('memory', None)
+
+        _validate_builder_resources('builder', self.cpu, self.memory)
+
+
+# --------------------------------
+# Image > Update
+# --------------------------------
+
+
+@dataclass
+class ImageUpdate:
+    # optional
+    filters: Optional[List[str]] = None
+    max_updates: int = None
+    budget: int = None
+    skip_if_base_newer_than_days: int = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageUpdate, obj, path=path, parent_key='update')
+
+        self.filters = obj.get('filters', None)
+        self.max_updates = obj.get('maxUpdates', None)
+        self.budget = obj.get('budget', None)
+        self.skip_if_base_newer_than_days = obj.get('skipIfBaseNewerThanDays', None)
+
+        if self.filters is not None and (not isinstance(self.filters, list) or not self.filters
+                                         or not all(isinstance(f, str) and f.startswith(('include:', 'exclude:'))
+                                                    for f in self.filters)):
+            raise ValidationError('update.filters must be a list of filters that start with include: or exclude:')
+
+        for key, name in [('max_updates', 'maxUpdates'), ('budget', 'budget'),
+                          ('skip_if_base_newer_than_days', 'skipIfBaseNewerThanDays')]:
+            value = getattr(self, key)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                raise ValidationError(f'update.{name} must be a number greater than 0')
+
+
+# --------------------------------
+# Image > Budgets
+# --------------------------------
+
+
+@dataclass
+class ImageBudgets:
+    # optional (minutes)
+    build: int = None
+    update: int = None
+    choco: int = None
+    scripts: int = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageBudgets, obj, path=path, parent_key='budgets')
+
+        self.build = obj.get('build', None)
+        self.update = obj.get('update', None)
+        self.choco = obj.get('choco', None)
+        self.scripts = obj.get('scripts', None)
+
+        for key in ['build', 'update', 'choco', 'scripts']:
+            value = getattr(self, key)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                raise ValidationError(f'budgets.{key} must be a number of minutes greater than 0')
+
+
 # --------------------------------
 # Image
 # --------------------------------
@@ -252,6 +381,145 @@ class ImageBase:
         self.version = obj.get('version', 'latest')
 
 
+@dataclass
+class ImageVm:
+    # optional
+    size: str = IMAGE_DEFAULT_VM['size']
+    os_disk_type: Literal['Standard_LRS', 'Premium_LRS'] = IMAGE_DEFAULT_VM['osDiskType']
+    os_disk_size_gb: int = IMAGE_DEFAULT_VM['osDiskSizeGb']
+    disk_caching: Literal['None', 'ReadOnly', 'ReadWrite'] = IMAGE_DEFAULT_VM['diskCaching']
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageVm, obj, path=path, parent_key='vm')
+
+        self.size = obj.get('size', IMAGE_DEFAULT_VM['size'])
+        self.os_disk_type = obj.get('osDiskType', IMAGE_DEFAULT_VM['osDiskType'])
+        self.os_disk_size_gb = obj.get('osDiskSizeGb', IMAGE_DEFAULT_VM['osDiskSizeGb'])
+        self.disk_caching = obj.get('diskCaching', IMAGE_DEFAULT_VM['diskCaching'])
+
+        if not isinstance(self.size, str) or not self.size:
+            raise ValidationError('vm.size must be the name of an azure vm size (i.e. Standard_D8s_v3)')
+        if self.os_disk_type not in IMAGE_VM_OS_DISK_TYPES:
+            raise ValidationError(f'vm.osDiskType must be one of: {", ".join(IMAGE_VM_OS_DISK_TYPES)}')
+        if not isinstance(self.os_disk_size_gb, int) or isinstance(self.os_disk_size_gb, bool) \
+                or self.os_disk_size_gb < 0 or self.os_disk_size_gb > 4095:
+            raise ValidationError('vm.osDiskSizeGb must be a number between 0 and 4095')
+        if self.disk_caching not in IMAGE_VM_DISK_CACHING_TYPES:
+            raise ValidationError(f'vm.diskCaching must be one of: {", ".join(IMAGE_VM_DISK_CACHING_TYPES)}')
+
+
+@dataclass
+class ImagePublish:
+    # optional
+    managed_image: bool = False
+    replication: Literal['inline', 'deferred'] = 'inline'
+    storage_account_type: Literal['Standard_LRS', 'Standard_ZRS', 'Premium_LRS'] = 'Standard_LRS'
+    replica_count: int = 1
+    region_replica_counts: Mapping[str, int] = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImagePublish, obj, path=path, parent_key='publish')
+
+        self.managed_image = obj.get('managedImage', False)
+        self.replication = obj.get('replication', 'inline')
+        self.storage_account_type = obj.get('storageAccountType', 'Standard_LRS')
+        self.replica_count = obj.get('replicaCount', 1)
+        # packer requires every attribute of the publish variable, so this is an empty map (not None) by default
+        self.region_replica_counts = obj.get('regionReplicaCounts', None)
+        if self.region_replica_counts is None:
+            self.region_replica_counts = {}
+
+        if not isinstance(self.managed_image, bool):
+            raise ValidationError('publish.managedImage must be true or false')
+        if self.replication not in ['inline', 'deferred']:
+            raise ValidationError('publish.replication must be one of: inline, deferred')
+        if self.storage_account_type not in IMAGE_PUBLISH_STORAGE_ACCOUNT_TYPES:
+            raise ValidationError('publish.storageAccountType must be one of: '
+                                  f'{", ".join(IMAGE_PUBLISH_STORAGE_ACCOUNT_TYPES)}')
+        if not isinstance(self.region_replica_counts, dict):
+            raise ValidationError('publish.regionReplicaCounts must be an object of region names and replica counts')
+
+        counts = [('publish.replicaCount', self.replica_count)]
+        counts += [(f'publish.regionReplicaCounts.{r}', c) for r, c in self.region_replica_counts.items()]
+        for key, count in counts:
+            if not isinstance(count, int) or isinstance(count, bool) \
+                    or count < 1 or count > IMAGE_PUBLISH_REPLICA_COUNT_MAX:
+                raise ValidationError(f'{key} must be a number between 1 and {IMAGE_PUBLISH_REPLICA_COUNT_MAX}')
+
+
+@dataclass
+class ImageIncremental:
+    # optional
+    full_rebuild_days: int = IMAGE_INCREMENTAL_FULL_REBUILD_DAYS
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageIncremental, obj, path=path, parent_key='incremental')
+
+        self.full_rebuild_days = obj.get('fullRebuildDays', IMAGE_INCREMENTAL_FULL_REBUILD_DAYS)
+
+        if not isinstance(self.full_rebuild_days, int) or isinstance(self.full_rebuild_days, bool) \
+                or self.full_rebuild_days < 1:
+            raise ValidationError('incremental.fullRebuildDays must be a number of days greater than 0')
+
+
+@dataclass
+class ImageCheckpoints:
+    # required
+    after: List[str]
+    # optional
+    max_age_days: int = IMAGE_CHECKPOINT_MAX_AGE_DAYS
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageCheckpoints, obj, path=path, parent_key='checkpoints')
+
+        self.after = obj['after']
+        self.max_age_days = obj.get('maxAgeDays', IMAGE_CHECKPOINT_MAX_AGE_DAYS)
+
+        if isinstance(self.after, str):
+            self.after = [self.after]
+
+        if not isinstance(self.after, list) or not all(isinstance(a, str) for a in self.after):
+            raise ValidationError('checkpoints.after must be a list of install steps')
+        if not isinstance(self.max_age_days, int) or isinstance(self.max_age_days, bool) or self.max_age_days < 1:
+            raise ValidationError('checkpoints.maxAgeDays must be a number of days greater than 0')
+
+
+@dataclass
+class ImageVariant:
+    # required
+    name: str
+    # optional
+    sku: str = None
+    description: str = None
+    definition: str = None
+    base: Optional[ImageBase] = None
+    scripts: List[PowershellScript] = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(ImageVariant, obj, path=path, parent_key='variants')
+
+        self.name = obj['name']
+        self.sku = obj.get('sku', None)
+        self.description = obj.get('description', None)
+        self.definition = obj.get('definition', None)
+        # the base image properties that differ from the image's base, merged by the image
+        self.base = obj.get('base', None)
+        self.scripts = [PowershellScript({'path': s}, path) if isinstance(s, str)
+                        else PowershellScript(s, path) for s in obj.get('scripts', [])]
+
+        # the name is used for the packer source, so it must be a valid hcl identifier
+        if not isinstance(self.name, str) or not VARIANT_NAME.match(self.name):
+            raise ValidationError('variants.name must start with a letter and only contain letters, numbers, '
+                                  'hyphens, and underscores')
+
+        if self.base is not None and not isinstance(self.base, dict):
+            raise ValidationError(f'variants {self.name} base must be an object')
+
+        if any(script.after for script in self.scripts):
+            raise ValidationError(f'variants {self.name} scripts can not use after, they run in order after the '
+                                  'install.scripts of the image')
+
+
 @dataclass
 class Image:
     # required
@@ -265,7 +533,14 @@ class Image:
     description: str = None
     install: Optional[ImageInstall] = None
     base: ImageBase = None
-    update: bool = True
+    update: Optional[ImageUpdate] = None
+    budgets: Optional[ImageBudgets] = None
+    builder: Optional[ImageBuilder] = None
+    vm: ImageVm = None
+    publish: ImagePublish = None
+    incremental: Optional[ImageIncremental] = None
+    checkpoints: Optional[ImageCheckpoints] = None
+    variants: List[ImageVariant] = None
     # cli
     name: str = None
     dir: Path = None
@@ -291,7 +566,38 @@ class Image:
         else:
             raise ValidationError('Image base is required for non-Windows images')
 
-        self.update = obj.get('update', True)
+        # update can be true (install all updates), false (skip updates), or an object
+        update = obj.get('update', True)
+        if isinstance(update, bool):
+            self.update = ImageUpdate({}, path) if update else None
+        else:
+            self.update = ImageUpdate(update, path)
+
+        self.budgets = ImageBudgets(obj['budgets'], path) if 'budgets' in obj else None
+
+        if self.update and self.update.budget and self.budgets and self.budgets.update:
+            raise ValidationError('Set either update.budget or budgets.update, not both')
+        self.builder = ImageBuilder(obj['builder'], path) if 'builder' in obj else None
+        self.vm = ImageVm(obj.get('vm', {}), path)
+        self.publish = ImagePublish(obj.get('publish', {}), path)
+
+        # incremental can be true (use the defaults) or an object
+        incremental = obj.get('incremental', False)
+        if isinstance(incremental, bool):
+            self.incremental = ImageIncremental({}, path) if incremental else None
+        else:
+            self.incremental = ImageIncremental(incremental, path)
+
+        self.checkpoints = ImageCheckpoints(obj['checkpoints'], path) if 'checkpoints' in obj else None
+
+        if self.checkpoints:
+            # checkpoints are taken after the windows updates, choco packages, winget packages, or an install script
+            scripts = [Path(s.path).as_posix() for s in self.install.scripts.powershell] \
+                if self.install and self.install.scripts else []
+            for step in self.checkpoints.after:
+                if step not in IMAGE_CHECKPOINT_STEPS and Path(step).as_posix() not in scripts:
+                    raise ValidationError(f'checkpoints.after {step} must be one of: '
+                                          f'{", ".join(IMAGE_CHECKPOINT_STEPS)}, or the path of an install script')
 
         if path:
             self.name = path.parent.name
@@ -302,6 +608,21 @@ class Image:
         else:
             raise ValidationError('Image name is required if not using a file path')
 
+        # variants share the image's install steps and are published to their own gallery image definitions
+        self.variants = [ImageVariant(v, path) for v in obj.get('variants', [])]
+        names = [v.name for v in self.variants]
+        if len(set(names)) != len(names):
+            raise ValidationError('variants names must be unique')
+        if self.variants and self.incremental:
+            raise ValidationError('Images with variants can not be built incrementally')
+        if self.variants and self.checkpoints:
+            raise ValidationError('Images with variants can not use checkpoints')
+
+        for variant in self.variants:
+            variant.definition = variant.definition or f'{self.name}-{variant.name}'
+            variant.sku = variant.sku or f'{self.sku}-{variant.name}'
+            variant.base = ImageBase({**get_dict(self.base), **(variant.base or {})}, path)
+
 
 # --------------------------------
 # Sandbox
@@ -369,6 +690,58 @@ class Gallery:
             raise ValidationError('gallery.subscription is not a valid GUID')
 
 
+# --------------------------------
+# Builder
+# --------------------------------
+
+
+@dataclass
+class BuilderRetention:
+    # optional (unset limits keep every run)
+    keep_runs: int = None
+    max_age_days: int = None
+    max_size_mb: int = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(BuilderRetention, obj, path=path, parent_key='builder.retention')
+
+        self.keep_runs = obj.get('keepRuns', None)
+        self.max_age_days = obj.get('maxAgeDays', None)
+        self.max_size_mb = obj.get('maxSizeMb', None)
+
+        for key, value, minimum in [('keepRuns', self.keep_runs, 0), ('maxAgeDays', self.max_age_days, 1),
+                                    ('maxSizeMb', self.max_size_mb, 1)]:
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < minimum):
+                raise ValidationError(f'builder.retention.{key} must be an integer greater than or equal to {minimum}')
+
+
+@dataclass
+class Builder:
+    # optional
+    output: Literal['files', 'archive'] = 'files'
+    retention: BuilderRetention = None
+    status: bool = False
+    cpu: float = None
+    memory: float = None
+
+    def __init__(self, obj: dict, path: Path = None) -> None:
+        _validate_data_object(Builder, obj, path=path, parent_key='builder')
+
+        self.output = obj.get('output', 'files')
+        self.status = obj.get('status', False)
+        # builder output is only compressed or deleted if bake.yml has a retention policy
+        self.retention = BuilderRetention(obj['retention'], path) if 'retention' in obj else None
+        self.cpu = obj.get('cpu', None)
+        self.memory = obj.get('memory', None)
+
+        if self.output not in ['files', 'archive']:
+            raise ValidationError("builder.output must be one of 'files' or 'archive'")
+        if not isinstance(self.status, bool):
+            raise ValidationError('builder.status must be true or false')
+
+        _validate_builder_resources('builder', self.cpu, self.memory)
+
+
 # --------------------------------
 # BakeConfig
 # --------------------------------
@@ -381,6 +754,8 @@ class BakeConfig:
     version: int
     sandbox: Sandbox
     gallery: Gallery
+    # optional
+    builder: Builder = None
     # cli
     name: str = None
     dir: Path = None
@@ -400,3 +775,4 @@ class BakeConfig:
         self.version = obj['version']
         self.sandbox = Sandbox(obj['sandbox'], path)
         self.gallery = Gallery(obj['gallery'], path)
+        self.builder = Builder(obj.get('builder', {}), path)
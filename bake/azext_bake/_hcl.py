@@ -0,0 +1,218 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import hashlib
+import json
+import re
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, List, Mapping, Tuple
+
+from azure.cli.core.azclierror import ValidationError
+
+from ._constants import BAKE_PLACEHOLDER, PKR_BUILD_FILE
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+INDENT = '  '
+
+PLACEHOLDER_LINE = re.compile(r'^[ \t]*' + re.escape(BAKE_PLACEHOLDER), re.MULTILINE)
+BUILD_SOURCES = re.compile(r'(?m)^[ \t]*sources\s*=\s*\[(?P<sources>[^\]]*)\]')
+
+
+def strip_hcl_comments(content: str) -> str:
+    '''Replaces hcl comments with spaces (preserving strings and offsets) so they are ignored when parsing'''
+    chars = list(content)
+    i, length = 0, len(content)
+    while i < length:
+        c = content[i]
+        if c == '"':  # skip over strings, including escaped quotes
+            i += 1
+            while i < length and content[i] not in '"\n':
+                i += 2 if content[i] == '\\' else 1
+            i += 1
+        elif c == '#' or content.startswith('//', i):
+            end = content.find('\n', i)
+            end = length if end < 0 else end
+            chars[i:end] = ' ' * (end - i)
+            i = end
+        elif content.startswith('/*', i):
+            end = content.find('*/', i + 2)
+            end = length if end < 0 else end + 2
+            chars[i:end] = [ch if ch == '\n' else ' ' for ch in content[i:end]]
+            i = end
+        else:
+            i += 1
+    return ''.join(chars)
+
+
+def find_closing(content: str, start: int) -> int:
+    '''Finds the index of the bracket that closes the one at start, ignoring brackets in strings'''
+    depth, i = 0, start
+    in_string = False
+    while i < len(content):
+        c = content[i]
+        if in_string:
+            if c == '\\':
+                i += 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '{([':
+            depth += 1
+        elif c in '})]':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return len(content)
+
+
+class Raw(str):
+    '''A value rendered into hcl as is (i.e. an expression like build.User or a template like "${path.root}/file")'''
+
+
+def hcl_string(value: str) -> str:
+    '''Quotes a value as a double quoted hcl string, escaping quotes, backslashes, control characters,
+    and template sequences (i.e. ${ and %{)'''
+    return json.dumps(value, ensure_ascii=False).replace('${', '$${').replace('%{', '%%{')
+
+
+def hcl_value(value: Any, depth: int = 0) -> str:
+    '''Renders a python value (str, bool, int, float, list, or Raw) as an hcl expression'''
+    if isinstance(value, Raw):
+        return str(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return json.dumps(value)
+    if isinstance(value, str):
+        return hcl_string(value)
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return '[]'
+        indent = INDENT * (depth + 1)
+        items = ',\n'.join(f'{indent}{hcl_value(v, depth + 1)}' for v in value)
+        return f'[\n{items}\n{INDENT * depth}]'
+    raise ValidationError(f'Unable to render {type(value).__name__} value as hcl')
+
+
+@dataclass
+class Provisioner:
+    '''A packer provisioner block. Attributes are rendered in order, attributes set to None are left out'''
+    type: str
+    attributes: Mapping[str, Any] = field(default_factory=dict)
+    comments: List[str] = field(default_factory=list)
+
+    def render(self, depth: int = 1) -> str:
+        indent = INDENT * depth
+        lines = [f'{indent}# Injected by az bake'] + [f'{indent}# {c}' for c in self.comments]
+        lines.append(f'{indent}provisioner {hcl_string(self.type)} {{')
+        attributes = {k: hcl_value(v, depth + 1) for k, v in self.attributes.items() if v is not None}
+        # like packer fmt, the single line attributes are aligned
+        width = max((len(k) for k, v in attributes.items() if '\n' not in v), default=0)
+        for key, value in attributes.items():
+            name = key if '\n' in value else key.ljust(width)
+            lines.append(f'{indent}{INDENT}{name} = {value}')
+        lines.append(f'{indent}}}')
+        return '\n'.join(lines)
+
+
+def _find_source(content: str, source_type: str, name: str):
+    return re.search(r'(?m)^source\s+"' + re.escape(source_type) + r'"\s+"' + re.escape(name) + r'"\s*\{', content)
+
+
+class PackerBuildFile:
+    '''A packer build file template (build.pkr.hcl) and the provisioners and sources az bake injects into it.
+    They are collected in memory and rendered into the template in one pass'''
+
+    def __init__(self, template: str):
+        if BAKE_PLACEHOLDER not in template:
+            raise ValidationError(f'Could not find {BAKE_PLACEHOLDER} in {PKR_BUILD_FILE}')
+        self.template = template
+        self.provisioners: List[Provisioner] = []
+        # copies of the template's sources (source, name, replacements), built in parallel by packer
+        self.sources: List[Tuple[str, str, Mapping[str, Any]]] = []
+        # other files the provisioners upload from the image directory (name: content)
+        self.files: Mapping[str, str] = {}
+
+    @classmethod
+    def load(cls, image_dir: Path):
+        build_file_path = image_dir / PKR_BUILD_FILE
+        if not build_file_path.is_file():
+            raise ValidationError(f'Could not find {PKR_BUILD_FILE} file at {build_file_path}')
+        return cls(build_file_path.read_text(encoding='utf-8'))
+
+    def add(self, *provisioners: Provisioner):
+        self.provisioners.extend(provisioners)
+
+    def add_source(self, source: str, name: str, replacements: Mapping[str, Any] = None):
+        '''Adds a copy of a source in the template (i.e. azure-arm.vm) to the build's sources. Expressions in the copy
+        (i.e. var.image.name) are replaced by the values in replacements'''
+        self.sources.append((source, name, dict(replacements or {})))
+
+    def _render_sources(self, content: str) -> str:
+        stripped = strip_hcl_comments(content)
+        copies = {}
+        added = []
+
+        for source, name, replacements in self.sources:
+            source_type, source_name = source.split('.', 1)
+            if _find_source(stripped, source_type, name) or f'{source_type}.{name}' in added:
+                raise ValidationError(f'{PKR_BUILD_FILE} already has a source named {source_type}.{name}')
+            match = _find_source(stripped, source_type, source_name)
+            if not match:
+                raise ValidationError(f'Could not find source {source} in {PKR_BUILD_FILE}')
+
+            end = find_closing(stripped, match.end() - 1)
+            # the comments are copied too, they separate the (aligned) groups of attributes
+            body = content[match.end():end].strip('\n').rstrip()
+            for expression, value in replacements.items():
+                pattern = r'(?<![\w.])' + re.escape(expression) + r'(?![\w.])'
+                body = re.sub(pattern, lambda _, v=value: hcl_value(v, 1), body)
+
+            copy = f'\n\n# Injected by az bake\nsource {hcl_string(source_type)} {hcl_string(name)} {{\n{body}\n}}'
+            # copies are added after the source they copy
+            copies[end + 1] = copies.get(end + 1, '') + copy
+            added.append(f'{source_type}.{name}')
+
+        match = BUILD_SOURCES.search(stripped)
+        if not match:
+            raise ValidationError(f'Could not find the build sources in {PKR_BUILD_FILE}')
+        sources = content[match.start('sources'):match.end('sources')].rstrip()
+        sources += ''.join(f', {hcl_string("source." + a)}' for a in added)
+        edits = [(position, position, text) for position, text in copies.items()]
+        edits.append((match.start('sources'), match.end('sources'), sources))
+
+        # apply the edits from the end so the offsets of the others don't change
+        for start, end, text in sorted(edits, key=lambda e: e[0], reverse=True):
+            content = content[:start] + text + content[end:]
+        return content
+
+    def render(self) -> str:
+        '''Renders the build file. The output only depends on the template, sources, and provisioners'''
+        content = self._render_sources(self.template) if self.sources else self.template
+        injected = ''.join(f'\n{p.render()}\n' for p in self.provisioners).rstrip('\n')
+        # the placeholder line (including its indentation) is replaced by the provisioners
+        return PLACEHOLDER_LINE.sub(lambda _: injected, content, count=1)
+
+    def fingerprint(self) -> str:
+        '''Gets a hash of the rendered build file and the files it uploads'''
+        sha = hashlib.sha256(self.render().encode('utf-8'))
+        for name in sorted(self.files):
+            sha.update(b'\0' + name.encode('utf-8') + b'\0' + self.files[name].encode('utf-8'))
+        return sha.hexdigest()[:16]
+
+    def save(self, image_dir: Path):
+        '''Writes the build file and the files it uploads to the image directory'''
+        for name, content in self.files.items():
+            logger.info(f'Creating file: {image_dir / name}')
+            (image_dir / name).write_text(content, encoding='utf-8')
+        logger.info(f'Writing {len(self.provisioners)} provisioners to {image_dir / PKR_BUILD_FILE}')
+        (image_dir / PKR_BUILD_FILE).write_text(self.render(), encoding='utf-8')
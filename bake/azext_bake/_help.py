@@ -39,6 +39,34 @@ examples:
     text: az bake sandbox validate --sandbox mySandbox --gallery myGallery
 """
 
+helps['bake sandbox gc'] = """
+type: command
+short-summary: Compress or delete old builder output on the sandbox storage file shares.
+long-summary: Builder runs beyond the most recent --keep-runs are compressed into a single archive, runs older than --max-age-days are deleted, and the oldest runs are deleted until the output for each image is under --max-size-mb. The builder.retention policy in the repository's bake.yml is used for the options that are not set, it's the same policy the builder applies when it starts. Without either, every run is kept. The storage account network rules must allow your client to access the shares.
+examples:
+  - name: Show what the retention policy in bake.yml would compress or delete for all images in a sandbox.
+    text: az bake sandbox gc --sandbox mySandbox --dry-run
+  - name: Keep the last 3 builder runs for an image and delete runs older than a week.
+    text: az bake sandbox gc --sandbox mySandbox --images myImage --keep-runs 3 --max-age-days 7
+"""
+
+
+helps['bake sandbox cache'] = """
+type: group
+short-summary: Manage package caches in the sandbox storage account.
+"""
+
+helps['bake sandbox cache choco'] = """
+type: command
+short-summary: Cache the choco packages used by the images in a repo in the sandbox storage account.
+long-summary: Downloads the choco packages (and their dependencies) from the community feed to the choco file share in the sandbox storage account. Builders mount the share and install cached packages from it at the cached version, falling back to the community feed. Packages without a version are cached at the latest version, run the command again to update them. Only the packages are cached, installers that packages download when they're installed are not. The storage account network rules must allow your client to access the shares.
+examples:
+  - name: Cache the choco packages for all the images in a repo.
+    text: az bake sandbox cache choco --sandbox mySandbox --repo .
+  - name: Cache the choco packages for an image locally for az bake image build --local.
+    text: az bake sandbox cache choco --repo . --images myImage --local
+"""
+
 
 # ----------------
 # bake repo
@@ -91,6 +119,17 @@ examples:
     text: az bake image create --name myImage
 """
 
+helps['bake image build'] = """
+type: command
+short-summary: Build an image.
+long-summary: By default a builder container is deployed to the sandbox to build the image (see az bake repo build). With --local the builder runs in-process against the local repository, using the packer install and credentials on your machine. Add .local to your .gitignore file.
+examples:
+  - name: Build an image in the sandbox.
+    text: az bake image build --name myImage
+  - name: Build an image locally.
+    text: az bake image build --name myImage --local
+"""
+
 helps['bake image logs'] = """
 type: command
 short-summary: Get the logs for an image build.
@@ -99,6 +138,39 @@ examples:
     text: az bake image logs --sandbox mySandbox --name myImage
 """
 
+helps['bake image status'] = """
+type: command
+short-summary: Get the status of an image build.
+long-summary: Reads the small status manifest the builder maintains on the sandbox storage file share. The storage account network rules must allow your client to access the share.
+examples:
+  - name: Get the status of the most recent build of an image.
+    text: az bake image status --sandbox mySandbox --name myImage
+  - name: Get the status of a specific build of an image.
+    text: az bake image status --sandbox mySandbox --name myImage --run 20221027153001
+"""
+
+helps['bake image artifacts'] = """
+type: command
+short-summary: List or extract the files a builder saved to the sandbox storage file share.
+long-summary: When the builder output is an archive (builder.output set to archive in bake.yml) only the small index is read to list the files and each extracted file is read from the archive with a ranged read. The storage account network rules must allow your client to access the share.
+examples:
+  - name: List the files saved by the most recent build of an image.
+    text: az bake image artifacts --sandbox mySandbox --name myImage
+  - name: Extract the packer files from a specific build of an image.
+    text: az bake image artifacts --sandbox mySandbox --name myImage --run 20221027153001 --file build.pkr.hcl variable.pkr.hcl --outdir ./out
+"""
+
+helps['bake image replicate'] = """
+type: command
+short-summary: Replicate an image version to additional regions.
+long-summary: Images with publish.replication set to deferred in image.yml are only published to the build region, so the builder finishes sooner. The builder starts replicating the version to the image's replicaLocations after the build. Use this command to check the progress of that replication or to replicate a version to more regions. When the image.yml is read (no --regions or --gallery) the replica counts in its publish.regionReplicaCounts are applied too.
+examples:
+  - name: Replicate the latest version of an image to the replicaLocations in image.yml and wait for it to finish.
+    text: az bake image replicate --name myImage
+  - name: Replicate a specific version of an image to specific regions without waiting.
+    text: az bake image replicate --name myImage --gallery myGallery --version 1.0.2 --regions eastus westeurope --no-wait
+"""
+
 helps['bake image rebuild'] = """
 type: command
 short-summary: Rebuild an image that failed.
@@ -0,0 +1,145 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import hashlib
+import json
+import os
+import re
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Mapping, Sequence
+
+from ._constants import IMAGE_VERSION_TAG_LIMIT, tag_key
+from ._data import Image, PowershellScript, WingetPackage, get_dict
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+# gallery image version tags written by incremental builds
+INCREMENTAL_BASE_TAG = tag_key('base')
+INCREMENTAL_FULL_BUILD_TAG = tag_key('full-build')
+INCREMENTAL_STEP_TAG_PREFIX = tag_key('step:')
+
+# characters that aren't allowed in azure tag names
+TAG_NAME_INVALID_CHARS = re.compile(r'[<>%&\\?/]')
+
+
+def hash_inputs(*parts) -> str:
+    '''Gets a short hash of the inputs of an install step (bytes or values converted to strings)'''
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()[:16]
+
+
+def _step_tag(step: str) -> str:
+    return INCREMENTAL_STEP_TAG_PREFIX + TAG_NAME_INVALID_CHARS.sub('-', step)
+
+
+def get_script_path(image: Image, script: PowershellScript) -> str:
+    '''Gets the path of a script relative to the image directory (i.e. ../../scripts/Install-Git.ps1 for scripts
+    outside it), used to name its install step'''
+    path = script.path.replace('${path.root}', str(image.dir))
+    return Path(os.path.relpath(path, image.dir)).as_posix()
+
+
+def get_base_hash(image: Image) -> str:
+    '''Gets a hash of the image's base image properties'''
+    return hash_inputs(json.dumps(get_dict(image.base), sort_keys=True))
+
+
+def get_install_steps(image: Image, powershell_scripts: Sequence[PowershellScript] = None,
+                      choco_configs: Mapping[str, str] = None, winget_packages: Sequence[WingetPackage] = None) -> dict:
+    '''Gets a hash of the inputs of each install step, keyed by the step name (i.e. script:scripts/Install-Git.ps1).
+    The steps are in build order: windows updates, scripts, choco packages, and winget packages'''
+    steps = {}
+    if image.update:
+        steps['update'] = hash_inputs(json.dumps(get_dict(image.update), sort_keys=True))
+    for script in powershell_scripts or []:
+        content = (image.dir / get_script_path(image, script)).read_bytes()
+        steps[f'script:{get_script_path(image, script)}'] = hash_inputs(content, script.restart)
+    for name, config in (choco_configs or {}).items():
+        if config:
+            steps[f'choco:{name}'] = hash_inputs(config)
+    if winget_packages:
+        steps['winget'] = hash_inputs(json.dumps([get_dict(p) for p in winget_packages], sort_keys=True))
+    return steps
+
+
+def get_version_tags(image: Image, steps: Mapping[str, str], full_build: str) -> dict:
+    '''Gets the tags that record the install steps of a gallery image version for future incremental builds'''
+    tags = {
+        INCREMENTAL_BASE_TAG: get_base_hash(image),
+        INCREMENTAL_FULL_BUILD_TAG: full_build
+    }
+    limit = IMAGE_VERSION_TAG_LIMIT - len(tags)
+    if len(steps) > limit:
+        # steps without a tag are run again by every incremental build
+        logger.warning(f'Image {image.name} has more install steps than can be recorded in gallery version tags. '
+                       f'The last {len(steps) - limit} steps will run in every incremental build')
+    for step in list(steps)[:limit]:
+        tags[_step_tag(step)] = steps[step]
+    return tags
+
+
+def plan_incremental_build(image: Image, version, steps: Mapping[str, str], location: str = None,
+                           now: datetime = None):
+    '''Decides if the image can be built from its latest gallery version instead of the base image.
+    Returns the source version name (None for a full build), the install steps to run, and the reason'''
+    now = now or datetime.now(timezone.utc)
+
+    def _full(reason):
+        return None, list(steps), reason
+
+    if version is None:
+        return _full('the image has no published versions')
+
+    tags = version.tags or {}
+    full_build = tags.get(INCREMENTAL_FULL_BUILD_TAG)
+
+    if not full_build:
+        return _full(f'version {version.name} was not built incrementally')
+
+    if tags.get(INCREMENTAL_BASE_TAG) != get_base_hash(image):
+        return _full('the base image changed')
+
+    age = (now - datetime.fromisoformat(full_build)).days
+    if age >= image.incremental.full_rebuild_days:
+        return _full(f'the last full build was {age} days ago')
+
+    if location:
+        regions = [r.name.replace(' ', '').lower() for r in version.publishing_profile.target_regions or []]
+        if location.replace(' ', '').lower() not in regions:
+            return _full(f'version {version.name} is not replicated to {location}')
+
+    # installed packages and scripts can't be undone, so removing a step requires a full build
+    published = {name for name in tags if name.startswith(INCREMENTAL_STEP_TAG_PREFIX)}
+    removed = published - {_step_tag(step) for step in steps}
+    if removed:
+        removed = ', '.join(sorted(name[len(INCREMENTAL_STEP_TAG_PREFIX):] for name in removed))
+        return _full(f'install steps were removed: {removed}')
+
+    changed = [step for step in steps if tags.get(_step_tag(step)) != steps[step]]
+    return version.name, changed, f'{len(changed)} of {len(steps)} install steps changed since version {version.name}'
+
+
+def get_full_build_time(version=None) -> str:
+    '''Gets the time of the last full build, carried forward from the source version of an incremental build'''
+    if version is not None and version.tags and version.tags.get(INCREMENTAL_FULL_BUILD_TAG):
+        return version.tags[INCREMENTAL_FULL_BUILD_TAG]
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def filter_install_steps(image: Image, powershell_scripts: Sequence[PowershellScript], choco_configs: Mapping[str, str],
+                         winget_packages: Sequence[WingetPackage], changed: Sequence[str]):
+    '''Removes the powershell scripts, choco configs, and winget packages that didn't change since the source version.
+    Windows updates aren't removed, updates are released between builds so they always run (see plan_windows_update)'''
+    scripts = [s for s in powershell_scripts or [] if f'script:{get_script_path(image, s)}' in changed]
+    configs = {name: config if f'choco:{name}' in changed else None for name, config in (choco_configs or {}).items()}
+    packages = winget_packages if 'winget' in changed else None
+    return scripts, configs, packages
@@ -4,22 +4,33 @@
 # ------------------------------------
 # pylint: disable=logging-fstring-interpolation
 
+import hashlib
 import json
 import os
+import re
 import shutil
+import signal
 import subprocess
 import sys
+import threading
+import time
+import zipfile
 
 from pathlib import Path
-from typing import Any, Mapping, Sequence
-
-from azure.cli.core.azclierror import ValidationError
-
-from ._constants import (BAKE_PLACEHOLDER, CHOCO_PACKAGES_CONFIG_FILE, CHOCO_PACKAGES_USER_CONFIG_FILE,
-                         PKR_AUTO_VARS_FILE, PKR_BUILD_FILE, PKR_DEFAULT_VARS, PKR_PROVISIONER_CHOCO,
-                         PKR_PROVISIONER_CHOCO_USER, PKR_PROVISIONER_RESTART, PKR_PROVISIONER_UPDATE,
-                         PKR_PROVISIONER_WINGET_INSTALL, PKR_VARS_FILE, WINGET_SETTINGS_FILE, WINGET_SETTINGS_JSON)
-from ._data import Gallery, Image, PowershellScript, Sandbox, WingetPackage, get_dict
+from typing import Any, List, Mapping, Sequence
+
+from azure.cli.core.azclierror import CLIError, ValidationError
+
+from ._constants import (CHOCO_PACKAGES_CONFIG_FILE, CHOCO_PACKAGES_USER_CONFIG_FILE, INSTALL_BUNDLE_DIR,
+                         INSTALL_BUNDLE_FILE, INSTALL_SCRIPT_GROUP_FILE, OUTPUT_DIR, PKR_AUTO_VARS_FILE,
+                         PKR_BUILD_FILE, PKR_BUILD_SOURCE, PKR_DEFAULT_VARS, PKR_RESTART_PAUSE_MINUTES, PKR_VARS_FILE,
+                         WINGET_IMPORT_FILE, WINGET_INSTALLER_DEST, WINGET_INSTALLER_SRC, WINGET_SETTINGS_FILE,
+                         WINGET_SETTINGS_JSON, WINGET_SETTINGS_PATH, WINGET_SOURCE_DEST, WINGET_SOURCE_SRC)
+from ._data import (Gallery, Image, ImageBudgets, ImageUpdate, ImageVariant, PowershellScript, Sandbox, WingetPackage,
+                    get_dict)
+from ._hcl import PackerBuildFile, Provisioner, Raw, find_closing, strip_hcl_comments
+from ._scheduler import group_powershell_scripts
+from ._status import BuildStatus
 from ._utils import get_logger, get_templates_path
 
 logger = get_logger(__name__)
@@ -63,23 +74,95 @@ def _parse_command(command):
     return args
 
 
+# packer variables declared in each .pkr.hcl file, keyed by the sha256 of the file content
+_packer_vars_cache = {}
+
+PKR_VARIABLE_BLOCK = re.compile(r'(?m)^\s*variable\s+"(?P<name>[^"]+)"\s*\{')
+PKR_VARIABLE_TYPE = re.compile(r'(?m)^\s*type\s*=\s*(?P<type>\w+)\s*(?P<paren>\()?')
+PKR_OBJECT_ATTRIBUTE = re.compile(r'(?m)(?:^|,)\s*"?(?P<name>[A-Za-z_][\w-]*)"?\s*=')
+
+
+def _top_level(content: str) -> str:
+    '''Blanks out everything nested inside brackets so only the top level of a block is matched'''
+    chars = list(content)
+    i = 0
+    in_string = False
+    while i < len(content):
+        c = content[i]
+        if in_string:
+            if c == '\\':
+                i += 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '{([':
+            end = find_closing(content, i)
+            chars[i + 1:end] = [ch if ch == '\n' else ' ' for ch in content[i + 1:end]]
+            i = end
+        i += 1
+    return ''.join(chars)
+
+
+def parse_packer_variables(content: str):
+    '''Gets the variables declared in packer hcl, with the attribute names for object variables
+    e.g. {'image': ['name', 'version', ...], 'repos': []}'''
+    content = strip_hcl_comments(content)
+    variables = {}
+    for match in PKR_VARIABLE_BLOCK.finditer(content):
+        block_start = match.end() - 1
+        block = content[block_start + 1:find_closing(content, block_start)]
+
+        attributes = []
+        var_type = PKR_VARIABLE_TYPE.search(_top_level(block))
+        if var_type and var_type.group('type') == 'object' and var_type.group('paren'):
+            paren = var_type.end() - 1
+            object_type = block[paren + 1:find_closing(block, paren)].strip()
+            if object_type.startswith('{'):
+                attributes = [a.group('name') for a in PKR_OBJECT_ATTRIBUTE.finditer(_top_level(object_type[1:-1]))]
+
+        variables[match.group('name')] = attributes
+    return variables
+
+
 def get_packer_vars(image: Image):
-    '''Gets the available packer variables from the variable.pkr.hcl file'''
-    try:
-        args = _parse_command(['inspect', '-machine-readable', image.dir])
-        logger.info(f'Running packer command: {" ".join(args)}')
-        proc = subprocess.run(args, capture_output=True, check=True, text=True)
-        if proc.stdout:
-            logger.info(f'\n\n{proc.stdout}')
-            return [v.strip().split('var.')[1].split(':')[0] for v in proc.stdout.split('\\n') if v.startswith('var.')]
-        return PKR_DEFAULT_VARS
-    except subprocess.CalledProcessError:
-        return PKR_DEFAULT_VARS
+    '''Gets the variables declared in the image's packer files (i.e. variable.pkr.hcl) without running packer'''
+    pkr_vars = {}
+    for hcl_file in sorted(image.dir.glob('*.pkr.hcl')):
+        content = hcl_file.read_text(encoding='utf-8')
+        key = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        if key not in _packer_vars_cache:
+            _packer_vars_cache[key] = parse_packer_variables(content)
+        pkr_vars.update(_packer_vars_cache[key])
+    return pkr_vars or PKR_DEFAULT_VARS
+
+
+PKR_VARIABLE_REFERENCE = re.compile(r'\bvar\.(?P<name>[A-Za-z_][\w-]*)(?:\.(?P<attribute>[A-Za-z_][\w-]*))?')
+
+
+def get_missing_packer_vars(image: Image, content: str) -> List[str]:
+    '''Gets the variables and object attributes referenced in packer hcl (i.e. build.pkr.hcl) that aren't declared in
+    the image's packer files, e.g. ['image.vm', 'sourceVersion']'''
+    pkr_vars = get_packer_vars(image)
+    missing = []
+    for match in PKR_VARIABLE_REFERENCE.finditer(strip_hcl_comments(content)):
+        name, attribute = match.group('name', 'attribute')
+        if name not in pkr_vars:
+            reference = name
+        # attributes are only known for object variables
+        elif attribute and pkr_vars[name] and attribute not in pkr_vars[name]:
+            reference = f'{name}.{attribute}'
+        else:
+            continue
+        if reference not in missing:
+            missing.append(reference)
+    return missing
 
 
 def _clean_for_vars(obj, allowed_keys):
     '''Cleans an object for use as packer variables'''
-    obj_dict = get_dict(obj)
+    # packer requires every attribute of an object variable, so false values are kept
+    obj_dict = get_dict(obj, keep_false=True)
     obj_vars = {}
     for k in obj_dict:
         if k in allowed_keys:
@@ -99,9 +182,9 @@ def save_packer_vars_file(sandbox: Sandbox, gallery: Gallery, image: Image, addi
             if v in additonal_vars and additonal_vars[v]:
                 auto_vars[v] = additonal_vars[v]
 
-    auto_vars['sandbox'] = _clean_for_vars(sandbox, PKR_DEFAULT_VARS['sandbox'])
-    auto_vars['gallery'] = _clean_for_vars(gallery, PKR_DEFAULT_VARS['gallery'])
-    auto_vars['image'] = _clean_for_vars(image, PKR_DEFAULT_VARS['image'])
+    auto_vars['sandbox'] = _clean_for_vars(sandbox, pkr_vars.get('sandbox') or PKR_DEFAULT_VARS['sandbox'])
+    auto_vars['gallery'] = _clean_for_vars(gallery, pkr_vars.get('gallery') or PKR_DEFAULT_VARS['gallery'])
+    auto_vars['image'] = _clean_for_vars(image, pkr_vars.get('image') or PKR_DEFAULT_VARS['image'])
 
     logger.info(f'Saving {image.name} packer auto variables:')
     for line in json.dumps(auto_vars, indent=4).splitlines():
@@ -128,22 +211,341 @@ def packer_init(image: Image):
     return proc.returncode
 
 
-def packer_build(image: Image):
+# packer ui output that indicates a new step in the build started, the first match wins
+# e.g. ==> azure-arm.vm: Provisioning with powershell script: /mnt/repo/images/MyImage/script.ps1
+PKR_OUTPUT_STEPS = [
+    (re.compile(r'^==> [^:]+: Provisioning with (?P<name>.+?)\.*$'), 'provisioner', '{name}'),
+    (re.compile(r'^==> [^:]+: Restarting Machine'), 'restart', 'windows-restart'),
+    (re.compile(r'^==> [^:]+: Running Windows update'), 'update', 'windows-update'),
+    (re.compile(r'^==> [^:]+: (?:Uploading|Downloading) (?P<name>\S+)'), 'provisioner', 'file: {name}'),
+    (re.compile(r'^==> [^:]+: Deploying deployment template'), 'deploy', 'deploy build vm'),
+    (re.compile(r'^==> [^:]+: Waiting for WinRM to become available'), 'connect', 'connect winrm'),
+    (re.compile(r'^==> [^:]+: (?:Querying the machine\'s properties|Powering off machine)'), 'capture', 'capture'),
+    (re.compile(r'^==> [^:]+: Publishing to Shared Image Gallery'), 'replicate', 'publish to gallery'),
+    (re.compile(r'^==> [^:]+: (?:Deleting individual resources|Removing the created Deployment)'),
+     'cleanup', 'cleanup'),
+    # bundled scripts and choco configs run inline, so the injected provisioners write a marker for each step
+    # e.g.     azure-arm.vm: >>> Running script: scripts/001-Install-Git.ps1
+    (re.compile(r'^\s*[^:]+: >>> (?P<name>(?:Running script(?: group)?|Installing choco packages|'
+                r'Registering choco packages for users|Installing winget packages): .+)$'), 'provisioner', '{name}'),
+]
+
+# the markers written by the inline provisioners az bake injects (see PKR_OUTPUT_STEPS)
+PKR_STEP_MARKER = re.compile(r"Write-Host '>>> (?:Running script(?: group)?|Installing choco packages|"
+                             r"Registering choco packages for users|Installing winget packages): ")
+PKR_STEP_MARKER_NAMES = ('Running script:', 'Running script group:', 'Installing choco packages:',
+                         'Registering choco packages for users:', 'Installing winget packages:')
+
+# the outcome of each package written by the injected winget provisioner
+# e.g.     azure-arm.vm: --- winget package Git.Git: installed
+PKR_OUTPUT_PACKAGES = re.compile(r'^\s*[^:]+: --- winget package (?P<name>.+): (?P<outcome>installed|failed)$')
+
+# packer ui output that is counted on the current step
+PKR_OUTPUT_COUNTERS = [
+    (re.compile(r'Searching for Windows updates'), 'rounds'),
+    (re.compile(r'Found Windows update'), 'updates'),
+    (re.compile(r'Restarting the machine'), 'restarts'),
+]
+
+PKR_MACHINE_READABLE_COMMA = '%!(PACKER_COMMA)'
+
+
+def parse_machine_readable_line(line: str):
+    '''Parses a line of packer -machine-readable output into (timestamp, target, type, data)
+    https://developer.hashicorp.com/packer/docs/commands#machine-readable-output'''
+    parts = line.rstrip('\r\n').split(',')
+    if len(parts) < 3 or not parts[0].isdigit():
+        return None
+    data = [p.replace(PKR_MACHINE_READABLE_COMMA, ',').replace('\\n', '\n').replace('\\r', '\r')
+            for p in parts[3:]]
+    return int(parts[0]), parts[1], parts[2], data
+
+
+# seconds between checks of the build's time budgets
+PKR_BUDGET_CHECK_INTERVAL = 15
+# seconds to wait for packer to clean up (delete the build vm and resource group) after an interrupt
+PKR_INTERRUPT_TIMEOUT = 20 * 60
+
+
+def get_budget_section(kind: str, name: str, current: str = None):
+    '''Gets the image.yaml install section (update, choco, or scripts) a packer build step belongs to'''
+    if kind == 'update':
+        return 'update'
+    if kind == 'restart':
+        return current
+    if kind != 'provisioner':
+        return None
+    if CHOCO_PACKAGES_CONFIG_FILE in name or CHOCO_PACKAGES_USER_CONFIG_FILE in name or 'chocolatey' in name:
+        return 'choco'
+    # inline powershell is written to a temp file (i.e. /tmp/powershell-provisioner123)
+    if name.startswith('powershell script:') and 'powershell-provisioner' not in name:
+        return 'scripts'
+    if name.startswith(('Running script:', 'Running script group:')):
+        return 'scripts'
+    # the choco provisioners run inline powershell after uploading the packages config
+    return current if current == 'choco' else None
+
+
+class BuildWatchdog(threading.Thread):
+    '''Watches the progress of a packer build and interrupts packer (so it cleans up the build vm)
+    as soon as the build or one of its install sections exceeds its time budget'''
+
+    def __init__(self, proc: subprocess.Popen, budgets: ImageBudgets, status: BuildStatus = None):
+        super().__init__(name='bake-watchdog', daemon=True)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.proc = proc
+        self.budgets = budgets
+        self.status = status
+        self.started = time.time()
+        self.step = None
+        self.section = None
+        self.section_started = None
+        self.elapsed = {}
+        self.overrun = None
+
+    def start_step(self, kind: str, name: str):
+        '''Called by the output parser when a new build step starts'''
+        with self._lock:
+            now = time.time()
+            self.step = name
+            section = get_budget_section(kind, name, self.section)
+            if section == self.section:
+                return
+            if self.section:
+                self.elapsed[self.section] = self.elapsed.get(self.section, 0) + now - self.section_started
+            self.section = section
+            self.section_started = now
+
+    def check(self, now: float = None):
+        '''Gets the budget (if any) that has been exceeded'''
+        now = now or time.time()
+        with self._lock:
+            if self.budgets.build and now - self.started > self.budgets.build * 60:
+                return 'build', self.budgets.build, self.step
+            if self.section:
+                budget = getattr(self.budgets, self.section)
+                elapsed = self.elapsed.get(self.section, 0) + now - self.section_started
+                if budget and elapsed > budget * 60:
+                    return self.section, budget, self.step
+        return None
+
+    def run(self):
+        while not self._stopped.wait(PKR_BUDGET_CHECK_INTERVAL):
+            overrun = self.check()
+            if overrun:
+                self.overrun = overrun
+                self._interrupt(*overrun)
+                return
+
+    def stop(self):
+        self._stopped.set()
+
+    def _interrupt(self, budget, minutes, step):
+        logger.error(f'Packer build exceeded the {budget} time budget of {minutes} minutes during step: {step}')
+        if self.status:
+            self.status.set_overrun(budget, minutes, step)
+
+        # packer cancels the build and deletes the build vm and resource group when interrupted
+        logger.warning('Interrupting packer so it can clean up the build resources')
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(timeout=PKR_INTERRUPT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f'Packer did not exit {PKR_INTERRUPT_TIMEOUT // 60} minutes after interrupt. Terminating')
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+class PackerOutputParser:
+    '''Parses streaming packer -machine-readable output, updating the build status and timeline.
+    Only the output of the image's source is tracked as build steps, the sources in ignore_sources (i.e. the variants
+    packer builds in parallel) are only logged'''
+
+    def __init__(self, status: BuildStatus = None, watchdog: BuildWatchdog = None,
+                 ignore_sources: Sequence[str] = None):
+        self.status = status
+        self.timeline = status.timeline if status else None
+        self.watchdog = watchdog
+        self.ignore_sources = ignore_sources or []
+        # the inline powershell provisioner that is running, its first marker names its step instead of a new one
+        self._inline = False
+
+    def parse(self, line: str):
+        '''Parses a line of packer output and returns the human readable text (if any) to write to stdout'''
+        parsed = parse_machine_readable_line(line)
+
+        if parsed is None:  # plugins may write plain text to stderr
+            text = line.rstrip('\r\n')
+            self._track(time.time(), text)
+            return text
+
+        timestamp, target, msg_type, data = parsed
+
+        if msg_type == 'ui' and len(data) >= 2:
+            text = data[1].rstrip('\r\n')
+            if data[0] == 'error' and self.status:
+                self.status.increment('errors')
+            self._track(timestamp, text, target)
+            return text
+
+        if msg_type == 'artifact' and len(data) >= 3 and data[1] == 'id':
+            logger.info(f'Packer artifact: {data[2]}')
+            if self.timeline:
+                self.timeline.add_artifact(data[2])
+
+        return None
+
+    def finish(self, succeeded: bool):
+        if self.timeline:
+            self.timeline.finish(time.time(), succeeded)
+
+    def _set_provisioner(self, name: str):
+        '''Advances the build status to the provisioner step, counting the same steps as count_packer_provisioners'''
+        # the powershell provisioner says it's starting, then names each script it runs
+        # file transfers are part of the provisioner that uses the files
+        if name == 'Powershell' or name.startswith('file: '):
+            return
+        if name.startswith('powershell script:'):
+            # inline powershell is written to a temp file (i.e. /tmp/powershell-provisioner123)
+            self._inline = 'powershell-provisioner' in name
+            self.status.set_provisioner(name)
+        elif name.startswith(PKR_STEP_MARKER_NAMES):
+            self.status.set_provisioner(name, advance=not self._inline)
+            self._inline = False
+        else:
+            self._inline = False
+            self.status.set_provisioner(name)
+
+    def _track(self, timestamp, text, target: str = None):
+        if self.status:
+            self.status.add_log(text, packer=True)
+
+        if target in self.ignore_sources:
+            return
+
+        for pattern, kind, name in PKR_OUTPUT_STEPS:
+            match = pattern.match(text)
+            if match:
+                name = name.format(**match.groupdict())
+                if self.timeline:
+                    self.timeline.start_step(kind, name, timestamp)
+                if self.status and kind in ['provisioner', 'restart', 'update']:
+                    self._set_provisioner(name)
+                if self.watchdog:
+                    self.watchdog.start_step(kind, name)
+                return
+
+        match = PKR_OUTPUT_PACKAGES.match(text)
+        if match:
+            if self.timeline:
+                self.timeline.add_package(match.group('name'), match.group('outcome'))
+            if self.status and match.group('outcome') == 'failed':
+                self.status.increment('packages_failed')
+            return
+
+        if self.timeline:
+            for pattern, counter in PKR_OUTPUT_COUNTERS:
+                if pattern.search(text):
+                    self.timeline.increment(counter)
+                    return
+
+
+def count_packer_provisioners(image_dir: Path):
+    '''Counts the provisioner steps of the image's source in the packer build file, the same steps
+    PackerOutputParser tracks: each script in a scripts list (or marker written by an inline provisioner) is a step,
+    file transfers aren't'''
+    build_file_path = image_dir / PKR_BUILD_FILE
+    if not build_file_path.is_file():
+        return None
+
+    with open(build_file_path, 'r', encoding='utf-8') as f:
+        pkr_build = f.read()
+
+    # ignore commented out lines
+    lines = [line for line in pkr_build.splitlines() if not line.strip().startswith(('#', '//'))]
+    pkr_build = '\n'.join(lines)
+
+    total = 0
+    for match in re.finditer(r'provisioner\s+"(?P<type>[^"]+)"\s*{', pkr_build):
+        block = pkr_build[match.end():]
+        end = block.find('\n  }')
+        block = block[:end] if end >= 0 else block
+        only = re.search(r'only\s*=\s*\[(?P<sources>[^\]]*)\]', block)
+        if match.group('type') == 'file' or (only and f'"{PKR_BUILD_SOURCE}"' not in only.group('sources')):
+            continue
+        scripts = re.search(r'scripts\s*=\s*\[(?P<scripts>[^\]]*)\]', block)
+        markers = len(PKR_STEP_MARKER.findall(block))
+        total += max(1, len(re.findall(r'"[^"]+"', scripts.group('scripts')))) if scripts else max(1, markers)
+
+    return total
+
+
+def get_build_budgets(image: Image) -> ImageBudgets:
+    '''Gets the time budgets of a build, including the update budget set in the image.yaml update section'''
+    if image.update and image.update.budget:
+        return ImageBudgets({**(get_dict(image.budgets) if image.budgets else {}), 'update': image.update.budget})
+    return image.budgets
+
+
+def packer_build(image: Image, status: BuildStatus = None):
     '''Executes the packer build command on an image'''
     logger.info(f'Executing packer build for {image.name}')
-    args = _parse_command(['build', '-force', image.dir])
+    args = _parse_command(['build', '-force', '-machine-readable', image.dir])
     if in_builder:
         args.insert(2, '-color=false')
     logger.info(f'Running packer command: {" ".join(args)}')
-    proc = subprocess.run(args, stdout=sys.stdout, stderr=sys.stderr, check=True, text=True)
+
+    if status:
+        status.set_provisioner_total(count_packer_provisioners(image.dir))
+
+    # stream the machine readable output so it can be tracked while still writing readable output to stdout
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
+        budgets = get_build_budgets(image)
+        watchdog = BuildWatchdog(proc, budgets, status) if budgets else None
+        if watchdog:
+            watchdog.start()
+
+        # the variants are built in parallel from copies of the image's source
+        source_type = PKR_BUILD_SOURCE.split('.')[0]
+        parser = PackerOutputParser(status, watchdog, [f'{source_type}.{v.name}' for v in image.variants or []])
+
+        for line in proc.stdout:
+            text = parser.parse(line)
+            if text is not None:
+                sys.stdout.write(text + '\n')
+                sys.stdout.flush()
+
+    if watchdog:
+        watchdog.stop()
+
+    parser.finish(proc.returncode == 0)
+
+    if watchdog and watchdog.overrun:
+        budget, minutes, step = watchdog.overrun
+        raise CLIError(f'Packer build stopped because it exceeded the {budget} time budget of {minutes} minutes '
+                       f'during step: {step}')
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+
     logger.info(f'Done executing packer build for {image.name}')
     return proc.returncode
 
 
-def packer_execute(image: Image):
+def packer_execute(image: Image, status: BuildStatus = None):
     '''Executes the packer init and build commands on an image'''
+    if status:
+        status.start_phase('packer-init')
     i = packer_init(image)
-    return packer_build(image) if i == 0 else i
+    if i != 0:
+        return i
+    if status:
+        status.start_phase('packer-build')
+    return packer_build(image, status)
 
 
 def copy_packer_files(image_dir: Path):
@@ -168,138 +570,282 @@ def copy_packer_files(image_dir: Path):
     return True
 
 
-def inject_update_provisioner(image_dir: Path):
-    '''Injects the update provisioner into the packer build file'''
-    _inject_provisioner(image_dir, PKR_PROVISIONER_UPDATE)
-
-
-def inject_restart_provisioner(image_dir: Path):
-    '''Injects the restart provisioner into the packer build file'''
-    _inject_provisioner(image_dir, PKR_PROVISIONER_RESTART)
-
-
-def inject_powershell_provisioner(image_dir: Path, powershell_scripts: Sequence[PowershellScript]):
-    '''Injects the powershell provisioner into the packer build file'''
-
-    current_index = 0
-    inject_restart = False
-
-    powershell_provisioner = '''
-  # Injected by az bake
-  provisioner "powershell" {
-    elevated_user     = build.User
-    elevated_password = build.Password
-    scripts = [
-'''
-
-    for i, script in enumerate(powershell_scripts):
-        current_index = i
-        script_path = script.path
-        powershell_provisioner += f'      "{script_path}"'
-
-        if script.restart is True:
-            inject_restart = True
-            break
-
-        if i < len(powershell_scripts) - 1:
-            powershell_provisioner += ',\n'
-
-    powershell_provisioner += f'''
+def bundle_install_files(image_dir: Path, powershell_scripts: Sequence[PowershellScript] = None,
+                         files: Mapping[str, Any] = None) -> Sequence[PowershellScript]:
+    '''Packs the powershell scripts and files (name: content or path) into one archive that the bundle provisioners
+    upload to the build vm once and extract to the bundle directory. Returns the scripts with their paths on the
+    build vm'''
+    logger.info(f'Creating file: {image_dir / INSTALL_BUNDLE_FILE}')
+    bundled = []
+    with zipfile.ZipFile(image_dir / INSTALL_BUNDLE_FILE, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        for i, script in enumerate(powershell_scripts or []):
+            # scripts can be outside the image directory, so prefix the names to keep them unique
+            source = Path(script.path.replace('${path.root}', str(image_dir)))
+            name = f'scripts/{i:03d}-{source.name}'
+            bundle.write(source, name)
+            bundled.append(PowershellScript({**get_dict(script), 'path': f'{INSTALL_BUNDLE_DIR}/{name}'}))
+        if any(script.group for script in bundled):
+            bundle.write(get_templates_path('install') / INSTALL_SCRIPT_GROUP_FILE, INSTALL_SCRIPT_GROUP_FILE)
+        for name, content in (files or {}).items():
+            if isinstance(content, Path):
+                # packages (i.e. nupkg) are already compressed
+                bundle.write(content, name, compress_type=zipfile.ZIP_STORED)
+            elif content:
+                bundle.writestr(name, content)
+
+    return bundled
+
+
+def _elevated(inline: Sequence[str], only: Sequence[str] = None) -> Provisioner:
+    '''Gets a powershell provisioner that runs the commands as the build user'''
+    return Provisioner('powershell', {'elevated_user': Raw('build.User'), 'elevated_password': Raw('build.Password'),
+                                      'inline': list(inline), 'only': only})
+
+
+def get_bundle_provisioners() -> List[Provisioner]:
+    '''Gets the provisioners that upload the install bundle to the build vm and extract it'''
+    return [
+        Provisioner('file', {
+            'source': Raw(f'"${{path.root}}/{INSTALL_BUNDLE_FILE}"'),
+            'destination': f'C:/Windows/Temp/{INSTALL_BUNDLE_FILE}'
+        }),
+        Provisioner('powershell', {'inline': [
+            f'Expand-Archive -Path C:/Windows/Temp/{INSTALL_BUNDLE_FILE} -DestinationPath {INSTALL_BUNDLE_DIR} -Force'
+        ]})
     ]
-  }}
-  {BAKE_PLACEHOLDER}'''
-
-    _inject_provisioner(image_dir, powershell_provisioner)
-
-    if inject_restart:
-        inject_restart_provisioner(image_dir)
-
-        if current_index < len(powershell_scripts) - 1:
-            inject_powershell_provisioner(image_dir, powershell_scripts[current_index + 1:])
-
-
-def inject_choco_provisioners(image_dir: Path, config_xml, for_user=False):
-    '''Injects the chocolatey provisioners into the packer build file'''
-    # create the choco packages config file
-    file_name = CHOCO_PACKAGES_USER_CONFIG_FILE if for_user else CHOCO_PACKAGES_CONFIG_FILE
-
-    logger.info(f'Creating file: {image_dir / file_name}')
-    with open(image_dir / file_name, 'w', encoding='utf-8') as f:
-        f.write(config_xml)
 
-    _inject_provisioner(image_dir, PKR_PROVISIONER_CHOCO_USER if for_user else PKR_PROVISIONER_CHOCO)
 
-
-def inject_winget_provisioners(image_dir: Path, winget_packages: Sequence[WingetPackage]):
-    '''Injects the winget provisioners into the packer build file'''
-
-    logger.info(f'Creating file: {image_dir / WINGET_SETTINGS_FILE}')
-    with open(image_dir / WINGET_SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        f.write(WINGET_SETTINGS_JSON)
-
-    winget_install = f'''
-{PKR_PROVISIONER_WINGET_INSTALL}
-
-  # Injected by az bake
-  provisioner "powershell" {{
-    elevated_user     = build.User
-    elevated_password = build.Password
-    inline = [
-'''
-
-    for i, p in enumerate(winget_packages):
-        winget_cmd = 'winget install '
-
-        if p.any:  # user just specified a string, it could be a the moniker, name or id
-            winget_cmd += f'{p.any} '
-        elif p.id:
-            winget_cmd += f'--id {p.id} '
-        elif p.name:
-            winget_cmd += f'--name {p.name} '
-        elif p.moniker:
-            winget_cmd += f'--moniker {p.moniker} '
+def get_update_provisioners(update: ImageUpdate = None) -> List[Provisioner]:
+    '''Gets the windows-update provisioner. The update filters and limit are passed to the provisioner (the plugin's
+    defaults are used when they aren't set)'''
+    return [Provisioner('windows-update', {
+        'filters': update.filters if update else None,
+        'update_limit': update.max_updates if update else None
+    }, comments=['https://github.com/rgl/packer-plugin-windows-update'])]
+
+
+def get_restart_provisioner(only: Sequence[str] = None) -> Provisioner:
+    return Provisioner('windows-restart', {
+        'restart_timeout': '30m',
+        'pause_before': f'{PKR_RESTART_PAUSE_MINUTES}m',
+        'only': only
+    })
+
+
+def get_powershell_provisioners(powershell_scripts: Sequence[PowershellScript],
+                                only: Sequence[str] = None) -> List[Provisioner]:
+    '''Gets the powershell provisioners that run the scripts, with a restart after each script that needs one.
+    The scripts must have been bundled, they run from the bundle directory on the build vm.
+    Scripts in a group run in parallel as background jobs on the build vm.
+    If only is set, the provisioners only run in those packer sources (i.e. azure-arm.vm)'''
+    provisioners = []
+    inline = []
+
+    for group in group_powershell_scripts(powershell_scripts):
+        script_paths = [_escape_powershell(script.path) for script in group]
+        if group[0].group is None:
+            script_name = script_paths[0][len(INSTALL_BUNDLE_DIR) + 1:]
+            inline.append(f"Write-Host '>>> Running script: {script_name}'")
+            inline.append(f"& '{script_paths[0]}'; if ($LASTEXITCODE) {{ exit $LASTEXITCODE }}")
         else:
-            raise Exception('Invalid winget package configuration')
-
-        if p.source:  # even if the user only specified a string, source could be in defaults
-            winget_cmd += f'--source {p.source} '
-
-        winget_cmd += '--accept-package-agreements --accept-source-agreements'
-
-        winget_install += f'      "Write-Host \'>>> Running command: {winget_cmd}\'",\n'
-        winget_install += f'      "{winget_cmd}"'
-
-        if i < len(winget_packages) - 1:
-            winget_install += ',\n'
-
-    winget_install += f'''
-    ]
-  }}
-  {BAKE_PLACEHOLDER}'''
-
-    _inject_provisioner(image_dir, winget_install)
-
-
-def _inject_provisioner(image_dir: Path, provisioner: str):
-    '''Injects the provisioner into the packer build file'''
-
-    build_file_path = image_dir / PKR_BUILD_FILE
-
-    if not build_file_path.exists():
-        raise ValidationError(f'Could not find {PKR_BUILD_FILE} file at {build_file_path}')
-    if not build_file_path.is_file():
-        raise ValidationError(f'{build_file_path} is not a file')
-
-    # inject provisioner into build.pkr.hcl
-    logger.info(f'Injecting provisioner into {build_file_path}')
-
-    with open(build_file_path, 'r', encoding='utf-8') as f:
-        pkr_build = f.read()
-
-    if BAKE_PLACEHOLDER not in pkr_build:
-        raise ValidationError(f'Could not find {BAKE_PLACEHOLDER} in {PKR_BUILD_FILE} at {build_file_path}')
-
-    pkr_build = pkr_build.replace(BAKE_PLACEHOLDER, provisioner)
-
-    with open(build_file_path, 'w', encoding='utf-8') as f:
-        f.write(pkr_build)
+            scripts_arg = ','.join(f"'{path}'" for path in script_paths)
+            inline.append(f"Write-Host '>>> Running script group: {_escape_powershell(group[0].group)} "
+                          f"({len(group)} scripts)'")
+            inline.append(f"& '{INSTALL_BUNDLE_DIR}/{INSTALL_SCRIPT_GROUP_FILE}' -Scripts {scripts_arg}; "
+                          'if ($LASTEXITCODE) { exit $LASTEXITCODE }')
+
+        if any(script.restart is True for script in group):
+            provisioners.extend([_elevated(inline, only=only), get_restart_provisioner(only)])
+            inline = []
+
+    if inline:
+        provisioners.append(_elevated(inline, only=only))
+
+    return provisioners
+
+
+def get_choco_provisioners(for_user=False, output_dir: Path = OUTPUT_DIR,
+                           sources: Sequence[str] = None) -> List[Provisioner]:
+    '''Gets the chocolatey provisioners that install the bundled packages config. Packages for users are installed
+    by each user when they first log in. If the build has more than one packer source, the chocolatey log of each is
+    downloaded to its own file'''
+    if for_user:
+        components = 'HKLM:\\SOFTWARE\\Microsoft\\Active Setup\\Installed Components'
+        component = '7cc2318a-b226-4fdd-84c6-31e5f4dd9e4f'
+        return [_elevated([
+            f"Write-Host '>>> Registering choco packages for users: {CHOCO_PACKAGES_USER_CONFIG_FILE}'",
+            f"New-Item -Path '{components}' -Name '{component}' -Value 'Install Chocolatey Packages'",
+            f"New-ItemProperty '{components}\\{component}' -Name StubPath -Value "
+            f"'choco install {INSTALL_BUNDLE_DIR}/{CHOCO_PACKAGES_USER_CONFIG_FILE} --yes --no-progress'"
+        ])]
+
+    # the chocolatey log is downloaded to the output directory for this run
+    if sources and len(sources) > 1:
+        logs = [(f'{output_dir}/{source.split(".")[-1]}.chocolatey.log', [source]) for source in sources]
+    else:
+        logs = [(f'{output_dir}/chocolatey.log', None)]
+
+    return [
+        Provisioner('powershell', {
+            'environment_vars': ['chocolateyUseWindowsCompression=false'],
+            'inline': [
+                "(new-object net.webclient).DownloadFile('https://chocolatey.org/install.ps1', "
+                "'C:/Windows/Temp/chocolatey.ps1')",
+                '& C:/Windows/Temp/chocolatey.ps1'
+            ]
+        }),
+        _elevated([
+            f"Write-Host '>>> Installing choco packages: {CHOCO_PACKAGES_CONFIG_FILE}'",
+            f'choco install {INSTALL_BUNDLE_DIR}/{CHOCO_PACKAGES_CONFIG_FILE} --yes --no-progress'
+        ])
+    ] + [Provisioner('file', {
+        'source': 'C:/ProgramData/chocolatey/logs/chocolatey.log',
+        'destination': destination,
+        'direction': 'download',
+        'only': only
+    }) for destination, only in logs]
+
+
+def _winget_install_command(package: WingetPackage) -> str:
+    '''Gets the winget install command for a package'''
+    if package.any:  # user just specified a string, it could be a the moniker, name or id
+        winget_cmd = f"winget install '{_escape_powershell(package.any)}' "
+    elif package.id:
+        winget_cmd = f"winget install --id '{_escape_powershell(package.id)}' --exact "
+    elif package.name:
+        winget_cmd = f"winget install --name '{_escape_powershell(package.name)}' --exact "
+    elif package.moniker:
+        winget_cmd = f"winget install --moniker '{_escape_powershell(package.moniker)}' "
+    else:
+        raise ValidationError('Invalid winget package configuration')
+
+    if package.version:
+        winget_cmd += f"--version '{_escape_powershell(package.version)}' "
+
+    if package.source:  # even if the user only specified a string, source could be in defaults
+        winget_cmd += f"--source '{_escape_powershell(package.source)}' "
+
+    return winget_cmd + '--accept-package-agreements --accept-source-agreements'
+
+
+def _winget_outcome(name: str) -> str:
+    '''Gets the powershell that writes the outcome of the last winget command for a package (see PKR_OUTPUT_PACKAGES).
+    The name is a powershell expression (i.e. a quoted string or variable)'''
+    return f"if ($LASTEXITCODE -eq 0) {{ Write-Host ('--- winget package ' + {name} + ': installed') }} " \
+           f"else {{ $failed++; Write-Host ('--- winget package ' + {name} + ': failed') }}"
+
+
+def get_winget_provisioners(imported: Sequence[WingetPackage] = None,
+                            installed: Sequence[WingetPackage] = None) -> List[Provisioner]:
+    '''Gets the winget provisioners. Winget is installed and configured first, then the imported packages are
+    installed with one winget import of the bundled import file and the others with winget install. The outcome of
+    each package is written to the output and the provisioner fails if any package failed.
+    The winget settings file must be saved to the image directory (see WINGET_SETTINGS_FILE)'''
+    imported = imported or []
+    installed = installed or []
+
+    winget_install = _elevated([
+        f"Write-Host '>>> Downloading package: {WINGET_INSTALLER_SRC} to {WINGET_INSTALLER_DEST}'",
+        f"(new-object net.webclient).DownloadFile('{WINGET_INSTALLER_SRC}', '{WINGET_INSTALLER_DEST}')",
+        f"Write-Host '>>> Installing package: {WINGET_INSTALLER_DEST}'",
+        'Add-AppxPackage -InstallAllResources -ForceTargetApplicationShutdown -ForceUpdateFromAnyVersion '
+        f"-Path '{WINGET_INSTALLER_DEST}'",
+        f"Write-Host '>>> Downloading package: {WINGET_SOURCE_SRC} to {WINGET_SOURCE_DEST}'",
+        f"(new-object net.webclient).DownloadFile('{WINGET_SOURCE_SRC}', '{WINGET_SOURCE_DEST}')",
+        f"Write-Host '>>> Installing package: {WINGET_SOURCE_DEST}'",
+        f"Add-AppxPackage -ForceTargetApplicationShutdown -ForceUpdateFromAnyVersion -Path '{WINGET_SOURCE_DEST}'",
+        'winget --info',
+        "Write-Host '>>> Resetting winget source'",
+        'winget source reset --force',
+        'winget source list'
+    ])
+
+    winget_settings = Provisioner('file', {
+        'source': Raw(f'"${{path.root}}/{WINGET_SETTINGS_FILE}"'),
+        'destination': WINGET_SETTINGS_PATH
+    })
+
+    commands = [f"Write-Host '>>> Installing winget packages: {len(imported) + len(installed)} packages'",
+                '$failed = 0']
+
+    if imported:
+        ids = ','.join(f"'{_escape_powershell(p.id or p.any)}'" for p in imported)
+        commands.append(f"winget import --import-file '{INSTALL_BUNDLE_DIR}/{WINGET_IMPORT_FILE}' --no-upgrade "
+                        '--accept-package-agreements --accept-source-agreements')
+        # winget import only reports the packages that failed to install, so check each package is installed
+        commands.append('foreach ($id in @(' + ids + ')) { winget list --id $id --exact --accept-source-agreements '
+                        f'| Out-Null; {_winget_outcome("$id")} }}')
+
+    for package in installed:
+        name = "'" + _escape_powershell(package.id or package.name or package.moniker or package.any) + "'"
+        commands.append(f'{_winget_install_command(package)}; {_winget_outcome(name)}')
+
+    commands.append('if ($failed) { exit 1 }')
+
+    return [winget_install, winget_settings, _elevated(commands)]
+
+
+def _escape_powershell(value: str) -> str:
+    '''Escapes a value for a single quoted powershell string'''
+    return value.replace("'", "''")
+
+
+def get_variant_source(variant: ImageVariant) -> Mapping[str, Any]:
+    '''Gets the values that replace the image's variables in the copy of the packer source for a variant'''
+    return {
+        'var.image.name': variant.definition,
+        'var.image.base.publisher': variant.base.publisher,
+        'var.image.base.offer': variant.base.offer,
+        'var.image.base.sku': variant.base.sku,
+        'var.image.base.version': variant.base.version
+    }
+
+
+def get_build_file(template: str, powershell_scripts: Sequence[PowershellScript] = None,
+                   choco_configs: Mapping[str, str] = None, winget_imported: Sequence[WingetPackage] = None,
+                   winget_installed: Sequence[WingetPackage] = None, update: ImageUpdate = None,
+                   bundled: bool = False, output_dir: Path = OUTPUT_DIR, variants: Sequence[ImageVariant] = None,
+                   variant_scripts: Mapping[str, Sequence[PowershellScript]] = None) -> PackerBuildFile:
+    '''Gets the packer build file for the image.yaml install section from the build file template. The install steps
+    run in order: windows updates (if update is set), scripts, variant scripts, choco packages for users, choco
+    packages, and winget packages. The bundled scripts and configs are uploaded to the build vm first.
+    Each variant is built from a copy of the template's source, packer builds them in parallel'''
+    build = PackerBuildFile(template)
+    choco_configs = choco_configs or {}
+    variant_scripts = variant_scripts or {}
+
+    # variants are copies of the template's source (i.e. azure-arm.vm) named after the variant (i.e. azure-arm.pro)
+    source_type = PKR_BUILD_SOURCE.split('.')[0]
+    sources = [PKR_BUILD_SOURCE]
+    for variant in variants or []:
+        build.add_source(PKR_BUILD_SOURCE, variant.name, get_variant_source(variant))
+        sources.append(f'{source_type}.{variant.name}')
+
+    if bundled:
+        build.add(*get_bundle_provisioners())
+
+    if update:
+        build.add(*get_update_provisioners(update))
+
+    if powershell_scripts:
+        build.add(*get_powershell_provisioners(powershell_scripts))
+
+    for variant in variants or []:
+        if variant_scripts.get(variant.name):
+            only = [f'{source_type}.{variant.name}']
+            build.add(*get_powershell_provisioners(variant_scripts[variant.name], only=only))
+
+    # the configs are also saved to the image directory, they're uploaded to the build vm in the bundle
+    if choco_configs.get('user'):
+        build.files[CHOCO_PACKAGES_USER_CONFIG_FILE] = choco_configs['user']
+        build.add(*get_choco_provisioners(for_user=True, output_dir=output_dir))
+
+    if choco_configs.get('machine'):
+        build.files[CHOCO_PACKAGES_CONFIG_FILE] = choco_configs['machine']
+        build.add(*get_choco_provisioners(for_user=False, output_dir=output_dir, sources=sources))
+
+    if winget_imported or winget_installed:
+        build.files[WINGET_SETTINGS_FILE] = WINGET_SETTINGS_JSON
+        build.add(*get_winget_provisioners(winget_imported, winget_installed))
+
+    return build
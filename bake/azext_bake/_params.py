@@ -103,6 +103,36 @@ def load_arguments(self, _):
             c.ignore('sandbox')
             c.ignore('gallery')
 
+    with self.argument_context('bake sandbox gc') as c:  # uses command level validator, param validators are ignored
+        c.argument('sandbox_resource_group_name', sandbox_resource_group_name_type)
+        c.argument('repository_path', options_list=['--repo-path', '--repo', '-r'], type=file_type, default='./',
+                   help='Path to the locally cloned repository. The builder.retention policy in its bake.yml is used for '
+                   'the retention options that are not set.')
+        c.argument('image_names', options_list=['--images', '-i'], nargs='*',
+                   help='Space separated list of images to clean up. Default: all images in the sandbox.')
+        c.argument('keep_runs', type=int, options_list=['--keep-runs'], arg_group='Retention',
+                   help='Number of most recent builder runs to keep uncompressed.')
+        c.argument('max_age_days', type=int, options_list=['--max-age-days'], arg_group='Retention',
+                   help='Delete builder runs older than this number of days.')
+        c.argument('max_size_mb', type=int, options_list=['--max-size-mb'], arg_group='Retention',
+                   help='Delete the oldest builder runs until the output for each image is under this size (in MB).')
+        c.argument('dry_run', options_list=['--dry-run'], action='store_true',
+                   help='Show the builder runs that would be compressed or deleted without changing anything.')
+        c.ignore('sandbox')
+        c.ignore('builder')
+
+    with self.argument_context('bake sandbox cache choco') as c:  # uses command level validator, param validators are ignored
+        c.argument('sandbox_resource_group_name', sandbox_resource_group_name_type)
+        c.argument('repository_path', options_list=['--repo-path', '--repo', '-r'], type=file_type, default='./',
+                   help='Path to the locally cloned repository.')
+        c.argument('image_names', options_list=['--images', '-i'], nargs='*',
+                   help='Space separated list of images with packages to cache. Default: all images in the repository.')
+        c.argument('local', options_list=['--local'], action='store_true',
+                   help='Cache the packages in .local/choco in the repository (used by az bake image build --local) '
+                   'instead of the sandbox storage account.')
+        c.ignore('sandbox')
+        c.ignore('images')
+
     for scope in ['bake repo validate', 'bake validate repo']:
         with self.argument_context(scope) as c:
             c.argument('repository_path', options_list=['--repo-path', '--repo'], type=file_type, default='./',
@@ -124,6 +154,7 @@ def load_arguments(self, _):
         c.ignore('sandbox')
         c.ignore('gallery')
         c.ignore('images')
+        c.ignore('builder')
         c.ignore('repo')
 
     with self.argument_context('bake repo setup') as c:
@@ -163,6 +194,22 @@ def load_arguments(self, _):
         c.argument('minor', options_list=['--minor'], action='store_true', help='Bump minor version.')
         c.ignore('images')
 
+    with self.argument_context('bake image build') as c:  # uses command level validator, param validators are ignored
+        c.argument('repository_path', options_list=['--repo-path', '--repo', '-r'], type=file_type, default='./',
+                   help='Path to the locally cloned repository.')
+        c.argument('image_name', options_list=['--name', '-n'], help='Name of the image to build.')
+        c.argument('local', options_list=['--local'], action='store_true',
+                   help='Run the builder in-process against the local repository instead of deploying a builder '
+                   'container. Output is saved to .local/storage in the repository.')
+        c.argument('repository_url', options_list=['--repo-url'], arg_group='Repo', help='Repository url.')
+        c.argument('repository_token', options_list=['--repo-token'], arg_group='Repo', help='Repository token.')
+        c.argument('repository_revision', options_list=['--repo-revision'], arg_group='Repo', help='Repository revision.')
+        c.ignore('sandbox')
+        c.ignore('gallery')
+        c.ignore('images')
+        c.ignore('builder')
+        c.ignore('repo')
+
     with self.argument_context('bake image rebuild') as c:
         c.argument('resource_group_name', sandbox_resource_group_name_type)
         c.argument('container_group_name', options_list=['--name', '-n'], help='Name of the image to rebuild.')
@@ -173,6 +220,40 @@ def load_arguments(self, _):
         c.argument('sandbox_resource_group_name', sandbox_resource_group_name_type)
         c.ignore('sandbox')
 
+    with self.argument_context('bake image status') as c:
+        c.argument('image_name', options_list=['--name', '-n'], help='Name of the image.')
+        c.argument('sandbox_resource_group_name', sandbox_resource_group_name_type)
+        c.argument('run', options_list=['--run'],
+                   help='Name (timestamp) of the builder run output directory. Default: the most recent run.')
+        c.ignore('sandbox')
+
+    with self.argument_context('bake image artifacts') as c:
+        c.argument('image_name', options_list=['--name', '-n'], help='Name of the image.')
+        c.argument('sandbox_resource_group_name', sandbox_resource_group_name_type)
+        c.argument('run', options_list=['--run'],
+                   help='Name (timestamp) of the builder run output directory. Default: the most recent run.')
+        c.argument('files', options_list=['--file', '-f'], nargs='+',
+                   help='Space separated list of files to extract. Default: list the files without extracting.')
+        c.argument('outdir', options_list=['--outdir'], completer=DirectoriesCompleter(),
+                   help='Directory to save the extracted files. Default: the current directory.')
+        c.ignore('sandbox')
+
+    with self.argument_context('bake image replicate') as c:  # uses command level validator, param validators are ignored
+        c.argument('image_name', options_list=['--name', '-n'], help='Name of the image.')
+        c.argument('gallery_resource_id', gallery_resource_id_type,
+                   help='Name or ID of a Azure Compute Gallery. Default: the gallery in bake.yml.')
+        c.argument('version', options_list=['--version', '-v'],
+                   help='Version of the image to replicate. Default: the latest version.')
+        c.argument('regions', options_list=['--regions'], nargs='+',
+                   help='Space separated list of regions to replicate the image version to. '
+                   'Default: the replicaLocations in image.yml.')
+        c.argument('repository_path', options_list=['--repo-path', '--repo'], type=file_type, default='./',
+                   help='Path to the locally cloned repository.')
+        c.argument('no_wait', options_list=['--no-wait'], action='store_true',
+                   help='Start replicating without waiting for it to finish.')
+        c.ignore('gallery')
+        c.ignore('images')
+
     with self.argument_context('bake yaml export') as c:
         c.argument('sandbox_resource_group_name', sandbox_resource_group_name_type)
         c.argument('gallery_resource_id', gallery_resource_id_type)
@@ -187,4 +268,5 @@ def load_arguments(self, _):
         c.ignore('sandbox')
         c.ignore('gallery')
         c.ignore('image')
+        c.ignore('builder')
         c.ignore('suffix')
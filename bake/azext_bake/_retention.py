@@ -0,0 +1,174 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List
+
+from ._data import BuilderRetention
+from ._storage import (BUILDER_RUN_PATTERN, delete_share_directory, delete_share_file, list_share_files,
+                       list_share_root, read_share_file, upload_share_file)
+from ._utils import get_logger, zip_directory
+
+logger = get_logger(__name__)
+
+# builder runs older than the retention policy's keepRuns are compressed into a single archive (i.e. 20221027153001.zip)
+RUN_ARCHIVE_PATTERN = re.compile(r'^(\d{14})\.zip$')
+
+
+def _run_age_days(run: str, now: datetime) -> float:
+    started = datetime.strptime(run, '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+    return (now - started).total_seconds() / 86400
+
+
+def plan_retention(runs: List[dict], policy: BuilderRetention, now: datetime = None,
+                   compact: bool = True, limit_size: bool = True) -> List[dict]:
+    '''Gets the actions (compact or delete) needed to apply the retention policy to the runs.
+    Each run is a dict with the name, whether it is archived, and its size in bytes'''
+    now = now or datetime.now(timezone.utc)
+    max_size = policy.max_size_mb * 1024 * 1024 if policy.max_size_mb and limit_size else None
+
+    actions = []
+    kept = []
+
+    # newest first, the newest run is always kept because it may still be running
+    for index, run in enumerate(sorted(runs, key=lambda r: r['name'], reverse=True)):
+        if index > 0 and policy.max_age_days and _run_age_days(run['name'], now) > policy.max_age_days:
+            actions.append(dict(run, action='delete', reason='maxAgeDays'))
+            continue
+        if compact and policy.keep_runs is not None and index >= max(policy.keep_runs, 1) and not run['archived']:
+            actions.append(dict(run, action='compact', reason='keepRuns'))
+        kept.append(run)
+
+    if max_size:
+        total = sum(r['size'] for r in kept)
+        for run in reversed(kept[1:]):  # oldest first
+            if total <= max_size:
+                break
+            total -= run['size']
+            actions = [a for a in actions if a['name'] != run['name']]
+            actions.append(dict(run, action='delete', reason='maxSizeMb'))
+
+    return actions
+
+
+def enforce_retention(store, policy: BuilderRetention, dry_run: bool = False) -> List[dict]:
+    '''Applies the retention policy to the runs in the store, compressing runs before deleting by size'''
+    if dry_run:
+        # the size of runs after they're compressed isn't known, so the size limit uses their current size
+        return plan_retention(store.list_runs(), policy)
+
+    actions = plan_retention(store.list_runs(), policy, limit_size=False)
+
+    for action in actions:
+        if action['action'] == 'compact':
+            store.compact(action['name'])
+        else:
+            store.delete(action['name'], action['archived'])
+
+    # the size of compacted runs is only known after they've been compressed, so the size limit is checked after
+    if policy.max_size_mb:
+        deletes = plan_retention(store.list_runs(), policy, compact=False)
+        for action in deletes:
+            store.delete(action['name'], action['archived'])
+        actions = [a for a in actions if a['name'] not in [d['name'] for d in deletes]] + deletes
+
+    return actions
+
+
+class LocalRunStore:
+    '''Builder runs in a local directory (the storage share mounted in the builder)'''
+
+    def __init__(self, storage_dir: Path, exclude: str = None):
+        self.storage_dir = storage_dir
+        self.exclude = exclude
+
+    def list_runs(self) -> List[dict]:
+        runs = []
+        for path in self.storage_dir.iterdir():
+            if path.name == self.exclude:
+                continue
+            if path.is_dir() and BUILDER_RUN_PATTERN.match(path.name):
+                size = sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+                runs.append({'name': path.name, 'archived': False, 'size': size})
+            elif path.is_file() and RUN_ARCHIVE_PATTERN.match(path.name):
+                runs.append({'name': path.name[:-4], 'archived': True, 'size': path.stat().st_size})
+        return runs
+
+    def compact(self, run: str):
+        logger.info(f'Compressing builder run {run}')
+        temp = self.storage_dir / f'.{run}.zip.tmp'
+        zip_directory(self.storage_dir / run, temp)
+        # only remove the run once the archive is complete
+        os.replace(temp, self.storage_dir / f'{run}.zip')
+        shutil.rmtree(self.storage_dir / run)
+
+    def delete(self, run: str, archived: bool):
+        logger.info(f'Deleting builder run {run}')
+        if archived:
+            (self.storage_dir / f'{run}.zip').unlink(missing_ok=True)
+        else:
+            shutil.rmtree(self.storage_dir / run, ignore_errors=True)
+
+
+class ShareRunStore:
+    '''Builder runs on an image's storage file share'''
+
+    def __init__(self, share_client):
+        self.share_client = share_client
+
+    def list_runs(self) -> List[dict]:
+        runs = []
+        for item in list_share_root(self.share_client):
+            if item['is_directory'] and BUILDER_RUN_PATTERN.match(item['name']):
+                size = sum(f['size'] for f in list_share_files(self.share_client, item['name']))
+                runs.append({'name': item['name'], 'archived': False, 'size': size})
+            elif not item['is_directory'] and RUN_ARCHIVE_PATTERN.match(item['name']):
+                runs.append({'name': item['name'][:-4], 'archived': True, 'size': item['size']})
+        return runs
+
+    def compact(self, run: str):
+        logger.info(f'Compressing builder run {run} on file share {self.share_client.share_name}')
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+            with zipfile.ZipFile(spool, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for f in list_share_files(self.share_client, run):
+                    archive.writestr(f['name'][len(run) + 1:], read_share_file(self.share_client, f['name']))
+            length = spool.tell()
+            spool.seek(0)
+            upload_share_file(self.share_client, f'{run}.zip', spool, length=length)
+        # only remove the run once the archive is uploaded
+        delete_share_directory(self.share_client, run)
+
+    def delete(self, run: str, archived: bool):
+        logger.info(f'Deleting builder run {run} from file share {self.share_client.share_name}')
+        if archived:
+            delete_share_file(self.share_client, f'{run}.zip')
+        else:
+            delete_share_directory(self.share_client, run)
+
+
+def start_local_retention(storage_dir: Path, policy: BuilderRetention, exclude: str = None):
+    '''Applies the retention policy to the builder runs in the storage directory on a background thread.
+    The thread isn't a daemon so the builder waits for it to finish before exiting.'''
+
+    def _enforce():
+        try:
+            actions = enforce_retention(LocalRunStore(storage_dir, exclude), policy)
+            if actions:
+                logger.info(f'Applied builder output retention policy: {len(actions)} runs compressed or deleted')
+        except OSError as e:
+            logger.warning(f'Unable to apply builder output retention policy: {e}')
+
+    thread = threading.Thread(target=_enforce, name='bake-retention')
+    thread.start()
+    return thread
@@ -0,0 +1,106 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+from typing import List, Sequence, Tuple
+
+from azure.cli.core.azclierror import ValidationError
+
+from ._constants import PKR_RESTART_PAUSE_MINUTES
+from ._data import PowershellScript, get_dict
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def group_powershell_scripts(scripts: Sequence[PowershellScript]) -> List[List[PowershellScript]]:
+    '''Groups the scripts that run in parallel. Scripts in a group run together at the position of the
+    group's first script, scripts without a group are in a group of their own'''
+    groups: List[List[PowershellScript]] = []
+    named = {}
+    for script in scripts:
+        if script.group is None:
+            groups.append([script])
+        elif script.group in named:
+            named[script.group].append(script)
+        else:
+            named[script.group] = [script]
+            groups.append(named[script.group])
+    return groups
+
+
+def _get_restart_levels(units: Sequence[List[PowershellScript]]) -> List[int]:
+    '''Gets the number of restarts each group of scripts must wait for, the most restarts of any group in its
+    after chain (plus one when that group needs a restart)'''
+    index = {script.path: i for i, unit in enumerate(units) for script in unit}
+    levels = [None] * len(units)
+    visiting = set()
+
+    def _level(i):
+        if levels[i] is not None:
+            return levels[i]
+        if i in visiting:
+            raise ValidationError(f'install.scripts.powershell has a circular after dependency: {units[i][0].path}')
+        visiting.add(i)
+        # scripts that aren't in the list (i.e. skipped by an incremental build) are already installed
+        deps = {index[a] for script in units[i] for a in script.after or [] if a in index}
+        levels[i] = max((_level(d) + (1 if _needs_restart(units[d]) else 0) for d in deps), default=0)
+        visiting.discard(i)
+        return levels[i]
+
+    for i in range(len(units)):
+        _level(i)
+
+    return levels
+
+
+def _needs_restart(unit: Sequence[PowershellScript]) -> bool:
+    return any(script.restart for script in unit)
+
+
+def _sort_level(units: Sequence[List[PowershellScript]], level: List[int]) -> List[int]:
+    '''Orders the groups of scripts in a level so each runs after the groups it depends on, otherwise keeping the
+    order from the image.yaml'''
+    index = {script.path: i for i in level for script in units[i]}
+    pending = {i: {index[a] for script in units[i] for a in script.after or [] if a in index} for i in level}
+    ordered = []
+    while pending:
+        ready = min(i for i, deps in pending.items() if not deps)
+        ordered.append(ready)
+        del pending[ready]
+        for deps in pending.values():
+            deps.discard(ready)
+    return ordered
+
+
+def schedule_powershell_scripts(scripts: Sequence[PowershellScript]) -> Tuple[List[PowershellScript], dict]:
+    '''Reorders the scripts so those that need a restart share as few restarts as possible. Scripts only wait for
+    the scripts listed in their after property. Returns the scripts, with restart set on the last script before
+    each restart, and a report of the restarts saved'''
+    units = group_powershell_scripts(scripts)
+    levels = _get_restart_levels(units)
+
+    scheduled: List[PowershellScript] = []
+    restarts = 0
+
+    for level in sorted(set(levels)):
+        ordered = [script for i in _sort_level(units, [i for i, lvl in enumerate(levels) if lvl == level])
+                   for script in units[i]]
+        restart = any(script.restart for script in ordered)
+        for script in ordered:
+            scheduled.append(PowershellScript({**get_dict(script), 'restart': restart and script is ordered[-1]}))
+        restarts += 1 if restart else 0
+
+    before = sum(1 for unit in units if _needs_restart(unit))
+
+    report = {
+        'restartsBefore': before,
+        'restartsAfter': restarts,
+        'restartsSaved': before - restarts,
+        # the pause packer waits before each restart, the time the reboot takes isn't included
+        'minutesSaved': (before - restarts) * PKR_RESTART_PAUSE_MINUTES
+    }
+
+    return scheduled, report
@@ -0,0 +1,406 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from knack.log import get_logger as knack_get_logger
+
+from ._constants import STATUS_LOG_LINES, STATUS_SERVER_PORT
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def _utc_iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat() if epoch else None
+
+
+def _label(value):
+    '''Escapes a prometheus label value'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _save_json_atomic(path: Path, obj):
+    '''Writes the object to a temp file then replaces the file so readers never see a partially written file'''
+    temp = path.with_name(f'.{path.name}.tmp')
+    try:
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=2)
+        os.replace(temp, path)
+    except OSError as e:
+        logger.warning(f'Unable to save {path}: {e}')
+
+
+class BuildTimeline:
+    '''Thread-safe timeline of the steps in a packer build (provisioners, restarts, updates, capture, etc.)'''
+
+    def __init__(self, path: Path = None):
+        self._lock = threading.RLock()
+        self.path = path
+        self.steps = []
+        self.artifacts = []
+        self.finished = None
+        self.succeeded = None
+
+    @property
+    def current(self):
+        return self.steps[-1] if self.steps and self.steps[-1]['end'] is None else None
+
+    def start_step(self, kind: str, name: str, timestamp: float):
+        '''Ends the current step (if any) and starts a new one'''
+        with self._lock:
+            current = self.current
+            # windows-update reports starting again for each round
+            if current and current['kind'] == kind and current['name'] == name and kind == 'update':
+                return
+            if current:
+                current['end'] = timestamp
+            self.steps.append({'kind': kind, 'name': name, 'start': timestamp, 'end': None})
+            self.save()
+
+    def increment(self, counter: str, value: int = 1):
+        '''Increments a counter (i.e. windows update rounds) on the current step'''
+        with self._lock:
+            current = self.current
+            if current:
+                current[counter] = current.get(counter, 0) + value
+
+    def add_package(self, name: str, outcome: str):
+        '''Records the outcome (installed or failed) of a package installed by the current step'''
+        with self._lock:
+            current = self.current
+            if current:
+                current.setdefault('packages', {})[name] = outcome
+
+    def add_artifact(self, artifact: str):
+        with self._lock:
+            self.artifacts.append(artifact)
+
+    def finish(self, timestamp: float, succeeded: bool):
+        with self._lock:
+            current = self.current
+            if current:
+                current['end'] = timestamp
+            self.finished = timestamp
+            self.succeeded = succeeded
+            self.save()
+
+    def to_list(self):
+        with self._lock:
+            now = time.time()
+            return [dict({k: v for k, v in s.items() if k not in ['start', 'end']},
+                         started=_utc_iso(s['start']), finished=_utc_iso(s['end']),
+                         elapsed=round((s['end'] or now) - s['start'], 1)) for s in self.steps]
+
+    def summary(self):
+        '''Gets the total time spent in each kind of step along with restart and windows update counts'''
+        steps = self.to_list()
+        totals = {}
+        for step in steps:
+            totals[step['kind']] = round(totals.get(step['kind'], 0) + step['elapsed'], 1)
+        return {
+            'step': steps[-1]['name'] if steps and not steps[-1]['finished'] else None,
+            'steps': len(steps),
+            'elapsed': totals,
+            'restarts': sum(1 for s in steps if s['kind'] == 'restart') + sum(s.get('restarts', 0) for s in steps),
+            'updateRounds': sum(s.get('rounds', 0) for s in steps),
+            'updates': sum(s.get('updates', 0) for s in steps),
+            'packagesFailed': sorted(name for s in steps for name, outcome in s.get('packages', {}).items()
+                                     if outcome == 'failed')
+        }
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'succeeded': self.succeeded,
+                'finished': _utc_iso(self.finished),
+                'summary': self.summary(),
+                'artifacts': list(self.artifacts),
+                'steps': self.to_list()
+            }
+
+    def save(self):
+        if self.path:
+            _save_json_atomic(self.path, self.to_dict())
+
+
+class BuildStatus:
+    '''Thread-safe record of the progress of a build in the builder container'''
+
+    def __init__(self, image_name: str = None, image_version: str = None, log_lines: int = STATUS_LOG_LINES,
+                 manifest: Path = None, timeline: Path = None):
+        self._lock = threading.RLock()
+        self.image_name = image_name
+        self.image_version = image_version
+        self.manifest = manifest
+        self.timeline = BuildTimeline(timeline)
+        self.started = time.time()
+        self.finished = None
+        self.outcome = None
+        self.phase = None
+        self.phases = []
+        self.provisioner = None
+        self.provisioner_total = None
+        self.overrun = None
+        self.update = None
+        self.checkpoints = []
+        self.logs = deque(maxlen=log_lines)
+        self.counters = {
+            'log_lines': 0,
+            'packer_lines': 0,
+            'provisioners': 0,
+            'errors': 0,
+            'packages_failed': 0
+        }
+
+    def start_phase(self, name: str):
+        '''Ends the current phase (if any) and starts a new one'''
+        with self._lock:
+            now = time.time()
+            if self.phases and self.phases[-1]['end'] is None:
+                self.phases[-1]['end'] = now
+            self.phase = name
+            self.phases.append({'name': name, 'start': now, 'end': None})
+            self.save_manifest()
+        logger.info(f'Build phase: {name}')
+
+    def set_provisioner(self, provisioner: str, advance: bool = True):
+        '''Sets the packer provisioner that is currently running, advance=False renames the current step'''
+        with self._lock:
+            # some provisioners (i.e. windows-update) report starting more than once
+            if provisioner == self.provisioner:
+                return
+            self.provisioner = provisioner
+            if advance:
+                self.counters['provisioners'] += 1
+            self.save_manifest()
+
+    def set_provisioner_total(self, total: int):
+        '''Sets the total number of provisioners in the packer build'''
+        with self._lock:
+            self.provisioner_total = total
+            self.save_manifest()
+
+    def set_overrun(self, budget: str, minutes: int, step: str = None):
+        '''Records the time budget that was exceeded and the step that was running'''
+        with self._lock:
+            self.overrun = {'budget': budget, 'minutes': minutes, 'step': step}
+            self.save_manifest()
+
+    def set_update(self, installed: bool, reason: str = None):
+        '''Records whether the build installs windows updates and why'''
+        with self._lock:
+            self.update = {'installed': installed, 'reason': reason}
+            self.save_manifest()
+
+    def set_checkpoint(self, version: str, after: str, state: str):
+        '''Records a checkpoint the build resumed from, created, or deleted'''
+        with self._lock:
+            checkpoint = next((c for c in self.checkpoints if c['version'] == version), None)
+            if checkpoint:
+                checkpoint['state'] = state
+            else:
+                self.checkpoints.append({'version': version, 'after': after, 'state': state})
+            self.save_manifest()
+
+    def add_log(self, line: str, packer: bool = False):
+        '''Adds a line to the log tail'''
+        with self._lock:
+            self.logs.append(line)
+            self.counters['packer_lines' if packer else 'log_lines'] += 1
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def finish(self, outcome: str):
+        '''Marks the build as finished with the outcome (succeeded or failed)'''
+        with self._lock:
+            now = time.time()
+            if self.phases and self.phases[-1]['end'] is None:
+                self.phases[-1]['end'] = now
+            self.finished = now
+            self.outcome = outcome
+            self.phase = outcome
+            self.save_manifest()
+        logger.info(f'Build {outcome}')
+
+    def get_logs(self, lines: int = None):
+        with self._lock:
+            logs = list(self.logs)
+        return logs[-lines:] if lines else logs
+
+    def to_dict(self):
+        with self._lock:
+            now = self.finished or time.time()
+            timeline = self.timeline.summary()
+            update = None
+            if self.update:
+                # the number of updates installed and how long it took, from the windows-update steps
+                update = {**self.update, 'updates': timeline['updates'],
+                          'elapsed': timeline['elapsed'].get('update', 0)}
+            return {
+                'image': self.image_name,
+                'version': self.image_version,
+                'phase': self.phase,
+                'provisioner': self.provisioner,
+                'provisionerIndex': self.counters['provisioners'],
+                'provisionerTotal': self.provisioner_total,
+                'outcome': self.outcome,
+                'overrun': dict(self.overrun) if self.overrun else None,
+                'update': update,
+                'checkpoints': [dict(c) for c in self.checkpoints],
+                'started': _utc_iso(self.started),
+                'finished': _utc_iso(self.finished),
+                'elapsed': round(now - self.started, 1),
+                'phases': [{
+                    'name': p['name'],
+                    'started': _utc_iso(p['start']),
+                    'elapsed': round((p['end'] or now) - p['start'], 1)
+                } for p in self.phases],
+                'timeline': timeline,
+                'counters': dict(self.counters)
+            }
+
+    def save_manifest(self):
+        '''Atomically writes the status to the manifest file (if set) so it can be read from the storage share'''
+        if self.manifest:
+            _save_json_atomic(self.manifest, self.to_dict())
+
+    def to_prometheus(self):
+        '''Gets the status as metrics in the prometheus text exposition format'''
+        status = self.to_dict()
+        labels = f'image="{_label(status["image"])}",version="{_label(status["version"])}"'
+        lines = [
+            '# HELP bake_build_info Information about the build.',
+            '# TYPE bake_build_info gauge',
+            f'bake_build_info{{{labels},phase="{_label(status["phase"])}"}} 1',
+            '# HELP bake_build_elapsed_seconds Time since the build started.',
+            '# TYPE bake_build_elapsed_seconds gauge',
+            f'bake_build_elapsed_seconds{{{labels}}} {status["elapsed"]}',
+            '# HELP bake_build_finished Whether the build has finished.',
+            '# TYPE bake_build_finished gauge',
+            f'bake_build_finished{{{labels}}} {1 if status["outcome"] else 0}',
+            '# HELP bake_budget_exceeded Whether the build was stopped because a time budget was exceeded.',
+            '# TYPE bake_budget_exceeded gauge',
+            f'bake_budget_exceeded{{{labels}}} {1 if status["overrun"] else 0}',
+            '# HELP bake_phase_elapsed_seconds Time spent in each build phase.',
+            '# TYPE bake_phase_elapsed_seconds gauge'
+        ]
+        lines.extend(f'bake_phase_elapsed_seconds{{{labels},phase="{_label(p["name"])}"}} {p["elapsed"]}'
+                     for p in status['phases'])
+        lines.extend(['# HELP bake_step_elapsed_seconds Time spent in each kind of packer build step.',
+                      '# TYPE bake_step_elapsed_seconds gauge'])
+        lines.extend(f'bake_step_elapsed_seconds{{{labels},kind="{_label(kind)}"}} {elapsed}'
+                     for kind, elapsed in status['timeline']['elapsed'].items())
+        for name, metric in [('restarts', 'restarts'), ('updateRounds', 'update_rounds'), ('updates', 'updates')]:
+            lines.extend([f'# TYPE bake_{metric}_total counter',
+                          f'bake_{metric}_total{{{labels}}} {status["timeline"][name]}'])
+        for name, value in status['counters'].items():
+            lines.extend([f'# TYPE bake_{name}_total counter', f'bake_{name}_total{{{labels}}} {value}'])
+        return '\n'.join(lines) + '\n'
+
+
+class StatusLogHandler(logging.Handler):
+    '''Logging handler that adds the extension's log records to the status log tail'''
+
+    def __init__(self, status: BuildStatus):
+        super().__init__()
+        self.status = status
+        self.setFormatter(logging.Formatter('{asctime} {levelname:<8}: {message}', style='{',
+                                            datefmt='%m/%d/%Y %I:%M:%S %p'))
+
+    def emit(self, record):
+        try:
+            self.status.add_log(self.format(record))
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class _StatusRequestHandler(BaseHTTPRequestHandler):
+    '''Serves the build status, metrics, and log tail (which requires the server's bearer token)'''
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        status: BuildStatus = self.server.status
+
+        if url.path in ['/', '/status']:
+            self._send(200, 'application/json', json.dumps(status.to_dict(), indent=2))
+        elif url.path == '/timeline':
+            self._send(200, 'application/json', json.dumps(status.timeline.to_dict(), indent=2))
+        elif url.path == '/metrics':
+            self._send(200, 'text/plain; version=0.0.4', status.to_prometheus())
+        elif url.path == '/logs':
+            # the log tail has raw packer output, only serve it to clients with the token
+            token = self.server.token
+            auth = self.headers.get('Authorization', '')
+            if not token or not hmac.compare_digest(auth.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+                self._send(401, 'text/plain', 'unauthorized\n')
+                return
+            query = parse_qs(url.query)
+            try:
+                lines = int(query.get('lines', [0])[0]) or None
+            except ValueError:
+                self._send(400, 'text/plain', 'lines must be an integer\n')
+                return
+            self._send(200, 'text/plain', '\n'.join(status.get_logs(lines)) + '\n')
+        else:
+            self._send(404, 'text/plain', 'not found\n')
+
+    def _send(self, code, content_type, body):
+        content = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8'
+                         if 'charset' not in content_type else content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(f'Status server: {format % args}')
+
+
+def start_status_server(status: BuildStatus, port: int = STATUS_SERVER_PORT, token: str = None):
+    '''Starts serving the build status on a background thread. The log tail is only served to requests
+    with the token as a bearer token'''
+    try:
+        server = ThreadingHTTPServer(('', port), _StatusRequestHandler)
+    except OSError as e:
+        logger.warning(f'Unable to start status server on port {port}: {e}')
+        return None
+
+    server.daemon_threads = True
+    server.status = status
+    server.token = token
+
+    thread = threading.Thread(target=server.serve_forever, name='bake-status-server', daemon=True)
+    thread.start()
+
+    logger.info(f'Serving build status on port {port}')
+    return server
+
+
+def attach_status_log_handler(status: BuildStatus):
+    '''Adds the extension's log records to the status log tail'''
+    handler = StatusLogHandler(status)
+    knack_get_logger('azext_bake').addHandler(handler)
+    return handler
+
+
+def detach_status_log_handler(handler: StatusLogHandler):
+    '''Stops adding the extension's log records to the status log tail'''
+    knack_get_logger('azext_bake').removeHandler(handler)
@@ -0,0 +1,205 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import re
+import struct
+import zlib
+
+from typing import List
+
+from azure.cli.core.azclierror import AzureResponseError, FileOperationError, ResourceNotFoundError
+from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import ResourceNotFoundError as AzureResourceNotFoundError
+
+from ._client_factory import cf_share_service, cf_storage
+from ._constants import CHOCO_CACHE_SHARE
+from ._data import Sandbox
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+# builder output directories are named with the utc timestamp of the run (i.e. 20221027153001)
+BUILDER_RUN_PATTERN = re.compile(r'^\d{14}$')
+
+# zip local file header: signature, version, flags, method, time, date, crc, sizes, name length, extra length
+ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_LOCAL_HEADER_SIGNATURE = 0x04034b50
+
+
+def get_image_share_name(image_name: str):
+    '''Gets the name of the file share the builder for an image mounts (matches builder.bicep)'''
+    return image_name.replace('_', '-').lower()
+
+
+def get_storage_account_key(cmd, sandbox: Sandbox):
+    logger.info(f'Getting key for storage account {sandbox.storage_account}')
+    client = cf_storage(cmd.cli_ctx).storage_accounts
+    keys = client.list_keys(sandbox.resource_group, sandbox.storage_account)
+    return keys.keys[0].value
+
+
+def get_share_service_client(cmd, sandbox: Sandbox):
+    '''Gets a client for the file service of the sandbox storage account'''
+    account_key = get_storage_account_key(cmd, sandbox)
+    return cf_share_service(cmd.cli_ctx, sandbox.storage_account, account_key)
+
+
+def get_image_share_client(cmd, sandbox: Sandbox, image_name: str):
+    '''Gets a client for the file share the builder for an image writes its output to'''
+    service = get_share_service_client(cmd, sandbox)
+    return service.get_share_client(get_image_share_name(image_name))
+
+
+def choco_cache_share_exists(cmd, sandbox: Sandbox) -> bool:
+    '''Checks if the choco package cache share exists, using the management api so the storage account network rules
+    don't apply'''
+    client = cf_storage(cmd.cli_ctx).file_shares
+    try:
+        client.get(sandbox.resource_group, sandbox.storage_account, CHOCO_CACHE_SHARE)
+        return True
+    except AzureResourceNotFoundError:
+        return False
+
+
+def get_share_names(service_client) -> List[str]:
+    '''Gets the names of the file shares in the sandbox storage account'''
+    try:
+        return [share['name'] for share in service_client.list_shares()]
+    except HttpResponseError as e:
+        raise _share_response_error(f'storage account {service_client.account_name}', e) from e
+
+
+def list_share_root(share_client) -> List[dict]:
+    '''Lists the directories and files in the root of the share'''
+    try:
+        return list(share_client.list_directories_and_files())
+    except AzureResourceNotFoundError as e:
+        raise ResourceNotFoundError(f'Could not find file share {share_client.share_name}. '
+                                    'Has the image been built?') from e
+    except HttpResponseError as e:
+        raise _share_response_error(f'file share {share_client.share_name}', e) from e
+
+
+def get_builder_runs(share_client) -> List[str]:
+    '''Gets the names of the builder output directories on the share, oldest first'''
+    items = list_share_root(share_client)
+    return sorted(i['name'] for i in items if i['is_directory'] and BUILDER_RUN_PATTERN.match(i['name']))
+
+
+def get_latest_builder_run(share_client, run: str = None) -> str:
+    '''Gets the name of the most recent builder output directory on the share or validates the one provided'''
+    runs = get_builder_runs(share_client)
+    if not runs:
+        raise ResourceNotFoundError(f'No builder output found on file share {share_client.share_name}')
+    if run is None:
+        return runs[-1]
+    if run not in runs:
+        raise ResourceNotFoundError(f'Builder run {run} not found on file share {share_client.share_name}. '
+                                    f'Available runs: {", ".join(runs)}')
+    return run
+
+
+def read_share_file(share_client, path: str, offset: int = None, length: int = None) -> bytes:
+    '''Reads a file (or a range of bytes in the file) from the share'''
+    logger.info(f'Reading {path} from file share {share_client.share_name}')
+    try:
+        downloader = share_client.get_file_client(path).download_file(offset=offset, length=length)
+        return downloader.readall()
+    except AzureResourceNotFoundError as e:
+        raise ResourceNotFoundError(f'Could not find {path} on file share {share_client.share_name}') from e
+    except HttpResponseError as e:
+        raise _share_response_error(f'file share {share_client.share_name}', e) from e
+
+
+def list_share_files(share_client, path: str) -> List[dict]:
+    '''Recursively lists the files in a directory on the share'''
+    try:
+        directory = share_client.get_directory_client(path)
+        files = []
+        for item in directory.list_directories_and_files():
+            item_path = f'{path}/{item["name"]}'
+            if item['is_directory']:
+                files.extend(list_share_files(share_client, item_path))
+            else:
+                files.append({'name': item_path, 'size': item['size']})
+        return files
+    except AzureResourceNotFoundError as e:
+        raise ResourceNotFoundError(f'Could not find {path} on file share {share_client.share_name}') from e
+    except HttpResponseError as e:
+        raise _share_response_error(f'file share {share_client.share_name}', e) from e
+
+
+def upload_share_file(share_client, path: str, data, length: int = None):
+    '''Uploads a file to the share'''
+    logger.info(f'Uploading {path} to file share {share_client.share_name}')
+    try:
+        share_client.get_file_client(path).upload_file(data, length=length)
+    except HttpResponseError as e:
+        raise _share_response_error(f'file share {share_client.share_name}', e) from e
+
+
+def delete_share_file(share_client, path: str):
+    '''Deletes a file from the share'''
+    logger.info(f'Deleting {path} from file share {share_client.share_name}')
+    try:
+        share_client.get_file_client(path).delete_file()
+    except AzureResourceNotFoundError:
+        pass
+    except HttpResponseError as e:
+        raise _share_response_error(f'file share {share_client.share_name}', e) from e
+
+
+def delete_share_directory(share_client, path: str):
+    '''Recursively deletes a directory and its files from the share'''
+    logger.info(f'Deleting {path} from file share {share_client.share_name}')
+    try:
+        directory = share_client.get_directory_client(path)
+        for item in list(directory.list_directories_and_files()):
+            if item['is_directory']:
+                delete_share_directory(share_client, f'{path}/{item["name"]}')
+            else:
+                directory.delete_file(item['name'])
+        directory.delete_directory()
+    except AzureResourceNotFoundError:
+        pass
+    except HttpResponseError as e:
+        raise _share_response_error(f'file share {share_client.share_name}', e) from e
+
+
+def read_share_archive_file(share_client, archive_path: str, entry: dict) -> bytes:
+    '''Reads a single file from a zip archive on the share using its index entry, without downloading the archive'''
+    name_length = len(entry['name'].encode('utf-8'))
+    # read the local header and the compressed data in one request, allowing for a small extra field
+    length = ZIP_LOCAL_HEADER.size + name_length + 64 + entry['compressedSize']
+    data = read_share_file(share_client, archive_path, offset=entry['offset'], length=length)
+
+    header = ZIP_LOCAL_HEADER.unpack_from(data)
+    if header[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise FileOperationError(f'Invalid archive entry for {entry["name"]} in {archive_path}')
+
+    start = ZIP_LOCAL_HEADER.size + header[9] + header[10]
+    end = start + entry['compressedSize']
+    if end > len(data):  # extra field was larger than expected
+        data = read_share_file(share_client, archive_path, offset=entry['offset'], length=end)
+
+    content = data[start:end]
+    if entry['method'] == 8:  # deflated
+        content = zlib.decompressobj(-15).decompress(content)
+    elif entry['method'] != 0:  # stored
+        raise FileOperationError(f'Unsupported compression method for {entry["name"]} in {archive_path}')
+
+    if zlib.crc32(content) != entry['crc']:
+        raise FileOperationError(f'CRC check failed for {entry["name"]} in {archive_path}')
+
+    return content
+
+
+def _share_response_error(name: str, error: HttpResponseError):
+    if error.status_code == 403:
+        return AzureResponseError(f'Access to {name} was denied. The sandbox storage '
+                                  'account only allows access from the builders subnet by default. Add your client '
+                                  'IP address to the storage account network rules to access builder output.')
+    return AzureResponseError(str(error))
@@ -0,0 +1,51 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+# pylint: disable=logging-fstring-interpolation
+
+import re
+
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from ._data import Image
+from ._utils import get_logger
+
+logger = get_logger(__name__)
+
+# windows marketplace image versions end with the date they were built (i.e. 20348.1487.230106)
+MARKETPLACE_VERSION_DATE = re.compile(r'\.(?P<date>\d{6})$')
+
+
+def get_marketplace_version_date(version: str) -> Optional[datetime]:
+    '''Gets the date a marketplace image version was built from its name or None if the name doesn't include it'''
+    match = MARKETPLACE_VERSION_DATE.search(version or '')
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group('date'), '%y%m%d').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def plan_windows_update(image: Image, published: Optional[datetime], now: datetime = None) -> Tuple[bool, str]:
+    '''Decides if the build installs windows updates. Updates are skipped when the image the build starts from (the
+    base image or the source version of an incremental build) was published within update.skipIfBaseNewerThanDays.
+    Returns whether to install updates and the reason'''
+    if not image.update:
+        return False, 'update is false in the image.yaml'
+
+    days = image.update.skip_if_base_newer_than_days
+    if not days:
+        return True, 'update.skipIfBaseNewerThanDays is not set'
+
+    if published is None:
+        return True, 'the publish date of the base image is unknown'
+
+    now = now or datetime.now(timezone.utc)
+    age = (now - published).days
+    if age < days:
+        return False, f'the base image was published {age} days ago (less than {days} days)'
+
+    return True, f'the base image was published {age} days ago'
@@ -4,12 +4,20 @@
 # ------------------------------------
 # pylint: disable=logging-fstring-interpolation
 
+import atexit
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import tempfile
+import threading
+import zipfile
 
+from datetime import datetime, timezone
 from pathlib import Path
-from shutil import copy2, copytree
-from typing import List, Sequence, TypeVar
+from shutil import copy2, copyfileobj, copytree
+from typing import List, Mapping, Sequence, TypeVar
 from xml.dom import minidom
 from xml.etree.ElementTree import Element, tostring
 
@@ -18,8 +26,71 @@ import yaml
 from azure.cli.core.azclierror import FileOperationError, ValidationError
 from knack.log import get_logger as knack_get_logger
 
-from ._constants import IN_BUILDER, OUTPUT_DIR, STORAGE_DIR
-from ._data import ChocoPackage, Image, PowershellScript, get_dict
+from ._constants import (ARTIFACTS_ARCHIVE_FILE, ARTIFACTS_INDEX_FILE, BUILDER_CPU_MAX, BUILDER_CPU_PER_IMAGE,
+                         BUILDER_MEMORY_MAX, BUILDER_MEMORY_PER_IMAGE, IN_BUILDER, OUTPUT_DIR, STORAGE_DIR,
+                         WINGET_IMPORT_SCHEMA, WINGET_IMPORT_SOURCES)
+from ._data import Builder, ChocoPackage, Image, PowershellScript, WingetPackage, get_dict
+
+
+class _QueuedLogFileWriter(threading.Thread):
+    '''Background thread that writes queued log records to a file in batches, flushing once per batch'''
+
+    def __init__(self, path: Path, log_queue: queue.Queue, formatter: logging.Formatter, batch_size: int = 100):
+        super().__init__(name='bake-log-writer', daemon=True)
+        self.path = path
+        self.queue = log_queue
+        self.formatter = formatter
+        self.batch_size = batch_size
+
+    def run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            stop = False
+            while not stop:
+                batch = [self.queue.get()]  # block until there is at least one record
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                lines = []
+                for record in batch:
+                    if record is None:  # sentinel added by stop()
+                        stop = True
+                        continue
+                    lines.append(self.formatter.format(record))
+
+                if lines:
+                    try:
+                        f.write('\n'.join(lines) + '\n')
+                        f.flush()
+                    except OSError:
+                        pass  # never fail the build because the log share is unavailable
+
+    def stop(self, timeout: float = 5):
+        self.queue.put(None)
+        self.join(timeout)
+
+
+_builder_log_handler = None
+
+
+def _get_builder_log_handler():
+    '''Gets the single queue handler that feeds builder.log, creating it (and its writer thread) on first use'''
+    global _builder_log_handler  # pylint: disable=global-statement
+    if _builder_log_handler is None:
+        log_queue = queue.Queue(-1)
+        formatter = logging.Formatter('{asctime} [{name:^28}] {levelname:<8}: {message}',
+                                      datefmt='%m/%d/%Y %I:%M:%S %p', style='{',)
+        writer = _QueuedLogFileWriter(OUTPUT_DIR / 'builder.log', log_queue, formatter)
+        writer.start()
+        atexit.register(writer.stop)
+
+        _builder_log_handler = logging.handlers.QueueHandler(log_queue)
+        # all of the extension's loggers propagate to this one so the handler is only added once
+        knack_get_logger('azext_bake').addHandler(_builder_log_handler)
+
+    return _builder_log_handler
 
 
 def get_logger(name):
@@ -29,14 +100,9 @@ def get_logger(name):
     # this must only happen in the builder, otherwise
     # the log file could be created on users machines
     if IN_BUILDER and STORAGE_DIR.is_dir():
-        import logging
-        log_file = OUTPUT_DIR / 'builder.log'
-        formatter = logging.Formatter('{asctime} [{name:^28}] {levelname:<8}: {message}',
-                                      datefmt='%m/%d/%Y %I:%M:%S %p', style='{',)
-        fh = logging.FileHandler(log_file)
-        fh.setLevel(level=_logger.level)
-        fh.setFormatter(formatter)
-        _logger.addHandler(fh)
+        # log records are queued and written to the storage share on a background
+        # thread so logging never blocks the build waiting on the share
+        _get_builder_log_handler()
 
     return _logger
 
@@ -67,7 +133,7 @@ def copy_to_builder_output_dir(src, dest_path=OUTPUT_DIR):
             for d in dirnames:  # copy all the directories in the root directory recursively
                 d_path = Path(dirpath) / d
                 logger.info(f'Copying {d_path} to {dest_path}')
-                copytree(d_path, dest_path / d)
+                copytree(d_path, dest_path / d, dirs_exist_ok=True)
             break  # we copied the directories in root recursively, so we don't need to walk the subdirectories
     elif src_path.is_file():
         logger.info(f'Copying {src_path} to {dest_path}')
@@ -76,6 +142,60 @@ def copy_to_builder_output_dir(src, dest_path=OUTPUT_DIR):
         raise FileOperationError(f'Cannot copy to builder output because {src_path} is not a file or directory')
 
 
+def zip_directory(src_path: Path, dest_file: Path) -> List[zipfile.ZipInfo]:
+    '''Compress the files in a directory into a zip archive. The archive is built locally then copied
+    to the destination (usually the storage share) in one sequential write.'''
+    # spooled in memory for the typical image directory, only rolls over to a temp file for large directories
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+        with zipfile.ZipFile(spool, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for dirpath, dirnames, files in os.walk(src_path):
+                dirnames.sort()
+                for f in sorted(files):
+                    f_src = Path(dirpath) / f
+                    archive.write(f_src, f_src.relative_to(src_path).as_posix())
+            infos = archive.infolist()
+
+        spool.seek(0)
+        with open(dest_file, 'wb') as f:
+            copyfileobj(spool, f, 4 * 1024 * 1024)
+
+    return infos
+
+
+def archive_to_builder_output_dir(src, dest_path=OUTPUT_DIR):
+    '''Write the files in a directory to the builder output directory as a single compressed archive and index'''
+    src_path = (src if isinstance(src, Path) else Path(src)).resolve()
+    dest_path = (dest_path if isinstance(dest_path, Path) else Path(dest_path)).resolve()
+
+    logger.info(f'Archiving {src_path} to {dest_path / ARTIFACTS_ARCHIVE_FILE}')
+
+    if not src_path.is_dir():
+        raise FileOperationError(f'Cannot archive to builder output because {src_path} is not a directory')
+
+    if not dest_path.exists():
+        raise FileOperationError(f'Cannot archive to builder output because {dest_path} does not exist')
+
+    infos = zip_directory(src_path, dest_path / ARTIFACTS_ARCHIVE_FILE)
+
+    # the index lets clients list the archive and read a single file with a ranged read
+    index = {
+        'archive': ARTIFACTS_ARCHIVE_FILE,
+        'files': [{
+            'name': i.filename,
+            'size': i.file_size,
+            'compressedSize': i.compress_size,
+            'offset': i.header_offset,
+            'method': i.compress_type,
+            'crc': i.CRC
+        } for i in infos]
+    }
+
+    with open(dest_path / ARTIFACTS_INDEX_FILE, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+
+    logger.info(f'Archived {len(infos)} files to {dest_path / ARTIFACTS_ARCHIVE_FILE}')
+
+
 def get_templates_path(folder=None):
     '''Get the path to the templates folder'''
     path = Path(__file__).resolve().parent / 'templates'
@@ -137,6 +257,24 @@ def get_yaml_file_data(data_type: TData, path: Path) -> TData:
     return data_type(obj, path)
 
 
+def get_builder_resources(builder: Builder, image: Image):
+    '''Gets the cpu and memory (in GB) for an image's builder container. image.yaml settings take precedence
+    over bake.yaml settings, otherwise the container is sized from the number of images packer builds in parallel
+    (the image and its variants)'''
+    image_builder = image.builder if image else None
+    image_count = 1 + len(image.variants or []) if image else 1
+
+    cpu = image_builder.cpu if image_builder and image_builder.cpu else builder.cpu if builder else None
+    memory = image_builder.memory if image_builder and image_builder.memory else builder.memory if builder else None
+
+    if cpu is None:
+        cpu = min(BUILDER_CPU_MAX, BUILDER_CPU_PER_IMAGE * image_count)
+    if memory is None:
+        memory = min(BUILDER_MEMORY_MAX, BUILDER_MEMORY_PER_IMAGE * image_count)
+
+    return cpu, memory
+
+
 def get_install_choco_packages(image: Image) -> List[ChocoPackage]:
     '''Get the dict for the install choco section supplemented by the index'''
     logger.info('Getting choco install dictionary from image.yaml')
@@ -188,14 +326,13 @@ def get_choco_package_config(packages: Sequence[ChocoPackage], indent=2) -> str:
     return xml_string
 
 
-def get_install_winget(image: Image):
-    # TODO
-    '''Get the dict for the install winget section supplemented by the index'''
-    logger.info('Getting wingit install dictionary from image.yaml')
+def get_install_winget(image: Image) -> List[WingetPackage]:
+    '''Get the winget packages from the install winget section supplemented by the index and defaults'''
+    logger.info('Getting winget packages from image.yaml')
     if image.install is None or image.install.winget is None:
         return None
 
-    if image.install.winget.packages is None:
+    if not image.install.winget.packages:
         raise ValidationError('No packages found in install.winget in image.yaml')
 
     install_path = get_templates_path('install')
@@ -204,32 +341,58 @@ def get_install_winget(image: Image):
     with open(winget_index_path, 'r', encoding='utf-8') as f:
         winget_index = json.load(f)
 
-    winget = []
-
     winget_defaults = image.install.winget.defaults
 
-    for c in image.install.winget.packages:
-        logger.info(f'Getting winget config for {c} type {type(c)}')
-        if isinstance(c, str):
-            # if only the id was givin, check the index for the rest of the config
-            winget_node = winget_index[c] if c in winget_index else {'ANY': c}
-        elif isinstance(c, dict):
-            # if the full config was given, use it
-            winget_node = c
-        else:
-            raise ValidationError(f'Invalid winget config {c} in image {image["name"]}')
+    winget: List[WingetPackage] = []
+
+    for package in image.install.winget.packages:
+        logger.info(f'Getting winget config for {package}')
+        # if only a string was given, check the index for the rest of the config
+        if package.any and package.any in winget_index:
+            package = WingetPackage(winget_index[package.any], image.file)
 
         # if defaults were given, add them to the config
-        if winget_defaults:  # merge common properties into image properties
-            temp = winget_defaults.copy()
-            temp.update(winget_node)
-            winget_node = temp.copy()
+        if winget_defaults and winget_defaults.source and not package.source:
+            package = WingetPackage({**get_dict(package), 'source': winget_defaults.source}, image.file)
 
-        winget.append(winget_node)
+        winget.append(package)
 
     return winget
 
 
+def get_winget_import_config(packages: Sequence[WingetPackage]):
+    '''Get the winget import file for the packages that winget import can install (packages with an id, or a string
+    treated as an id, from a known source). Returns the file contents (or None), the imported packages, and the
+    packages that must be installed individually with winget install'''
+    logger.info('Getting winget import file contents from install dict')
+    imported: List[WingetPackage] = []
+    installed: List[WingetPackage] = []
+    sources = {}
+
+    for package in packages:
+        source = package.source or 'winget'
+        if (package.id or package.any) and source in WINGET_IMPORT_SOURCES:
+            entry = {'PackageIdentifier': package.id or package.any}
+            if package.version:
+                entry['Version'] = package.version
+            sources.setdefault(source, []).append(entry)
+            imported.append(package)
+        else:
+            installed.append(package)
+
+    if not imported:
+        return None, imported, installed
+
+    config = {
+        '$schema': WINGET_IMPORT_SCHEMA,
+        'CreationDate': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'Sources': [{'Packages': entries, 'SourceDetails': WINGET_IMPORT_SOURCES[source]}
+                    for source, entries in sources.items()]
+    }
+
+    return json.dumps(config, indent=2), imported, installed
+
+
 def get_install_powershell_scripts(image: Image) -> List[PowershellScript]:
     # TODO
     logger.info('Getting powershell scripts install dictionary from image.yaml')
@@ -243,14 +406,38 @@ def get_install_powershell_scripts(image: Image) -> List[PowershellScript]:
 
     scripts: List[PowershellScript] = []
 
+    script_paths = {}
+
     for script in image.install.scripts.powershell:
         logger.info(f'Getting powershell script config for {script} type {type(script)}')
-        script_path = str(_validate_file_path(image.dir / script.path)).replace(str(img_dir), '${path.root}')
-        scripts.append(PowershellScript({'path': script_path, 'restart': script.restart}))
+        script_paths[script.path] = str(_validate_file_path(image.dir / script.path)).replace(str(img_dir),
+                                                                                              '${path.root}')
+
+    for script in image.install.scripts.powershell:
+        obj = {'path': script_paths[script.path], 'restart': script.restart}
+        if script.after:
+            obj['after'] = [script_paths[a] for a in script.after]
+        if script.group:
+            obj['group'] = script.group
+        scripts.append(PowershellScript(obj))
 
     return scripts
 
 
+def get_variant_powershell_scripts(image: Image) -> Mapping[str, List[PowershellScript]]:
+    '''Gets the powershell scripts of each image variant (keyed by variant name) that has scripts'''
+    img_dir = image.dir.resolve()
+    variant_scripts = {}
+    for variant in image.variants:
+        scripts = []
+        for script in variant.scripts:
+            path = str(_validate_file_path(image.dir / script.path)).replace(str(img_dir), '${path.root}')
+            scripts.append(PowershellScript({**get_dict(script), 'path': path}))
+        if scripts:
+            variant_scripts[variant.name] = scripts
+    return variant_scripts
+
+
 def _validate_file_path(path, name=None) -> Path:
     file_path = (path if isinstance(path, Path) else Path(path)).resolve()
     not_exists = f'Could not find {name} file at {file_path}' if name else f'{file_path} is not a file or directory'
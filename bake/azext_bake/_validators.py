@@ -84,6 +84,56 @@ def process_bake_repo_build_namespace(cmd, ns):
     ns.repo = repo
 
 
+def process_bake_image_build_namespace(cmd, ns):
+    # the repo validators select images by name from image_names
+    ns.image_names = [ns.image_name]
+
+    if not ns.local:
+        process_bake_repo_build_namespace(cmd, ns)
+    else:
+        if ns.repository_url or ns.repository_token or ns.repository_revision:
+            raise ArgumentUsageError('--repo-url, --repo-token, and --repo-revision can not be used with --local')
+
+        repository_path_validator(cmd, ns)
+        repository_images_validator(cmd, ns)
+        bake_yaml_validator(cmd, ns)
+        check_packer_install(raise_error=True)
+
+    del ns.image_names
+
+
+def process_bake_image_replicate_namespace(cmd, ns):
+    gallery_resource_id_validator(cmd, ns)
+
+    # the regions and gallery default to the image's replicaLocations and the gallery in bake.yml
+    if not ns.regions or not ns.gallery:
+        ns.image_names = [ns.image_name]
+        repository_path_validator(cmd, ns)
+        repository_images_validator(cmd, ns)
+        if not ns.gallery:
+            bake_yaml_validator(cmd, ns)
+        if not ns.regions:
+            ns.regions = ns.images[0].replica_locations
+        del ns.image_names
+
+
+def process_sandbox_cache_choco_namespace(cmd, ns):
+    repository_path_validator(cmd, ns)
+    repository_images_validator(cmd, ns)
+    # the local cache doesn't need a sandbox
+    if not ns.local:
+        sandbox_resource_group_name_validator(cmd, ns)
+    del ns.image_names
+
+
+def process_sandbox_gc_namespace(cmd, ns):
+    sandbox_resource_group_name_validator(cmd, ns)
+    # the retention policy the builder enforces, if the repository has a bake.yml
+    path = get_yaml_file_path(ns.repository_path, 'bake', required=False) if ns.repository_path else None
+    if path:
+        ns.builder = get_yaml_file_data(BakeConfig, path).builder
+
+
 def process_bake_repo_validate_namespace(cmd, ns):
     repository_path_validator(cmd, ns)
     repository_images_validator(cmd, ns)
@@ -280,6 +330,9 @@ def bake_yaml_validator(cmd, ns, path=None):
     if hasattr(ns, 'gallery'):
         ns.gallery = bake_config.gallery
 
+    if hasattr(ns, 'builder'):
+        ns.builder = bake_config.builder
+
     return bake_config
 
 
@@ -6,8 +6,10 @@
 from azure.cli.core.commands import CliCommandType
 
 from ._client_factory import cf_container_groups
-from ._validators import (builder_validator, process_bake_repo_build_namespace, process_bake_repo_validate_namespace,
-                          process_sandbox_create_namespace)
+from ._validators import (builder_validator, process_bake_image_build_namespace,
+                          process_bake_image_replicate_namespace, process_bake_repo_build_namespace,
+                          process_bake_repo_validate_namespace, process_sandbox_cache_choco_namespace,
+                          process_sandbox_create_namespace, process_sandbox_gc_namespace)
 
 container_group_sdk = CliCommandType(
     operations_tmpl='azure.mgmt.containerinstance.operations#ContainerGroupsOperations.{}',
@@ -28,6 +30,10 @@ def load_command_table(self, _):  # pylint: disable=too-many-statements
     with self.command_group('bake sandbox') as g:
         g.custom_command('create', 'bake_sandbox_create', validator=process_sandbox_create_namespace)
         g.custom_command('validate', 'bake_sandbox_validate')
+        g.custom_command('gc', 'bake_sandbox_gc', validator=process_sandbox_gc_namespace)
+
+    with self.command_group('bake sandbox cache') as g:
+        g.custom_command('choco', 'bake_sandbox_cache_choco', validator=process_sandbox_cache_choco_namespace)
 
     with self.command_group('bake repo') as g:
         g.custom_command('build', 'bake_repo_build', validator=process_bake_repo_build_namespace)
@@ -46,7 +52,11 @@ def load_command_table(self, _):  # pylint: disable=too-many-statements
 
     with self.command_group('bake image') as g:
         g.custom_command('create', 'bake_image_create')
+        g.custom_command('build', 'bake_image_build', validator=process_bake_image_build_namespace)
         g.custom_command('logs', 'bake_image_logs')
+        g.custom_command('status', 'bake_image_status')
+        g.custom_command('artifacts', 'bake_image_artifacts')
+        g.custom_command('replicate', 'bake_image_replicate', validator=process_bake_image_replicate_namespace)
         g.custom_command('bump', 'bake_image_bump')
 
     with self.command_group('bake image', container_group_sdk) as g:
@@ -6,30 +6,56 @@
 
 import json
 import os
+import secrets
+import shutil
+import time
 
+from datetime import datetime, timezone
+from pathlib import Path
 from typing import Sequence
 
 import yaml
 
-from azure.cli.core.azclierror import CLIError, InvalidArgumentValueError, MutuallyExclusiveArgumentError
+from azure.cli.core.azclierror import (CLIError, InvalidArgumentValueError, MutuallyExclusiveArgumentError,
+                                       ResourceNotFoundError, ValidationError)
 from azure.cli.core.extension.operations import show_extension, update_extension
+from azure.core.exceptions import HttpResponseError
 from packaging.version import parse as parse_version
 
-from ._arm import (create_image_definition, create_resource_group, deploy_arm_template_at_resource_group,
-                   ensure_gallery_permissions, get_arm_output, get_gallery, get_image_definition,
-                   get_resource_group_by_name, image_version_exists)
+from ._arm import (create_image_definition, create_resource_group, delete_image_version, delete_managed_image,
+                   deploy_arm_template_at_resource_group, ensure_gallery_permissions, get_arm_output, get_gallery,
+                   get_image_definition, get_image_version_replication, get_latest_image_version,
+                   get_marketplace_image_version, get_resource_group_by_name, image_version_exists,
+                   list_image_versions, replicate_image_version, tag_image_version)
+from ._checkpoints import (CHECKPOINT_AFTER_TAG, BuildStage, find_checkpoint, get_checkpoint_definition_name,
+                           get_checkpoint_image, get_checkpoint_tags, plan_build_stages, resume_build_stages)
+from ._choco import LocalChocoCache, ShareChocoCache, apply_choco_cache, cache_choco_packages
 from ._client_factory import cf_container, cf_container_groups
-from ._constants import (BAKE_YAML_SCHEMA, DEVOPS_PIPELINE_CONTENT, DEVOPS_PIPELINE_FILE, DEVOPS_PROVIDER_NAME,
-                         GITHUB_PROVIDER_NAME, GITHUB_WORKFLOW_CONTENT, GITHUB_WORKFLOW_DIR, GITHUB_WORKFLOW_FILE,
-                         IMAGE_DEFAULT_BASE_WINDOWS, IMAGE_YAML_SCHEMA, IN_BUILDER)
-from ._data import Gallery, Image, Sandbox, get_dict
+from ._constants import (ARTIFACTS_INDEX_FILE, AZ_BAKE_CHOCO_VOLUME, AZ_BAKE_STATUS_TOKEN, BAKE_YAML_SCHEMA,
+                         CHOCO_CACHE_SHARE, CHOCO_PACKAGES_CONFIG_FILE, CHOCO_PACKAGES_USER_CONFIG_FILE,
+                         DEVOPS_PIPELINE_CONTENT, DEVOPS_PIPELINE_FILE, DEVOPS_PROVIDER_NAME, GITHUB_PROVIDER_NAME,
+                         GITHUB_WORKFLOW_CONTENT, GITHUB_WORKFLOW_DIR, GITHUB_WORKFLOW_FILE, IMAGE_DEFAULT_BASE_WINDOWS, IMAGE_REPLICATION_POLL_INTERVAL,
+                         IMAGE_YAML_SCHEMA, IN_BUILDER, OUTPUT_DIR, PKR_BUILD_FILE, PKR_VARS_FILE,
+                         STATUS_MANIFEST_FILE, STATUS_TIMELINE_FILE, STORAGE_DIR, WINGET_IMPORT_FILE)
+from ._data import Builder, BuilderRetention, Gallery, Image, Sandbox, get_dict
 from ._github import get_github_latest_release_version, get_github_release, get_release_templates, get_template_url
-from ._packer import (copy_packer_files, inject_choco_provisioners, inject_powershell_provisioner,
-                      inject_update_provisioner, packer_execute, save_packer_vars_file)
+from ._incremental import (filter_install_steps, get_full_build_time, get_install_steps, get_version_tags,
+                           plan_incremental_build)
+from ._packer import (bundle_install_files, copy_packer_files, get_build_file, get_missing_packer_vars,
+                      packer_execute, save_packer_vars_file)
 from ._repos import Repo
+from ._retention import ShareRunStore, enforce_retention, start_local_retention
 from ._sandbox import get_builder_subnet_id, get_sandbox_resource_names
-from ._utils import (copy_to_builder_output_dir, get_choco_package_config, get_install_choco_packages,
-                     get_install_powershell_scripts, get_logger, get_templates_path)
+from ._scheduler import schedule_powershell_scripts
+from ._status import BuildStatus, attach_status_log_handler, detach_status_log_handler, start_status_server
+from ._storage import (choco_cache_share_exists, get_image_share_client, get_image_share_name, get_latest_builder_run,
+                       get_share_names, get_share_service_client, list_share_files, read_share_archive_file,
+                       read_share_file)
+from ._update import get_marketplace_version_date, plan_windows_update
+from ._utils import (archive_to_builder_output_dir, copy_to_builder_output_dir, get_builder_resources,
+                     get_choco_package_config, get_install_choco_packages, get_install_powershell_scripts,
+                     get_install_winget, get_logger, get_templates_path, get_variant_powershell_scripts,
+                     get_winget_import_config)
 
 logger = get_logger(__name__)
 
@@ -120,13 +146,74 @@ def bake_sandbox_validate(cmd, sandbox_resource_group_name: str, gallery_resourc
     print('Sandbox is valid')
 
 
+def bake_sandbox_gc(cmd, sandbox_resource_group_name: str, image_names: Sequence[str] = None, keep_runs: int = None,
+                    max_age_days: int = None, max_size_mb: int = None, dry_run: bool = False, repository_path='./',
+                    sandbox: Sandbox = None, builder: Builder = None):
+    # the options that are set override the retention policy in bake.yml
+    configured = get_dict(builder.retention) if builder and builder.retention else {}
+    options = {k: v for k, v in {
+        'keepRuns': keep_runs,
+        'maxAgeDays': max_age_days,
+        'maxSizeMb': max_size_mb
+    }.items() if v is not None}
+
+    if not configured and not options:
+        logger.warning('No builder.retention policy in bake.yml and no retention options set, '
+                       'keeping every builder run')
+        return []
+
+    policy = BuilderRetention({**configured, **options})
+
+    service = get_share_service_client(cmd, sandbox)
+    share_names = [get_image_share_name(i) for i in image_names] if image_names else get_share_names(service)
+
+    results = []
+    for share_name in share_names:
+        logger.info(f'Applying builder output retention policy to file share {share_name}')
+        actions = enforce_retention(ShareRunStore(service.get_share_client(share_name)), policy, dry_run=dry_run)
+        results.extend({
+            'image': share_name,
+            'run': a['name'],
+            'action': a['action'],
+            'reason': a['reason'],
+            'size': a['size']
+        } for a in actions)
+
+    return results
+
+
+def bake_sandbox_cache_choco(cmd, repository_path, sandbox_resource_group_name: str = None,
+                             image_names: Sequence[str] = None, local: bool = False, sandbox: Sandbox = None,
+                             images: Sequence[Image] = None):
+    packages = {}
+    for image in images:
+        for package in get_install_choco_packages(image) or []:
+            packages.setdefault((package.id.lower(), package.version), package)
+
+    if local:
+        cache = LocalChocoCache(repository_path / '.local' / 'choco')
+    else:
+        cache = ShareChocoCache(get_share_service_client(cmd, sandbox).get_share_client(CHOCO_CACHE_SHARE))
+
+    logger.warning(f'Caching {len(packages)} choco packages (and their dependencies) in {cache.name}')
+    results = cache_choco_packages(cache, list(packages.values()))
+
+    failed = [r['id'] for r in results if r['action'] == 'failed']
+    if failed:
+        logger.warning(f'Failed to cache choco packages: {", ".join(failed)}. Builds install them from the '
+                       'community feed')
+
+    return results
+
+
 # ----------------
 # bake repo
 # ----------------
 
 def bake_repo_build(cmd, repository_path, image_names: Sequence[str] = None, sandbox: Sandbox = None,
-                    gallery: Gallery = None, images: Sequence[Image] = None, repository_url: str = None,
-                    repository_token: str = None, repository_revision: str = None, repo: Repo = None):
+                    gallery: Gallery = None, images: Sequence[Image] = None, builder: Builder = None,
+                    repository_url: str = None, repository_token: str = None, repository_revision: str = None,
+                    repo: Repo = None):
 
     hook = cmd.cli_ctx.get_progress_controller()
     hook.begin()
@@ -159,6 +246,10 @@ def bake_repo_build(cmd, repository_path, image_names: Sequence[str] = None, san
     if repo.revision:
         params.append(f'revision={repo.revision}')
 
+    # builders mount the choco package cache if it was created with az bake sandbox cache choco
+    if choco_cache_share_exists(cmd, sandbox):
+        params.append('chocoCache=true')
+
     for image in images:
         logger.info(f'Getting deployment params for {image.name} builder')
 
@@ -166,6 +257,17 @@ def bake_repo_build(cmd, repository_path, image_names: Sequence[str] = None, san
         image_params.append(f'image={image.name}')
         image_params.append(f'version={image.version}')
 
+        # the status server is opt-in, the build log tail it serves requires a token unique to each builder
+        status_token = secrets.token_urlsafe(24) if builder and builder.status else None
+        if status_token:
+            image_params.append(f'statusToken={status_token}')
+
+        # each builder builds a single image
+        cpu, memory = get_builder_resources(builder, image)
+        logger.info(f'Builder for {image.name} will use {cpu} cpu and {memory} GB memory')
+        image_params.append(f'cpu={cpu}')
+        image_params.append(f'memoryInGB={memory}')
+
         hook.add(message=f'Deploying {image.name} builder')
         logger.info(f'Deploying {image.name} builder...')
         deployment, outputs = deploy_arm_template_at_resource_group(cmd, sandbox.resource_group, template_file=template_file,
@@ -173,12 +275,17 @@ def bake_repo_build(cmd, repository_path, image_names: Sequence[str] = None, san
         logs = get_arm_output(outputs, 'logs')
         bake_logs = get_arm_output(outputs, 'bake')
         portal = get_arm_output(outputs, 'portal')
+        status_url = get_arm_output(outputs, 'status', raise_on_error=False)
 
         logger.warning(f'Finished deploying builder for {image.name} but packer is still running.')
         logger.warning('You can check the progress of the packer build:')
         logger.warning(f'  - Azure CLI: {logs}')
         logger.warning(f'  - Az Bake CLI: {bake_logs}')
         logger.warning(f'  - Azure Portal: {portal}')
+        if status_url:
+            logger.warning(f'  - Build Status: {status_url}')
+            logger.warning(f'  - Build Logs: curl -H "Authorization: Bearer {status_token}" '
+                           f'{status_url.rsplit("/", 1)[0]}/logs')
         logger.warning('')
 
         if repo and repo.provider == GITHUB_PROVIDER_NAME:
@@ -254,6 +361,12 @@ def bake_image_create(cmd, image_name, repository_path='./'):
 
     image_obj = get_dict(image)
 
+    # the update, vm, publish, and variants sections are defaulted when the image.yml is read,
+    # so only write what the scaffold sets (update: true rather than an empty update object)
+    image_obj['update'] = True
+    for key in ['vm', 'publish', 'variants']:
+        image_obj.pop(key, None)
+
     yaml_str = f'{IMAGE_YAML_SCHEMA}\n' + yaml.safe_dump(image_obj, default_flow_style=False, sort_keys=False)
 
     image_dir = repository_path / 'images' / image_name
@@ -282,6 +395,127 @@ def bake_image_logs(cmd, sandbox_resource_group_name, image_name, sandbox: Sandb
     print(log.content)
 
 
+def bake_image_status(cmd, sandbox_resource_group_name, image_name, run=None, sandbox: Sandbox = None):
+    share_client = get_image_share_client(cmd, sandbox, image_name)
+    run = get_latest_builder_run(share_client, run)
+
+    # only read the small status manifest the builder maintains, not the logs
+    status = json.loads(read_share_file(share_client, f'{run}/{STATUS_MANIFEST_FILE}'))
+    status['run'] = run
+    return status
+
+
+def bake_image_artifacts(cmd, sandbox_resource_group_name, image_name, run=None, files: Sequence[str] = None,
+                         outdir='./', sandbox: Sandbox = None):
+    share_client = get_image_share_client(cmd, sandbox, image_name)
+    run = get_latest_builder_run(share_client, run)
+
+    try:
+        # only read the small index, files are read from the archive with ranged reads
+        index = json.loads(read_share_file(share_client, f'{run}/{ARTIFACTS_INDEX_FILE}'))
+        entries = {e['name']: e for e in index['files']}
+        archive = f'{run}/{index["archive"]}'
+    except ResourceNotFoundError:
+        logger.info(f'No artifacts archive found for builder run {run}. Listing files instead.')
+        entries = {f['name'][len(run) + 1:]: f for f in list_share_files(share_client, run)}
+        archive = None
+
+    if not files:
+        return [{'name': name, 'size': entry['size']} for name, entry in entries.items()]
+
+    outdir = Path(outdir).resolve()
+    extracted = []
+
+    for name in files:
+        name = name.replace('\\', '/').lstrip('/')
+        if name not in entries:
+            raise ResourceNotFoundError(f'{name} not found in the output of builder run {run}')
+
+        dest = (outdir / name).resolve()
+        if outdir not in dest.parents:
+            raise InvalidArgumentValueError(f'{name} is not a valid file name')
+
+        if archive:
+            content = read_share_archive_file(share_client, archive, entries[name])
+        else:
+            content = read_share_file(share_client, f'{run}/{name}')
+
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.write_bytes(content)
+        logger.info(f'Saved {name} to {dest}')
+        extracted.append(str(dest))
+
+    return extracted
+
+
+def bake_image_build(cmd, repository_path, image_name, local: bool = False, sandbox: Sandbox = None,
+                     gallery: Gallery = None, images: Sequence[Image] = None, builder: Builder = None,
+                     repository_url: str = None, repository_token: str = None, repository_revision: str = None,
+                     repo: Repo = None):
+    if not local:
+        return bake_repo_build(cmd, repository_path, image_names=[image_name], sandbox=sandbox, gallery=gallery,
+                               images=images, builder=builder, repository_url=repository_url,
+                               repository_token=repository_token, repository_revision=repository_revision, repo=repo)
+
+    image = images[0]
+
+    # each local run gets its own output directory like the builder runs on the storage share
+    storage_dir = repository_path / '.local' / 'storage'
+    output_dir = storage_dir / datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # generating the packer files modifies the image directory, so build from a copy of the working tree
+    image.dir = _copy_image_for_local_build(repository_path, image, repository_path / '.local' / 'build' / image.name)
+
+    logger.warning(f'Building {image.name} locally. Output: {output_dir}')
+
+    # packages cached with az bake sandbox cache choco --local
+    choco_cache_dir = repository_path / '.local' / 'choco'
+
+    _, status = _bake_builder_run(cmd, sandbox, gallery, image, builder, output_dir, storage_dir=storage_dir,
+                                  choco_cache_dir=choco_cache_dir)
+
+    result = status.to_dict()
+    result['output'] = str(output_dir)
+    return result
+
+
+def bake_image_replicate(cmd, image_name, gallery_resource_id=None, version=None, regions: Sequence[str] = None,
+                         repository_path='./', no_wait=False, gallery: Gallery = None, images: Sequence[Image] = None):
+    if not version:
+        latest = get_latest_image_version(cmd, gallery.resource_group, gallery.name, image_name)
+        if not latest:
+            raise ResourceNotFoundError(f'No published versions of {image_name} found in gallery {gallery.name}')
+        version = latest.name
+
+    replica_counts = images[0].publish.region_replica_counts if images else None
+    poller, _ = replicate_image_version(cmd, gallery.resource_group, gallery.name, image_name, version, regions,
+                                        replica_counts)
+
+    if not no_wait:
+        # the version may already be replicating (i.e. started by the builder) so wait on the status, not the poller
+        reported = {}
+        while True:
+            replication = get_image_version_replication(cmd, gallery.resource_group, gallery.name, image_name, version)
+            for region in replication.summary or []:
+                if reported.get(region.region) != (region.state, region.progress):
+                    reported[region.region] = (region.state, region.progress)
+                    logger.warning(f'{region.region}: {region.state} ({region.progress or 0}%)')
+            if replication.aggregated_state not in ['InProgress', 'Unknown'] and (poller is None or poller.done()):
+                break
+            time.sleep(IMAGE_REPLICATION_POLL_INTERVAL)
+        if poller:
+            poller.result()
+
+    replication = get_image_version_replication(cmd, gallery.resource_group, gallery.name, image_name, version)
+    return {
+        'name': image_name,
+        'version': version,
+        'state': replication.aggregated_state,
+        'regions': [{'region': r.region, 'state': r.state, 'progress': r.progress} for r in replication.summary or []]
+    }
+
+
 def bake_image_bump(cmd, repository_path='./', image_names: Sequence[str] = None, images: Sequence[Image] = None,
                     major: bool = False, minor: bool = False):
     logger.info('Bumping image version')
@@ -390,7 +624,81 @@ def bake_upgrade(cmd, version=None, prerelease=False):
 # bake _builder
 # ----------------
 
-def bake_builder_build(cmd, sandbox: Sandbox = None, gallery: Gallery = None, image: Image = None, suffix=None):
+def bake_builder_build(cmd, sandbox: Sandbox = None, gallery: Gallery = None, image: Image = None,
+                       builder: Builder = None, suffix=None):
+
+    # write the status manifest and timeline to the builder output directory (next to builder.log)
+    # so they can be read from the storage share
+    storage_dir = STORAGE_DIR if IN_BUILDER and STORAGE_DIR.is_dir() else None
+
+    success, _ = _bake_builder_run(cmd, sandbox, gallery, image, builder, OUTPUT_DIR, storage_dir=storage_dir,
+                                   run_packer=IN_BUILDER,
+                                   status_token=os.environ.get(AZ_BAKE_STATUS_TOKEN, None) if IN_BUILDER else None,
+                                   choco_cache_dir=Path(AZ_BAKE_CHOCO_VOLUME) if IN_BUILDER else None)
+    return success
+
+
+# ----------------
+# _private
+# ----------------
+
+def _copy_image_for_local_build(repository_path: Path, image: Image, build_root: Path) -> Path:
+    '''Copies the image directory to the same path in the build root, with the scripts it uses from elsewhere in the
+    repository (i.e. ../../scripts), so relative script paths resolve like they do in the builder's clone'''
+    if build_root.exists():
+        shutil.rmtree(build_root)
+
+    repo_dir = repository_path.resolve()
+    build_dir = build_root / image.dir.resolve().relative_to(repo_dir)
+    shutil.copytree(image.dir, build_dir)
+
+    scripts = list(get_install_powershell_scripts(image) or [])
+    scripts += [script for scripts in get_variant_powershell_scripts(image).values() for script in scripts]
+    # scripts in the image directory are already copied, the others have absolute paths
+    for path in {Path(script.path) for script in scripts if not script.path.startswith('${path.root}')}:
+        if repo_dir in path.parents:
+            (build_root / path.relative_to(repo_dir)).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(path, build_root / path.relative_to(repo_dir))
+
+    return build_dir
+
+
+def _bake_builder_run(cmd, sandbox: Sandbox, gallery: Gallery, image: Image, builder: Builder, output_dir: Path,
+                      storage_dir: Path = None, run_packer: bool = True, status_token: str = None,
+                      choco_cache_dir: Path = None):
+    manifest = output_dir / STATUS_MANIFEST_FILE if storage_dir else None
+    timeline = output_dir / STATUS_TIMELINE_FILE if storage_dir else None
+
+    status = BuildStatus(image.name, image.version, manifest=manifest, timeline=timeline)
+    handler = attach_status_log_handler(status)
+
+    # the builder only serves its status when the deployment gave it a token (builder.status in bake.yml)
+    if status_token:
+        start_status_server(status, token=status_token)
+
+    # compress or delete the output of previous runs in the background while this one builds
+    if storage_dir and builder and builder.retention:
+        start_local_retention(storage_dir, builder.retention, exclude=output_dir.name)
+
+    try:
+        success = _bake_builder_build(cmd, sandbox, gallery, image, builder, status, output_dir, run_packer,
+                                      choco_cache_dir)
+    except BaseException:
+        status.finish('failed')
+        raise
+    finally:
+        # builds run in the same process (i.e. image build --local) each add their own handler
+        detach_status_log_handler(handler)
+
+    status.finish('succeeded')
+    return success, status
+
+
+def _bake_builder_build(cmd, sandbox: Sandbox, gallery: Gallery, image: Image, builder: Builder,
+                        status: BuildStatus, output_dir: Path = OUTPUT_DIR, run_packer: bool = IN_BUILDER,
+                        choco_cache_dir: Path = None):
+
+    status.start_phase('login')
 
     if IN_BUILDER:
         from azure.cli.command_modules.profile.custom import login
@@ -412,61 +720,246 @@ def bake_builder_build(cmd, sandbox: Sandbox = None, gallery: Gallery = None, im
     else:
         logger.info('Not in builder. Skipping login.')
 
+    status.start_phase('gallery')
+
     gallery_res = get_gallery(cmd, gallery.resource_group, gallery.name)
     if not gallery_res:
         raise CLIError(f'Could not find gallery {gallery.name} in resource group {gallery.resource_group}')
 
-    definition = get_image_definition(cmd, gallery.resource_group, gallery.name, image.name)
-    if not definition:
-        logger.info(f'Image definition {image.name} does not exist. Creating...')
-        definition = create_image_definition(cmd, gallery.resource_group, gallery.name, image.name,
-                                             image.publisher, image.offer, image.sku, gallery_res.location)
-    elif image_version_exists(cmd, gallery.resource_group, gallery.name, image.name, image.version):
-        raise CLIError('Image version already exists')
+    # variants are published to their own image definitions
+    definitions = [(image.name, image.sku, None)] + [(v.definition, v.sku, v.description) for v in image.variants]
+
+    for definition_name, sku, description in definitions:
+        definition = get_image_definition(cmd, gallery.resource_group, gallery.name, definition_name)
+        if not definition:
+            logger.info(f'Image definition {definition_name} does not exist. Creating...')
+            create_image_definition(cmd, gallery.resource_group, gallery.name, definition_name, image.publisher,
+                                    image.offer, sku, gallery_res.location, description=description)
+        elif image_version_exists(cmd, gallery.resource_group, gallery.name, definition_name, image.version):
+            raise CLIError(f'Image version {image.version} of {definition_name} already exists')
 
     logger.info(f'Image version {image.version} does not exist.')
 
+    status.start_phase('generate')
+
+    source_version = None
+    latest = None
+    version_tags = None
+    # the build runs in one stage (packer build) unless the image has checkpoints
+    stages = [BuildStage()]
+
     if copy_packer_files(image.dir):
-        if image.update:
-            inject_update_provisioner(image.dir)
+        # an existing variable.pkr.hcl is kept, so it may not declare everything the copied build.pkr.hcl uses
+        missing = get_missing_packer_vars(image, (image.dir / PKR_BUILD_FILE).read_text(encoding='utf-8'))
+        if missing:
+            raise ValidationError(f'The packer variables of {image.name} are missing {", ".join(missing)}, which '
+                                  f'{PKR_BUILD_FILE} uses. Update {PKR_VARS_FILE} from the bake templates')
 
         powershell_scripts = get_install_powershell_scripts(image)
-        if powershell_scripts:
-            inject_powershell_provisioner(image.dir, powershell_scripts)
-
-        choco_packages = get_install_choco_packages(image)
+        variant_scripts = get_variant_powershell_scripts(image)
 
+        choco_packages = get_install_choco_packages(image) or []
+        choco_packages, choco_files = apply_choco_cache(choco_packages, choco_cache_dir)
         user_choco_packages = [package for package in choco_packages if package.user]
-        if user_choco_packages:
-            choco_user_config = get_choco_package_config(user_choco_packages)
-            inject_choco_provisioners(image.dir, choco_user_config, for_user=True)
-
         machine_choco_packages = [package for package in choco_packages if not package.user]
-        if machine_choco_packages:
-            machine_choco_config = get_choco_package_config(machine_choco_packages)
-            inject_choco_provisioners(image.dir, machine_choco_config, for_user=False)
-
-        # winget_config = get_install_winget(image)
-        # if winget_config:
-        #     inject_winget_provisioners(image.dir, winget_config)
-
-    save_packer_vars_file(sandbox, gallery, image)
+        choco_configs = {
+            'user': get_choco_package_config(user_choco_packages) if user_choco_packages else None,
+            'machine': get_choco_package_config(machine_choco_packages) if machine_choco_packages else None
+        }
 
-    copy_to_builder_output_dir(image.dir)
+        winget_packages = get_install_winget(image)
+
+        if image.incremental and image.variants:
+            # only the image's own versions are tagged with install steps, the variants' bases aren't tracked
+            logger.warning(f'Building {image.name} from the base image: images with variants are always full builds')
+        elif image.incremental:
+            steps = get_install_steps(image, powershell_scripts, choco_configs, winget_packages)
+            latest = get_latest_image_version(cmd, gallery.resource_group, gallery.name, image.name)
+            source_version, changed, reason = plan_incremental_build(image, latest, steps, sandbox.location)
+            if source_version:
+                logger.warning(f'Building {image.name} incrementally from version {source_version}: {reason}')
+                powershell_scripts, choco_configs, winget_packages = filter_install_steps(
+                    image, powershell_scripts, choco_configs, winget_packages, changed)
+            else:
+                logger.warning(f'Building {image.name} from the base image: {reason}')
+            version_tags = get_version_tags(image, steps, get_full_build_time(latest if source_version else None))
+
+        if powershell_scripts and image.install.scripts.coalesce_restarts:
+            powershell_scripts, report = schedule_powershell_scripts(powershell_scripts)
+            logger.warning(f'Scheduled {image.name} install scripts with {report["restartsAfter"]} restarts instead of '
+                           f'{report["restartsBefore"]}, saving at least {report["minutesSaved"]} minutes')
+
+        winget_config, winget_imported, winget_installed = None, [], winget_packages or []
+        if winget_packages and image.install.winget.mode == 'import':
+            winget_config, winget_imported, winget_installed = get_winget_import_config(winget_packages)
+
+        if image.update and image.update.skip_if_base_newer_than_days:
+            published = _get_base_image_published(cmd, image, sandbox.location, latest if source_version else None)
+        else:
+            published = None
+        update, update_reason = plan_windows_update(image, published)
+        status.set_update(update, update_reason)
+
+        if not update and image.update:
+            logger.warning(f'Skipping windows updates for {image.name}: {update_reason}')
+
+        stages = [BuildStage(source_version=source_version)]
+        if image.checkpoints:
+            stages = _plan_build_stages(cmd, gallery, gallery_res.location, sandbox, image, status, powershell_scripts,
+                                        choco_configs, winget_packages, update, source_version)
+
+        # upload the scripts and install configs to the build vm in one archive instead of one transfer per file
+        bundled = bool(powershell_scripts or variant_scripts or any(choco_configs.values()) or winget_config)
+        if bundled:
+            # the variant scripts are bundled after the image's scripts
+            powershell_scripts = powershell_scripts or []
+            bundled_scripts = iter(bundle_install_files(
+                image.dir, powershell_scripts + [s for scripts in variant_scripts.values() for s in scripts], {
+                    CHOCO_PACKAGES_USER_CONFIG_FILE: choco_configs['user'],
+                    CHOCO_PACKAGES_CONFIG_FILE: choco_configs['machine'],
+                    WINGET_IMPORT_FILE: winget_config,
+                    **choco_files
+                }))
+            powershell_scripts = [next(bundled_scripts) for _ in powershell_scripts]
+            variant_scripts = {name: [next(bundled_scripts) for _ in scripts]
+                               for name, scripts in variant_scripts.items()}
+
+        # the provisioners are generated in memory and each stage's build file is written before it runs
+        template = (image.dir / PKR_BUILD_FILE).read_text(encoding='utf-8')
+        for stage in stages:
+            # checkpoints are of the image itself, so the variants are only built (and published) by the last stage
+            last = stage is stages[-1]
+            stage.build_file = get_build_file(
+                template, stage.get_scripts(powershell_scripts), choco_configs if stage.choco else None,
+                winget_imported if stage.winget else None, winget_installed if stage.winget else None,
+                update=image.update if update and stage.update else None, bundled=bundled, output_dir=output_dir,
+                variants=image.variants if last else None, variant_scripts=variant_scripts if last else None)
+
+    for stage in stages:
+        if stage.build_file:
+            stage.build_file.save(image.dir)
+            logger.info(f'Generated {PKR_BUILD_FILE} for {image.name} (fingerprint {stage.build_file.fingerprint()})')
+
+        # the stages before a checkpoint are published to the checkpoint image definition
+        stage_image = get_checkpoint_image(image, stage.version) if stage.checkpoint else image
+        save_packer_vars_file(sandbox, gallery, stage_image, {'sourceVersion': stage.source_version,
+                                                              'sourceImage': stage.source_image})
+
+        if builder and builder.output == 'archive':
+            archive_to_builder_output_dir(image.dir, output_dir)
+        else:
+            copy_to_builder_output_dir(image.dir, output_dir)
 
-    success = packer_execute(image) if IN_BUILDER else 0
+        success = packer_execute(image, status) if run_packer else 0
 
-    if success == 0:
-        logger.info('Packer build succeeded')
-    else:
-        raise CLIError('Packer build failed')
+        if success == 0:
+            logger.info('Packer build succeeded')
+        else:
+            raise CLIError('Packer build failed')
+
+        if run_packer and stage.checkpoint:
+            _save_checkpoint(cmd, gallery, image, stage, status)
+
+    if run_packer and status.update and status.update['installed']:
+        update_status = status.to_dict()['update']
+        logger.warning(f'Installed {update_status["updates"]} windows updates in '
+                       f'{round(update_status["elapsed"] / 60, 1)} minutes')
+
+    # images used to be captured to a managed image before being published to the gallery, remove the managed
+    # image left behind by those builds now the image is published directly (if packer captured it in the sandbox)
+    if run_packer and not image.publish.managed_image:
+        status.start_phase('cleanup')
+        delete_managed_image(cmd, gallery.resource_group, image.name, sandbox.resource_group)
+
+    # the build succeeded, so its checkpoints (and those of earlier failed builds) aren't needed anymore
+    if run_packer and image.checkpoints:
+        if status.phase != 'cleanup':
+            status.start_phase('cleanup')
+        definition_name = get_checkpoint_definition_name(image)
+        for version in list_image_versions(cmd, gallery.resource_group, gallery.name, definition_name):
+            if delete_image_version(cmd, gallery.resource_group, gallery.name, definition_name, version.name):
+                status.set_checkpoint(version.name, (version.tags or {}).get(CHECKPOINT_AFTER_TAG), 'deleted')
+
+    # the version was only published to the build region, replicate it to the other regions in the background.
+    # packer publishes replicaCount replicas in every region, so the regionReplicaCounts are set here too
+    if run_packer and (image.publish.replication == 'deferred' or image.publish.region_replica_counts):
+        for definition_name, _, _ in definitions:
+            try:
+                replicate_image_version(cmd, gallery.resource_group, gallery.name, definition_name, image.version,
+                                        image.replica_locations, image.publish.region_replica_counts)
+            except HttpResponseError as e:
+                logger.warning(f'Unable to start replicating version {image.version} of {definition_name}, '
+                               f'use az bake image replicate to replicate it: {e.message}')
+
+    # record the install steps on the new version so the next incremental build can skip unchanged steps
+    if run_packer and version_tags:
+        try:
+            tag_image_version(cmd, gallery.resource_group, gallery.name, image.name, image.version, version_tags,
+                              subscription=gallery.subscription)
+        except HttpResponseError as e:
+            logger.warning(f'Unable to tag version {image.version} of {image.name}, '
+                           f'the next incremental build will be a full build: {e.message}')
 
     return success
 
 
-# ----------------
-# _private
-# ----------------
+def _plan_build_stages(cmd, gallery: Gallery, location: str, sandbox: Sandbox, image: Image, status: BuildStatus,
+                       powershell_scripts, choco_configs, winget_packages, update: bool, source_version=None):
+    '''Splits the build into stages at the image's checkpoints and skips the stages of the latest valid checkpoint
+    left by a failed build'''
+    stages = plan_build_stages(image, powershell_scripts, choco_configs, winget_packages, update, source_version)
+    if len(stages) == 1:
+        return stages
+
+    definition_name = get_checkpoint_definition_name(image)
+    if not get_image_definition(cmd, gallery.resource_group, gallery.name, definition_name):
+        logger.info(f'Image definition {definition_name} does not exist. Creating...')
+        create_image_definition(cmd, gallery.resource_group, gallery.name, definition_name, image.publisher,
+                                image.offer, f'{image.sku}-checkpoints', location,
+                                description=f'Checkpoints of {image.name} builds, deleted when a build succeeds')
+
+    versions = list_image_versions(cmd, gallery.resource_group, gallery.name, definition_name)
+    index, checkpoint = find_checkpoint(image, stages, versions, sandbox.location)
+    if not checkpoint:
+        logger.warning(f'Building {image.name} in {len(stages)} stages with checkpoints after: '
+                       f'{", ".join(s.after for s in stages if s.after)}')
+        return stages
+
+    logger.warning(f'Resuming {image.name} from checkpoint {checkpoint.name} taken after {stages[index].after}')
+    status.set_checkpoint(checkpoint.name, stages[index].after, 'resumed')
+    return resume_build_stages(image, stages, index, checkpoint)
+
+
+def _save_checkpoint(cmd, gallery: Gallery, image: Image, stage: BuildStage, status: BuildStatus):
+    '''Tags the checkpoint version packer published with the hash of its install steps so failed builds can resume
+    from it'''
+    definition_name = get_checkpoint_definition_name(image)
+    try:
+        tag_image_version(cmd, gallery.resource_group, gallery.name, definition_name, stage.version,
+                          get_checkpoint_tags(stage), subscription=gallery.subscription)
+    except HttpResponseError as e:
+        logger.warning(f'Unable to tag checkpoint {stage.version} of {image.name}, '
+                       f'a failed build will not resume from it: {e.message}')
+        return
+    logger.warning(f'Saved checkpoint {stage.version} of {image.name} after {stage.after}')
+    status.set_checkpoint(stage.version, stage.after, 'created')
+
+
+def _get_base_image_published(cmd, image: Image, location: str, source_version=None):
+    '''Gets when the image the build starts from was published, the source version of an incremental build or the
+    marketplace base image (from the date in windows version names). Returns None if it isn't known'''
+    if source_version is not None:
+        return source_version.publishing_profile.published_date
+    if not location:
+        return None
+    try:
+        version = get_marketplace_image_version(cmd, location, image.base.publisher, image.base.offer,
+                                                image.base.sku, image.base.version)
+    except HttpResponseError as e:
+        logger.warning(f'Unable to get the base image version of {image.name}: {e.message}')
+        return None
+    return get_marketplace_version_date(version)
+
 
 def _bake_yaml_export(sandbox: Sandbox = None, gallery: Gallery = None, images: Sequence[Image] = None,
                       outfile=None, outdir=None, stdout=False):
@@ -0,0 +1,59 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+# Runs a group of install scripts in parallel as background jobs (injected by az bake for image.yml script groups).
+# Writes the output and duration of each script as it finishes and stops the remaining scripts when one fails.
+
+param(
+    [Parameter(Mandatory = $true)]
+    [string[]] $Scripts
+)
+
+$jobs = foreach ($script in $Scripts) {
+    Start-Job -Name (Split-Path $script -Leaf) -ArgumentList $script -ScriptBlock {
+        param($path)
+        & $path
+        if ($LASTEXITCODE) { throw "$path exited with code $LASTEXITCODE" }
+    }
+}
+
+function Write-JobOutput($job) {
+    Receive-Job -Job $job -ErrorAction Continue *>&1 | ForEach-Object { Write-Host "[$($job.Name)] $_" }
+}
+
+$pending = @($jobs)
+$failed = $null
+
+while ($pending.Count -gt 0) {
+    $job = Wait-Job -Job $pending -Any
+    $pending = @($pending | Where-Object { $_.Id -ne $job.Id })
+    $seconds = [int]($job.PSEndTime - $job.PSBeginTime).TotalSeconds
+
+    Write-JobOutput $job
+    Write-Host "--- $($job.Name): $($job.State.ToString().ToLower()) in $seconds seconds"
+
+    if ($job.State -ne 'Completed') {
+        $failed = $job
+        break
+    }
+}
+
+if ($failed) {
+    if ($pending.Count -gt 0) {
+        # write the output of the scripts still running so it's in the build log, then what they wrote while stopping
+        foreach ($job in $pending) {
+            Write-JobOutput $job
+            Stop-Job -Job $job
+            Write-JobOutput $job
+            Write-Host "--- $($job.Name): stopped"
+        }
+        Write-Host "--- Stopped $($pending.Count) scripts because $($failed.Name) failed"
+    }
+    $jobs | Remove-Job -Force
+    exit 1
+}
+
+$jobs | Remove-Job
+exit 0
@@ -1,5 +1,12 @@
 packer {
   required_plugins {
+    # https://github.com/hashicorp/packer-plugin-azure
+    # capturing the build vm directly into a gallery version (managed_image_* = null) needs a recent plugin,
+    # 1.3.1 is the release the template was built and tested against
+    azure = {
+      version = ">= 1.3.1"
+      source  = "github.com/hashicorp/azure"
+    }
     # https://github.com/rgl/packer-plugin-windows-update
     windows-update = {
       version = "0.14.1"
@@ -13,22 +20,37 @@ source "azure-arm" "vm" {
   skip_create_image                = false
   user_assigned_managed_identities = [var.sandbox.identityId] # optional
   async_resourcegroup_delete       = true
-  vm_size                          = "Standard_D8s_v3" # default is Standard_A1
+  # build vm options (azure can't capture an image from a vm with an ephemeral os disk, so it isn't an option)
+  vm_size                            = var.image.vm.size         # default: "Standard_D8s_v3"
+  managed_image_storage_account_type = var.image.vm.osDiskType   # default: "Standard_LRS" (also the build vm's os disk type)
+  os_disk_size_gb                    = var.image.vm.osDiskSizeGb # default: 0 (the base image's os disk size)
+  disk_caching_type                  = var.image.vm.diskCaching  # default: "ReadWrite"
   # winrm options
   communicator   = "winrm"
   winrm_username = "packer"
   winrm_insecure = true
   winrm_use_ssl  = true
   os_type        = var.image.os # default: "Windows" (tells packer to create a certificate for WinRM connection)
-  # base image options (Azure Marketplace Images only)
-  image_publisher    = var.image.base.publisher # default: "microsoftwindowsdesktop"
-  image_offer        = var.image.base.offer     # default: "windows-ent-cpc"
-  image_sku          = var.image.base.sku       # default: "win11-22h2-ent-cpc-m365"
-  image_version      = var.image.base.version   # default: "latest"
+  # base image options (Azure Marketplace Images only), not used by incremental builds
+  image_publisher    = var.sourceVersion == "" ? var.image.base.publisher : null # default: "microsoftwindowsdesktop"
+  image_offer        = var.sourceVersion == "" ? var.image.base.offer : null     # default: "windows-ent-cpc"
+  image_sku          = var.sourceVersion == "" ? var.image.base.sku : null       # default: "win11-22h2-ent-cpc-m365"
+  image_version      = var.sourceVersion == "" ? var.image.base.version : null   # default: "latest"
   use_azure_cli_auth = true
-  # managed image options
-  managed_image_name                = var.image.name
-  managed_image_resource_group_name = var.gallery.resourceGroup
+  # incremental builds start from the image's latest gallery version, resumed builds from a checkpoint version
+  dynamic "shared_image_gallery" {
+    for_each = var.sourceVersion == "" ? [] : [var.sourceVersion]
+    content {
+      subscription   = var.gallery.subscription
+      resource_group = var.gallery.resourceGroup
+      gallery_name   = var.gallery.name
+      image_name     = var.sourceImage == "" ? var.image.name : var.sourceImage
+      image_version  = shared_image_gallery.value
+    }
+  }
+  # managed image options (by default the image is captured directly into the gallery version)
+  managed_image_name                = var.image.publish.managedImage ? var.image.name : null
+  managed_image_resource_group_name = var.image.publish.managedImage ? var.gallery.resourceGroup : null
   # packer creates a temporary resource group
   subscription_id = var.sandbox.subscription
   # location                 = var.location
@@ -41,14 +63,16 @@ source "azure-arm" "vm" {
   virtual_network_name                = var.sandbox.virtualNetwork
   virtual_network_subnet_name         = var.sandbox.defaultSubnet
   virtual_network_resource_group_name = var.sandbox.virtualNetworkResourceGroup
+  # replicas per region (az bake sets the publish.regionReplicaCounts after the build)
+  shared_image_gallery_replica_count = var.image.publish.replicaCount # default: 1
   shared_image_gallery_destination {
     subscription         = var.gallery.subscription
     gallery_name         = var.gallery.name
     resource_group       = var.gallery.resourceGroup
     image_name           = var.image.name
     image_version        = var.image.version
-    replication_regions  = var.image.replicaLocations
-    storage_account_type = "Standard_LRS" # default is Standard_LRS
+    replication_regions  = var.image.publish.replication == "deferred" ? [] : var.image.replicaLocations # the build region is always included
+    storage_account_type = var.image.publish.storageAccountType # default: "Standard_LRS"
   }
 }
 
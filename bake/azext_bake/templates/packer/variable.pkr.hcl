@@ -50,6 +50,19 @@ variable "image" {
       sku       = string
       version   = string
     })
+    vm = object({
+      size         = string
+      osDiskType   = string
+      osDiskSizeGb = number
+      diskCaching  = string
+    })
+    publish = object({
+      managedImage        = bool
+      replication         = string
+      storageAccountType  = string
+      replicaCount        = number
+      regionReplicaCounts = map(number)
+    })
   })
   default = {
     name             = ""
@@ -62,10 +75,35 @@ variable "image" {
       sku       = "win11-22h2-ent-cpc-m365"
       version   = "latest"
     }
+    vm = {
+      size         = "Standard_D8s_v3"
+      osDiskType   = "Standard_LRS"
+      osDiskSizeGb = 0
+      diskCaching  = "ReadWrite"
+    }
+    publish = {
+      managedImage        = false
+      replication         = "inline"
+      storageAccountType  = "Standard_LRS"
+      replicaCount        = 1
+      regionReplicaCounts = {}
+    }
   }
   description = "The azure compute image to publish"
 }
 
+variable "sourceVersion" {
+  type        = string
+  default     = ""
+  description = "The gallery image version to start an incremental build from, or empty to start from the base image"
+}
+
+variable "sourceImage" {
+  type        = string
+  default     = ""
+  description = "The gallery image definition of the sourceVersion (i.e. a checkpoint), or empty for the image's definition"
+}
+
 variable "repos" {
   type = list(object({
     url    = string
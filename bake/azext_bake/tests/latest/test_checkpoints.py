@@ -0,0 +1,140 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+from azext_bake._checkpoints import (CHECKPOINT_TAG, find_checkpoint, get_checkpoint_tags, plan_build_stages,
+                                     resume_build_stages)
+from azext_bake._data import Image
+from azext_bake._utils import get_install_powershell_scripts, get_install_winget
+
+NOW = datetime(2022, 11, 30, 12, 0, 0, tzinfo=timezone.utc)
+CHOCO_CONFIGS = {'machine': '<packages />', 'user': None}
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp(prefix='bake-test-'))
+        self.image_dir = self.root / 'images' / 'MyImage'
+        (self.image_dir / 'scripts').mkdir(parents=True)
+        for name in ['A', 'B', 'C']:
+            (self.image_dir / 'scripts' / f'Install-{name}.ps1').write_text(f'Write-Host {name}', encoding='utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _image(self, after, **kwargs):
+        obj = {
+            'publisher': 'Contoso', 'offer': 'DevBox', 'sku': 'MyImage', 'version': '1.0.0', 'os': 'Windows',
+            'replicaLocations': ['eastus'], 'checkpoints': {'after': after, 'maxAgeDays': 7},
+            'install': {
+                'scripts': {'powershell': ['scripts/Install-A.ps1', 'scripts/Install-B.ps1', 'scripts/Install-C.ps1']},
+                'choco': {'packages': ['git']},
+                'winget': {'packages': ['Git.Git']}
+            }
+        }
+        obj.update(kwargs)
+        return Image(obj, self.image_dir / 'image.yml')
+
+    def _stages(self, image, update=True, source_version=None):
+        return plan_build_stages(image, get_install_powershell_scripts(image), CHOCO_CONFIGS, get_install_winget(image),
+                                 update=update, source_version=source_version, now=NOW)
+
+    @staticmethod
+    def _version(stage, name='1.221130.120000', days_ago=1, state='Succeeded', regions=None):
+        return SimpleNamespace(name=name, tags=get_checkpoint_tags(stage), provisioning_state=state,
+                               publishing_profile=SimpleNamespace(
+                                   published_date=NOW - timedelta(days=days_ago),
+                                   target_regions=[SimpleNamespace(name=r) for r in regions or ['East US']]))
+
+    def test_stages(self):
+        image = self._image(['update', 'scripts/Install-B.ps1', 'choco'])
+        stages = self._stages(image)
+
+        self.assertEqual(len(stages), 4)
+        self.assertEqual([s.after for s in stages], ['update', 'scripts/Install-B.ps1', 'choco', None])
+        self.assertEqual([(s.update, s.choco, s.winget) for s in stages],
+                         [(True, False, False), (False, False, False), (False, True, False), (False, False, True)])
+        self.assertEqual([(s.scripts_start, s.scripts_end) for s in stages], [(0, 0), (0, 2), (2, 3), (3, 3)])
+        self.assertEqual([s.version for s in stages], ['1.221130.120000', '2.221130.120000', '3.221130.120000', None])
+
+        # each stage starts from the previous stage's checkpoint
+        self.assertEqual([s.source_version for s in stages], [None] + [s.version for s in stages[:-1]])
+        self.assertEqual([s.source_image for s in stages], [None] + ['MyImage-checkpoints'] * 3)
+
+        scripts = get_install_powershell_scripts(image)
+        self.assertEqual([len(s.get_scripts(scripts)) for s in stages], [0, 2, 1, 0])
+
+    def test_no_checkpoint_after_last_step(self):
+        # the build publishes the image after the last step, so it doesn't need a checkpoint
+        stages = self._stages(self._image(['winget']))
+        self.assertEqual(len(stages), 1)
+        self.assertIsNone(stages[0].checkpoint)
+
+    def test_skipped_step(self):
+        # there's no checkpoint after updates when they don't run
+        stages = self._stages(self._image(['update', 'choco']), update=False)
+        self.assertEqual([s.after for s in stages], ['choco', None])
+
+    def test_checkpoint_hashes(self):
+        image = self._image(['scripts/Install-A.ps1', 'choco'])
+        first = self._stages(image)
+
+        self.assertEqual([s.checkpoint for s in first], [s.checkpoint for s in self._stages(image)])
+
+        # changing a step changes the checkpoints after it, not the ones before
+        (self.image_dir / 'scripts' / 'Install-B.ps1').write_text('Write-Host B2', encoding='utf-8')
+        changed = self._stages(image)
+        self.assertEqual(first[0].checkpoint, changed[0].checkpoint)
+        self.assertNotEqual(first[1].checkpoint, changed[1].checkpoint)
+
+        # and so does the version an incremental build starts from
+        incremental = self._stages(image, source_version='1.0.0')
+        self.assertNotEqual(changed[0].checkpoint, incremental[0].checkpoint)
+        self.assertEqual(incremental[0].source_image, 'MyImage')
+
+    def test_find_checkpoint(self):
+        image = self._image(['update', 'scripts/Install-B.ps1', 'choco'])
+        stages = self._stages(image)
+
+        self.assertEqual(find_checkpoint(image, stages, [], 'eastus', now=NOW), (-1, None))
+
+        first, second = self._version(stages[0], '1.0.1'), self._version(stages[1], '2.0.1')
+        index, version = find_checkpoint(image, stages, [first, second], 'eastus', now=NOW)
+        # the latest stage with a checkpoint
+        self.assertEqual((index, version), (1, second))
+
+        remaining = resume_build_stages(image, stages, index, version)
+        self.assertEqual([s.after for s in remaining], ['choco', None])
+        self.assertEqual((remaining[0].source_image, remaining[0].source_version), ('MyImage-checkpoints', '2.0.1'))
+
+    def test_find_checkpoint_ignores_invalid(self):
+        image = self._image(['update', 'choco'])
+        stages = self._stages(image)
+
+        invalid = [
+            self._version(stages[0], state='Failed'),
+            self._version(stages[0], days_ago=7),
+            self._version(stages[0], regions=['West US']),
+            SimpleNamespace(name='1.0.0', tags={}, provisioning_state='Succeeded', publishing_profile=None)
+        ]
+        for version in invalid:
+            self.assertEqual(find_checkpoint(image, stages, [version], 'eastus', now=NOW), (-1, None))
+
+        # a checkpoint of different install steps
+        other = self._version(stages[0])
+        other.tags = {**other.tags, CHECKPOINT_TAG: 'other'}
+        self.assertEqual(find_checkpoint(image, stages, [other], 'eastus', now=NOW), (-1, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
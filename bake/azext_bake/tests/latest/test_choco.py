@@ -0,0 +1,77 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import io
+import unittest
+import zipfile
+
+from azure.cli.core.azclierror import FileOperationError
+
+from azext_bake._choco import find_cached_version, get_nupkg_name, read_nuspec
+
+NUSPEC = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://schemas.microsoft.com/packaging/2015/06/nuspec.xsd">
+  <metadata>
+    <id>git</id>
+    <version>2.39.0</version>
+    <dependencies>
+      <dependency id="git.install" version="[2.39.0]" />
+      <dependency id="chocolatey-core.extension" version="1.3.3" />
+    </dependencies>
+  </metadata>
+</package>
+'''
+
+
+def _nupkg(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as nupkg:
+        for name, content in files.items():
+            nupkg.writestr(name, content)
+    return data.getvalue()
+
+
+class FindCachedVersionTests(unittest.TestCase):
+
+    NAMES = ['git.2.39.0.nupkg', 'git.2.9.1.nupkg', 'git.2.40.0-rc1.nupkg', 'git.install.2.41.0.nupkg',
+             'git.2.38.0.nuspec', 'googlechrome.108.0.5359.125.nupkg']
+
+    def test_exact_version(self):
+        self.assertEqual(find_cached_version(self.NAMES, 'git', '2.9.1'), '2.9.1')
+        self.assertIsNone(find_cached_version(self.NAMES, 'git', '2.38.0'))
+
+    def test_latest_version(self):
+        # versions are compared by number (2.40 > 2.39 > 2.9), ids that start with the id (git.install) are ignored
+        self.assertEqual(find_cached_version(self.NAMES, 'git'), '2.40.0-rc1')
+        self.assertEqual(find_cached_version(self.NAMES, 'git.install'), '2.41.0')
+        self.assertEqual(find_cached_version(self.NAMES, 'googlechrome'), '108.0.5359.125')
+
+    def test_ids_are_case_insensitive(self):
+        self.assertEqual(find_cached_version([get_nupkg_name('Git.Install', '2.41.0')], 'Git.Install'), '2.41.0')
+
+    def test_not_cached(self):
+        self.assertIsNone(find_cached_version(self.NAMES, 'vscode'))
+        self.assertIsNone(find_cached_version([], 'git'))
+
+
+class ReadNuspecTests(unittest.TestCase):
+
+    def test_read_nuspec(self):
+        package_id, version, dependencies = read_nuspec(_nupkg({'git.nuspec': NUSPEC, 'tools/install.ps1': ''}))
+        self.assertEqual((package_id, version), ('git', '2.39.0'))
+        self.assertEqual(dependencies, [('git.install', '[2.39.0]'), ('chocolatey-core.extension', '1.3.3')])
+
+    def test_without_namespace_or_dependencies(self):
+        nuspec = '<package><metadata><id> vscode </id><version>1.74.2</version></metadata></package>'
+        self.assertEqual(read_nuspec(_nupkg({'vscode.nuspec': nuspec})), ('vscode', '1.74.2', []))
+
+    def test_missing_nuspec(self):
+        # only the nuspec in the root of the package is read
+        with self.assertRaises(FileOperationError):
+            read_nuspec(_nupkg({'tools/git.nuspec': NUSPEC}))
+
+
+if __name__ == '__main__':
+    unittest.main()
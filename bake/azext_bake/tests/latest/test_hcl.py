@@ -0,0 +1,142 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import unittest
+
+from azure.cli.core.azclierror import ValidationError
+
+from azext_bake._hcl import PackerBuildFile, Provisioner, Raw, hcl_string
+
+TEMPLATE = '''source "azure-arm" "vm" {
+  # base image
+  image_sku  = var.image.base.sku # the sku
+  image_name = var.image.name
+  image_tags = var.image.name_tags
+}
+
+build {
+  sources = ["source.azure-arm.vm"]
+
+  provisioner "windows-restart" {
+    restart_timeout = "30m"
+  }
+  ###BAKE###
+
+  provisioner "powershell" {
+    inline = ["Write-Host 'done'"]
+  }
+}
+'''
+
+
+class PackerBuildFileTests(unittest.TestCase):
+
+    def test_render_without_changes(self):
+        build = PackerBuildFile(TEMPLATE)
+        rendered = build.render()
+        self.assertNotIn('###BAKE###', rendered)
+        self.assertEqual(rendered, TEMPLATE.replace('  ###BAKE###\n', '\n'))
+
+    def test_render_provisioners(self):
+        build = PackerBuildFile(TEMPLATE)
+        build.add(Provisioner('powershell', {'elevated_user': Raw('build.User'), 'inline': ['a', 'b'],
+                                             'only': None}),
+                  Provisioner('windows-update', {'update_limit': 5, 'filters': None}, comments=['updates']))
+        rendered = build.render()
+
+        expected = '''
+  # Injected by az bake
+  provisioner "powershell" {
+    elevated_user = build.User
+    inline = [
+      "a",
+      "b"
+    ]
+  }
+
+  # Injected by az bake
+  # updates
+  provisioner "windows-update" {
+    update_limit = 5
+  }
+'''
+        self.assertIn(expected, rendered)
+        # the provisioners are injected where the placeholder was, before the template's last provisioner
+        self.assertLess(rendered.index('windows-update'), rendered.index("Write-Host 'done'"))
+        # attributes set to None are left out
+        self.assertNotIn('only', rendered)
+        self.assertNotIn('filters', rendered)
+
+    def test_render_is_deterministic(self):
+        first, second = PackerBuildFile(TEMPLATE), PackerBuildFile(TEMPLATE)
+        for build in [first, second]:
+            build.add(Provisioner('powershell', {'inline': ['a']}))
+        self.assertEqual(first.render(), second.render())
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+
+        # the files the build uploads are part of the fingerprint
+        second.files['packages.config'] = '<packages />'
+        self.assertNotEqual(first.fingerprint(), second.fingerprint())
+
+    def test_missing_placeholder(self):
+        with self.assertRaises(ValidationError):
+            PackerBuildFile(TEMPLATE.replace('###BAKE###', ''))
+
+    def test_add_source(self):
+        build = PackerBuildFile(TEMPLATE)
+        build.add_source('azure-arm.vm', 'pro', {'var.image.name': 'MyImage-pro', 'var.image.base.sku': 'pro-sku'})
+        rendered = build.render()
+
+        self.assertIn('sources = ["source.azure-arm.vm", "source.azure-arm.pro"]', rendered)
+        self.assertEqual(rendered.count('source "azure-arm" "vm" {'), 1)
+
+        copy = rendered[rendered.index('source "azure-arm" "pro" {'):rendered.index('build {')]
+        self.assertIn('# Injected by az bake', rendered[:rendered.index('source "azure-arm" "pro" {')])
+        # the expressions are replaced, comments are kept
+        self.assertIn('image_sku  = "pro-sku" # the sku', copy)
+        self.assertIn('image_name = "MyImage-pro"', copy)
+        self.assertIn('# base image', copy)
+        # only whole expressions are replaced (not var.image.name_tags)
+        self.assertIn('image_tags = var.image.name_tags', copy)
+
+        # the original source is unchanged
+        original = rendered[:rendered.index('# Injected by az bake')]
+        self.assertIn('image_name = var.image.name\n', original)
+
+    def test_add_source_replacement_is_escaped(self):
+        build = PackerBuildFile(TEMPLATE)
+        build.add_source('azure-arm.vm', 'pro', {'var.image.name': 'My "${image}"'})
+        self.assertIn('image_name = "My \\"$${image}\\""', build.render())
+
+    def test_add_source_errors(self):
+        build = PackerBuildFile(TEMPLATE)
+        build.add_source('azure-arm.vm', 'vm')
+        with self.assertRaisesRegex(ValidationError, 'already has a source'):
+            build.render()
+
+        build = PackerBuildFile(TEMPLATE)
+        build.add_source('azure-arm.vm', 'pro')
+        build.add_source('azure-arm.vm', 'pro')
+        with self.assertRaisesRegex(ValidationError, 'already has a source'):
+            build.render()
+
+        build = PackerBuildFile(TEMPLATE)
+        build.add_source('azure-arm.other', 'pro')
+        with self.assertRaisesRegex(ValidationError, 'Could not find source'):
+            build.render()
+
+    def test_add_source_ignores_comments(self):
+        # a commented out source with the same name isn't a conflict
+        build = PackerBuildFile('# source "azure-arm" "pro" {}\n' + TEMPLATE)
+        build.add_source('azure-arm.vm', 'pro')
+        self.assertIn('source "azure-arm" "pro" {\n', build.render())
+
+    def test_hcl_string(self):
+        self.assertEqual(hcl_string('C:\\Temp'), '"C:\\\\Temp"')
+        self.assertEqual(hcl_string('${path.root} %{if}'), '"$${path.root} %%{if}"')
+
+
+if __name__ == '__main__':
+    unittest.main()
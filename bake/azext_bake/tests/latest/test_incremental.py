@@ -0,0 +1,156 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+from azext_bake._data import Image
+from azext_bake._incremental import (INCREMENTAL_BASE_TAG, INCREMENTAL_FULL_BUILD_TAG, filter_install_steps,
+                                     get_install_steps, get_version_tags, plan_incremental_build)
+from azext_bake._utils import get_install_powershell_scripts, get_install_winget
+
+NOW = datetime(2022, 11, 30, 12, 0, 0, tzinfo=timezone.utc)
+
+
+class IncrementalBuildTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp(prefix='bake-test-'))
+        self.image_dir = self.root / 'images' / 'MyImage'
+        (self.image_dir / 'scripts').mkdir(parents=True)
+        (self.root / 'scripts').mkdir()
+        (self.image_dir / 'scripts' / 'Install-A.ps1').write_text('Write-Host a', encoding='utf-8')
+        (self.root / 'scripts' / 'Install-B.ps1').write_text('Write-Host b', encoding='utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _image(self, **kwargs):
+        obj = {
+            'publisher': 'Contoso', 'offer': 'DevBox', 'sku': 'MyImage', 'version': '1.0.0', 'os': 'Windows',
+            'replicaLocations': ['eastus'], 'incremental': {'fullRebuildDays': 30},
+            'install': {
+                'scripts': {'powershell': ['scripts/Install-A.ps1', '../../scripts/Install-B.ps1']},
+                'winget': {'packages': ['Git.Git']}
+            }
+        }
+        obj.update(kwargs)
+        return Image(obj, self.image_dir / 'image.yml')
+
+    def _steps(self, image, choco_configs=None):
+        return get_install_steps(image, get_install_powershell_scripts(image), choco_configs,
+                                 get_install_winget(image))
+
+    @staticmethod
+    def _version(tags, regions=None):
+        return SimpleNamespace(name='1.0.0', tags=tags, publishing_profile=SimpleNamespace(
+            target_regions=[SimpleNamespace(name=r) for r in regions or ['East US']]))
+
+    def _published(self, image, choco_configs=None, days_ago=1):
+        full_build = (NOW - timedelta(days=days_ago)).isoformat(timespec='seconds')
+        return self._version(get_version_tags(image, self._steps(image, choco_configs), full_build))
+
+    def test_install_steps(self):
+        steps = self._steps(self._image(), {'machine': '<packages />', 'user': None})
+        # in build order, scripts outside the image directory are named by their relative path
+        self.assertEqual(list(steps), ['update', 'script:scripts/Install-A.ps1', 'script:../../scripts/Install-B.ps1',
+                                       'choco:machine', 'winget'])
+
+        # without updates there's no update step
+        self.assertNotIn('update', self._steps(self._image(update=False)))
+
+    def test_version_tags(self):
+        image = self._image()
+        tags = get_version_tags(image, self._steps(image), '2022-11-29T12:00:00+00:00')
+        self.assertEqual(tags[INCREMENTAL_FULL_BUILD_TAG], '2022-11-29T12:00:00+00:00')
+        self.assertIn(INCREMENTAL_BASE_TAG, tags)
+        # tag names can't contain slashes
+        self.assertTrue(any(name.endswith('step:script:scripts-Install-A.ps1') for name in tags))
+
+    def test_unchanged(self):
+        image = self._image()
+        source, changed, _ = plan_incremental_build(image, self._published(image), self._steps(image), 'eastus',
+                                                    now=NOW)
+        self.assertEqual(source, '1.0.0')
+        self.assertEqual(changed, [])
+
+    def test_changed_script(self):
+        image = self._image()
+        published = self._published(image)
+        (self.root / 'scripts' / 'Install-B.ps1').write_text('Write-Host b2', encoding='utf-8')
+
+        source, changed, _ = plan_incremental_build(image, published, self._steps(image), 'eastus', now=NOW)
+        self.assertEqual(source, '1.0.0')
+        self.assertEqual(changed, ['script:../../scripts/Install-B.ps1'])
+
+    def test_changed_winget_and_update(self):
+        image = self._image()
+        published = self._published(image)
+        changed_image = self._image(update={'maxUpdates': 10}, install={
+            'scripts': {'powershell': ['scripts/Install-A.ps1', '../../scripts/Install-B.ps1']},
+            'winget': {'packages': ['Git.Git', 'Microsoft.VisualStudioCode']}
+        })
+
+        _, changed, _ = plan_incremental_build(changed_image, published, self._steps(changed_image), 'eastus', now=NOW)
+        self.assertEqual(changed, ['update', 'winget'])
+
+    def test_added_step(self):
+        image = self._image()
+        published = self._published(image)
+        source, changed, _ = plan_incremental_build(image, published, self._steps(image, {'machine': '<packages />'}),
+                                                    'eastus', now=NOW)
+        self.assertEqual(source, '1.0.0')
+        self.assertEqual(changed, ['choco:machine'])
+
+    def test_full_builds(self):
+        image = self._image()
+        steps = self._steps(image)
+
+        def _reason(version, location='eastus', plan_image=image, plan_steps=None):
+            source, changed, reason = plan_incremental_build(plan_image, version, plan_steps or steps, location,
+                                                             now=NOW)
+            self.assertIsNone(source)
+            self.assertEqual(changed, list(plan_steps or steps))
+            return reason
+
+        self.assertIn('no published versions', _reason(None))
+        self.assertIn('not built incrementally', _reason(self._version({})))
+        self.assertIn('40 days ago', _reason(self._published(image, days_ago=40)))
+        self.assertIn('not replicated to westus', _reason(self._published(image), location='westus'))
+
+        based = self._image(base={'publisher': 'p', 'offer': 'o', 'sku': 's', 'version': 'latest'})
+        self.assertIn('base image changed', _reason(self._published(image), plan_image=based,
+                                                    plan_steps=self._steps(based)))
+
+        # installed packages and scripts can't be undone, removing a step (or turning off updates) is a full build
+        published = self._published(image, {'machine': '<packages />'})
+        self.assertIn('removed: choco:machine', _reason(published))
+        no_update = self._image(update=False)
+        self.assertIn('removed: update', _reason(self._published(image), plan_image=no_update,
+                                                 plan_steps=self._steps(no_update)))
+
+    def test_filter_install_steps(self):
+        image = self._image()
+        scripts = get_install_powershell_scripts(image)
+        winget = get_install_winget(image)
+        configs = {'machine': '<packages />', 'user': '<packages user />'}
+
+        filtered, filtered_configs, filtered_winget = filter_install_steps(
+            image, scripts, configs, winget, ['script:scripts/Install-A.ps1', 'choco:user'])
+        self.assertEqual([s.path for s in filtered], [scripts[0].path])
+        self.assertEqual(filtered_configs, {'machine': None, 'user': '<packages user />'})
+        self.assertIsNone(filtered_winget)
+
+        _, _, filtered_winget = filter_install_steps(image, scripts, configs, winget, ['winget'])
+        self.assertEqual(filtered_winget, winget)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+from azext_bake._constants import INSTALL_BUNDLE_DIR, PKR_BUILD_FILE, STATUS_MANIFEST_FILE, STATUS_TIMELINE_FILE
+from azext_bake._data import ImageUpdate, ImageVariant, PowershellScript, WingetPackage
+from azext_bake._packer import PackerOutputParser, count_packer_provisioners, get_build_file
+from azext_bake._status import BuildStatus
+from azext_bake._utils import get_templates_path
+
+# tools/fake-packer.py stands in for packer, it's only in the repository (not the extension wheel)
+FAKE_PACKER = Path(__file__).resolve().parents[4] / 'tools' / 'fake-packer.py'
+
+IDENTITY_ID = ('/subscriptions/00000000-0000-0000-0000-000000000000/resourceGroups/test-sandbox/providers/'
+               'Microsoft.ManagedIdentity/userAssignedIdentities/test')
+
+BAKE_YAML = '''version: 1
+sandbox:
+  resourceGroup: test-sandbox
+  subscription: 00000000-0000-0000-0000-000000000000
+  virtualNetwork: test-vnet
+  virtualNetworkResourceGroup: test-sandbox
+  defaultSubnet: default
+  builderSubnet: builders
+  keyVault: test-kv
+  storageAccount: teststorage
+  identityId: {identity}
+gallery:
+  name: test_gallery
+  resourceGroup: test-gallery
+'''.format(identity=IDENTITY_ID)
+
+IMAGE_YAML = '''publisher: Contoso
+offer: DevBox
+sku: TestImage
+version: 1.0.0
+os: Windows
+replicaLocations:
+  - eastus
+update: true
+install:
+  scripts:
+    powershell:
+      - path: scripts/Install-A.ps1
+        restart: true
+      - path: scripts/Install-B.ps1
+        group: apps
+      - path: scripts/Install-C.ps1
+        group: apps
+  choco:
+    packages:
+      - git
+      - id: vscode
+        user: true
+  winget:
+    packages:
+      - Git.Git
+'''
+
+
+def _script(path, **kwargs):
+    return PowershellScript({'path': f'{INSTALL_BUNDLE_DIR}/{path}', **kwargs})
+
+
+def _build_file(**kwargs):
+    template = (get_templates_path('packer') / PKR_BUILD_FILE).read_text(encoding='utf-8')
+    return get_build_file(
+        template, [_script('scripts/Install-A.ps1', restart=True), _script('scripts/Install-B.ps1', group='apps'),
+                   _script('scripts/Install-C.ps1', group='apps'), _script('scripts/Install-D.ps1')],
+        {'user': '<packages user />', 'machine': '<packages />'},
+        winget_installed=[WingetPackage({'id': 'Git.Git'})], update=ImageUpdate({}), bundled=True, **kwargs)
+
+
+@unittest.skipUnless(FAKE_PACKER.is_file(), 'requires tools/fake-packer.py')
+class PackerProgressTests(unittest.TestCase):
+
+    def setUp(self):
+        self.image_dir = Path(tempfile.mkdtemp(prefix='bake-test-'))
+
+    def tearDown(self):
+        shutil.rmtree(self.image_dir)
+
+    def _fake_packer_build(self, status, ignore_sources=None):
+        parser = PackerOutputParser(status, ignore_sources=ignore_sources)
+        output = subprocess.run([sys.executable, str(FAKE_PACKER), 'build', str(self.image_dir)], check=True,
+                                capture_output=True, text=True, env={**os.environ, 'FAKE_PACKER_STEP_LINES': '2'})
+        for line in output.stdout.splitlines(keepends=True):
+            parser.parse(line)
+        parser.finish(True)
+
+    def test_count_matches_parser(self):
+        _build_file().save(self.image_dir)
+        total = count_packer_provisioners(self.image_dir)
+
+        status = BuildStatus('TestImage', '1.0.0')
+        status.set_provisioner_total(total)
+        self._fake_packer_build(status)
+
+        # the template's provisioners, windows update, 3 restarts, 3 scripts (one is a group), choco, and winget
+        self.assertEqual(total, status.counters['provisioners'])
+        self.assertGreater(total, 10)
+
+    def test_count_ignores_variant_provisioners(self):
+        _build_file().save(self.image_dir)
+        total = count_packer_provisioners(self.image_dir)
+
+        variant = ImageVariant({'name': 'pro', 'base': {'sku': 'pro'}})
+        variant.definition, variant.base = 'TestImage-pro', SimpleNamespace(publisher='p', offer='o', sku='pro',
+                                                                            version='latest')
+        _build_file(variants=[variant], variant_scripts={'pro': [_script('scripts/Install-Pro.ps1')]}).save(
+            self.image_dir)
+
+        self.assertIn('azure-arm.pro', (self.image_dir / PKR_BUILD_FILE).read_text(encoding='utf-8'))
+        self.assertEqual(count_packer_provisioners(self.image_dir), total)
+
+    def test_parser_ignores_sources(self):
+        status = BuildStatus('TestImage', '1.0.0')
+        parser = PackerOutputParser(status, ignore_sources=['azure-arm.pro'])
+        for target in ['azure-arm.vm', 'azure-arm.pro']:
+            parser.parse(f'1669809600,{target},ui,say,==> {target}: Provisioning with Powershell...\n')
+            parser.parse(f'1669809600,{target},ui,message,    {target}: >>> Running script: scripts/Install-A.ps1\n')
+            parser.parse(f'1669809601,{target},ui,say,==> {target}: Restarting Machine\n')
+
+        self.assertEqual(status.counters['provisioners'], 2)
+        self.assertEqual(status.counters['packer_lines'], 6)
+        # the powershell provisioner starting and the script it runs are both timeline steps
+        self.assertEqual([(s['kind'], s['name']) for s in status.timeline.to_list()],
+                         [('provisioner', 'Powershell'), ('provisioner', 'Running script: scripts/Install-A.ps1'),
+                          ('restart', 'windows-restart')])
+
+
+@unittest.skipUnless(FAKE_PACKER.is_file(), 'requires tools/fake-packer.py')
+class FakePackerBuildTests(unittest.TestCase):
+    '''Builds an image with az bake image build --local and tools/fake-packer.py as packer'''
+
+    def setUp(self):
+        self.temp_dir = Path(tempfile.mkdtemp(prefix='bake-test-'))
+        self.repo_dir = self.temp_dir / 'repo'
+        image_dir = self.repo_dir / 'images' / 'TestImage'
+        (image_dir / 'scripts').mkdir(parents=True)
+        (self.repo_dir / '.git').mkdir()
+        (self.repo_dir / 'bake.yml').write_text(BAKE_YAML, encoding='utf-8')
+        (image_dir / 'image.yml').write_text(IMAGE_YAML, encoding='utf-8')
+        for name in ['A', 'B', 'C']:
+            (image_dir / 'scripts' / f'Install-{name}.ps1').write_text(f'Write-Host {name}', encoding='utf-8')
+
+        bin_dir = self.temp_dir / 'bin'
+        bin_dir.mkdir()
+        packer = bin_dir / 'packer'
+        packer.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_PACKER}" "$@"\n', encoding='utf-8')
+        packer.chmod(0o755)
+
+        env = mock.patch.dict(os.environ, {'PATH': f'{bin_dir}{os.pathsep}{os.environ["PATH"]}',
+                                           'FAKE_PACKER_STEP_LINES': '2'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @unittest.skipIf(sys.platform == 'win32', 'the fake packer executable is a shell script')
+    def test_local_build(self):
+        from azext_bake import custom
+        from azext_bake._validators import bake_yaml_validator, repository_images_validator
+
+        # the gallery calls the builder makes, no azure resources are needed
+        stubs = {
+            'get_gallery': lambda *_: SimpleNamespace(location='eastus'),
+            'get_image_definition': lambda *_: SimpleNamespace(name='TestImage'),
+            'image_version_exists': lambda *_: False,
+            'delete_managed_image': lambda *_: False,
+            'get_latest_image_version': lambda *_: None,
+            'tag_image_version': lambda *_, **__: None,
+            'replicate_image_version': lambda *_: (None, [])
+        }
+
+        ns = SimpleNamespace(repository_path=self.repo_dir, image_names=['TestImage'], images=None,
+                             sandbox=None, gallery=None, builder=None)
+        repository_images_validator(None, ns)
+        bake_yaml_validator(None, ns)
+
+        with mock.patch.multiple(custom, **stubs), mock.patch('sys.stdout'):
+            result = custom.bake_image_build(None, self.repo_dir, 'TestImage', local=True, sandbox=ns.sandbox,
+                                             gallery=ns.gallery, images=ns.images, builder=ns.builder)
+
+        output_dir = Path(result['output'])
+        status = json.loads((output_dir / STATUS_MANIFEST_FILE).read_text(encoding='utf-8'))
+        timeline = json.loads((output_dir / STATUS_TIMELINE_FILE).read_text(encoding='utf-8'))
+
+        self.assertEqual(status['outcome'], 'succeeded')
+        self.assertEqual(status['image'], 'TestImage')
+        self.assertEqual([p['name'] for p in status['phases']],
+                         ['login', 'gallery', 'generate', 'packer-init', 'packer-build', 'cleanup'])
+        self.assertEqual(status['provisionerIndex'], status['provisionerTotal'])
+        self.assertEqual(status['update']['installed'], True)
+        self.assertEqual(status['counters']['errors'], 0)
+
+        self.assertTrue(timeline['succeeded'])
+        self.assertEqual(len(timeline['artifacts']), 1)
+        kinds = [step['kind'] for step in timeline['steps']]
+        for kind in ['deploy', 'provisioner', 'update', 'restart', 'capture', 'cleanup']:
+            self.assertIn(kind, kinds)
+        # the fake windows-update provisioner runs 2 rounds and finds an update in each
+        self.assertEqual(timeline['summary']['updateRounds'], 2)
+        self.assertEqual(timeline['summary']['updates'], 2)
+        self.assertEqual(timeline['summary']['steps'], len(timeline['steps']))
+        self.assertTrue(all(step['finished'] for step in timeline['steps']))
+
+
+if __name__ == '__main__':
+    unittest.main()
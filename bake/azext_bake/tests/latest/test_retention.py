@@ -0,0 +1,124 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import unittest
+
+from datetime import datetime, timedelta, timezone
+
+from azext_bake._data import BuilderRetention
+from azext_bake._retention import enforce_retention, plan_retention
+
+NOW = datetime(2022, 11, 30, 12, 0, 0, tzinfo=timezone.utc)
+MB = 1024 * 1024
+
+
+def _run(days_ago, size_mb=1, archived=False):
+    return {'name': (NOW - timedelta(days=days_ago)).strftime('%Y%m%d%H%M%S'), 'archived': archived,
+            'size': size_mb * MB}
+
+
+def _actions(actions):
+    return [(a['name'], a['action'], a['reason']) for a in actions]
+
+
+class PlanRetentionTests(unittest.TestCase):
+
+    def test_empty_policy_keeps_everything(self):
+        runs = [_run(days) for days in [1, 10, 100, 1000]]
+        self.assertEqual(plan_retention(runs, BuilderRetention({}), now=NOW), [])
+
+    def test_keep_runs(self):
+        runs = [_run(4), _run(1), _run(3), _run(2, archived=True)]
+        actions = plan_retention(runs, BuilderRetention({'keepRuns': 1}), now=NOW)
+
+        # the newest run is kept, the older runs that aren't archived yet are compacted
+        self.assertEqual(_actions(actions), [(runs[2]['name'], 'compact', 'keepRuns'),
+                                             (runs[0]['name'], 'compact', 'keepRuns')])
+
+    def test_keep_runs_zero_keeps_newest(self):
+        runs = [_run(1), _run(2)]
+        actions = plan_retention(runs, BuilderRetention({'keepRuns': 0}), now=NOW)
+        self.assertEqual(_actions(actions), [(runs[1]['name'], 'compact', 'keepRuns')])
+
+    def test_max_age_days(self):
+        runs = [_run(40), _run(20), _run(5)]
+        actions = plan_retention(runs, BuilderRetention({'maxAgeDays': 30}), now=NOW)
+        self.assertEqual(_actions(actions), [(runs[0]['name'], 'delete', 'maxAgeDays')])
+
+    def test_max_age_days_keeps_newest(self):
+        # the newest run may still be running, so it's kept however old it is
+        runs = [_run(40), _run(50)]
+        actions = plan_retention(runs, BuilderRetention({'maxAgeDays': 30}), now=NOW)
+        self.assertEqual(_actions(actions), [(runs[1]['name'], 'delete', 'maxAgeDays')])
+
+    def test_max_size_mb(self):
+        runs = [_run(1, 4), _run(2, 4), _run(3, 4), _run(4, 4)]
+        actions = plan_retention(runs, BuilderRetention({'maxSizeMb': 10}), now=NOW)
+
+        # the oldest runs are deleted until the total is under the limit
+        self.assertEqual(_actions(actions), [(runs[3]['name'], 'delete', 'maxSizeMb'),
+                                             (runs[2]['name'], 'delete', 'maxSizeMb')])
+
+    def test_max_size_mb_replaces_compact(self):
+        runs = [_run(1, 4), _run(2, 4), _run(3, 4)]
+        actions = plan_retention(runs, BuilderRetention({'keepRuns': 1, 'maxSizeMb': 9}), now=NOW)
+
+        self.assertEqual(_actions(actions), [(runs[1]['name'], 'compact', 'keepRuns'),
+                                             (runs[2]['name'], 'delete', 'maxSizeMb')])
+
+    def test_max_size_mb_keeps_newest(self):
+        runs = [_run(1, 20), _run(2, 1)]
+        actions = plan_retention(runs, BuilderRetention({'maxSizeMb': 10}), now=NOW)
+        self.assertEqual(_actions(actions), [(runs[1]['name'], 'delete', 'maxSizeMb')])
+
+    def test_no_compact(self):
+        runs = [_run(1), _run(2)]
+        actions = plan_retention(runs, BuilderRetention({'keepRuns': 1}), now=NOW, compact=False)
+        self.assertEqual(actions, [])
+
+
+class _MemoryRunStore:
+
+    def __init__(self, runs):
+        self.runs = {r['name']: dict(r) for r in runs}
+        self.calls = []
+
+    def list_runs(self):
+        return list(self.runs.values())
+
+    def compact(self, run):
+        self.calls.append(('compact', run))
+        # compressing a run makes it smaller
+        self.runs[run].update(archived=True, size=self.runs[run]['size'] // 4)
+
+    def delete(self, run, archived):
+        self.calls.append(('delete', run))
+        del self.runs[run]
+
+
+class EnforceRetentionTests(unittest.TestCase):
+
+    def test_dry_run(self):
+        runs = [_run(1), _run(2)]
+        store = _MemoryRunStore(runs)
+        actions = enforce_retention(store, BuilderRetention({'keepRuns': 1}), dry_run=True)
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(store.calls, [])
+
+    def test_size_is_checked_after_compacting(self):
+        # recent runs so maxAgeDays (not set) and the current time don't matter
+        now = datetime.now(timezone.utc)
+        names = [(now - timedelta(hours=h)).strftime('%Y%m%d%H%M%S') for h in [1, 2, 3]]
+        store = _MemoryRunStore([{'name': n, 'archived': False, 'size': 8 * MB} for n in names])
+
+        enforce_retention(store, BuilderRetention({'keepRuns': 1, 'maxSizeMb': 13}))
+
+        # 8 + 8 + 8 is over the limit before compacting but 8 + 2 + 2 isn't, so nothing is deleted
+        self.assertEqual(store.calls, [('compact', names[1]), ('compact', names[2])])
+        self.assertEqual(sorted(store.runs), sorted(names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import unittest
+
+from azure.cli.core.azclierror import ValidationError
+
+from azext_bake._constants import PKR_RESTART_PAUSE_MINUTES
+from azext_bake._data import PowershellScript
+from azext_bake._scheduler import schedule_powershell_scripts
+
+
+def _scripts(*scripts):
+    return [PowershellScript(s if isinstance(s, dict) else {'path': s}) for s in scripts]
+
+
+def _paths(scripts):
+    return [s.path for s in scripts]
+
+
+def _restarts(scripts):
+    return [s.path for s in scripts if s.restart]
+
+
+class SchedulePowershellScriptsTests(unittest.TestCase):
+
+    def test_independent_restarts_are_coalesced(self):
+        scripts = _scripts({'path': 'a.ps1', 'restart': True}, 'b.ps1', {'path': 'c.ps1', 'restart': True}, 'd.ps1')
+        scheduled, report = schedule_powershell_scripts(scripts)
+
+        # without after dependencies every script can run before a single restart, in the image.yml order
+        self.assertEqual(_paths(scheduled), ['a.ps1', 'b.ps1', 'c.ps1', 'd.ps1'])
+        self.assertEqual(_restarts(scheduled), ['d.ps1'])
+        self.assertEqual(report, {'restartsBefore': 2, 'restartsAfter': 1, 'restartsSaved': 1,
+                                  'minutesSaved': PKR_RESTART_PAUSE_MINUTES})
+
+    def test_after_waits_for_restart(self):
+        scripts = _scripts({'path': 'a.ps1', 'restart': True}, {'path': 'b.ps1', 'after': 'a.ps1'},
+                           {'path': 'c.ps1', 'restart': True}, 'd.ps1')
+        scheduled, report = schedule_powershell_scripts(scripts)
+
+        # b waits for a and its restart, c and d share a's restart
+        self.assertEqual(_paths(scheduled), ['a.ps1', 'c.ps1', 'd.ps1', 'b.ps1'])
+        self.assertEqual(_restarts(scheduled), ['d.ps1'])
+        self.assertEqual(report['restartsAfter'], 1)
+
+    def test_after_without_restart_keeps_order(self):
+        scripts = _scripts({'path': 'a.ps1', 'after': 'b.ps1'}, 'b.ps1')
+        scheduled, report = schedule_powershell_scripts(scripts)
+
+        self.assertEqual(_paths(scheduled), ['b.ps1', 'a.ps1'])
+        self.assertEqual(_restarts(scheduled), [])
+        self.assertEqual(report['restartsSaved'], 0)
+
+    def test_chained_restarts_are_kept(self):
+        scripts = _scripts({'path': 'a.ps1', 'restart': True}, {'path': 'b.ps1', 'restart': True, 'after': 'a.ps1'})
+        scheduled, report = schedule_powershell_scripts(scripts)
+
+        self.assertEqual(_restarts(scheduled), ['a.ps1', 'b.ps1'])
+        self.assertEqual(report['restartsSaved'], 0)
+
+    def test_groups_stay_together(self):
+        scripts = _scripts({'path': 'a.ps1', 'group': 'apps', 'restart': True}, 'b.ps1',
+                           {'path': 'c.ps1', 'group': 'apps'})
+        scheduled, _ = schedule_powershell_scripts(scripts)
+
+        # the group runs at the position of its first script
+        self.assertEqual(_paths(scheduled), ['a.ps1', 'c.ps1', 'b.ps1'])
+        self.assertEqual([s.group for s in scheduled], ['apps', 'apps', None])
+        self.assertEqual(_restarts(scheduled), ['b.ps1'])
+
+    def test_missing_after_is_installed(self):
+        # scripts skipped by an incremental build aren't in the list, they're already installed
+        scripts = _scripts('a.ps1', {'path': 'b.ps1', 'after': 'a.ps1'})
+        scheduled, _ = schedule_powershell_scripts(scripts[1:])
+        self.assertEqual(_paths(scheduled), ['b.ps1'])
+
+    def test_circular_after(self):
+        scripts = _scripts({'path': 'a.ps1', 'after': 'b.ps1'}, {'path': 'b.ps1', 'after': 'a.ps1'})
+        with self.assertRaisesRegex(ValidationError, 'circular'):
+            schedule_powershell_scripts(scripts)
+
+    def test_scripts_are_copies(self):
+        scripts = _scripts({'path': 'a.ps1', 'restart': True}, 'b.ps1')
+        schedule_powershell_scripts(scripts)
+        self.assertEqual(_restarts(scripts), ['a.ps1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+import unittest
+import urllib.error
+import urllib.request
+
+from knack.log import get_logger as knack_get_logger
+
+from azext_bake._status import BuildStatus, attach_status_log_handler, detach_status_log_handler, start_status_server
+
+
+class BuildStatusTests(unittest.TestCase):
+
+    def test_prometheus_labels_are_escaped(self):
+        status = BuildStatus('My"Image\\', '1.0.0')
+        status.start_phase('line\nbreak')
+        metrics = status.to_prometheus()
+        self.assertIn('bake_build_info{image="My\\"Image\\\\",version="1.0.0",phase="line\\nbreak"} 1', metrics)
+
+    def test_log_handler(self):
+        status = BuildStatus('MyImage', '1.0.0')
+        handler = attach_status_log_handler(status)
+        knack_get_logger('azext_bake.tests').warning('first')
+        detach_status_log_handler(handler)
+        knack_get_logger('azext_bake.tests').warning('second')
+
+        self.assertEqual(len(status.get_logs()), 1)
+        self.assertTrue(status.get_logs()[0].endswith('first'))
+        self.assertNotIn(handler, knack_get_logger('azext_bake').handlers)
+
+
+class StatusServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.status = BuildStatus('MyImage', '1.0.0')
+        self.status.add_log('packer output')
+        # port 0 serves on a free port
+        self.server = start_status_server(self.status, port=0, token='secret')
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def _get(self, path, headers=None):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, headers=headers or {})) as response:
+                return response.status, response.read().decode('utf-8')
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    def test_status(self):
+        code, body = self._get('/status')
+        self.assertEqual(code, 200)
+        self.assertIn('"image": "MyImage"', body)
+
+    def test_logs_require_token(self):
+        self.assertEqual(self._get('/logs')[0], 401)
+        self.assertEqual(self._get('/logs', {'Authorization': 'Bearer wrong'})[0], 401)
+        self.assertEqual(self._get('/logs', {'Authorization': 'Bearer secret'}), (200, 'packer output\n'))
+
+    def test_logs_without_token(self):
+        server = start_status_server(self.status, port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = f'http://127.0.0.1:{server.server_address[1]}'
+        self.assertEqual(self._get('/logs', {'Authorization': 'Bearer '})[0], 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+# Benchmarks the builder pipeline (bake image build --local) end-to-end without azure. A fake packer
+# (tools/fake-packer.py) is put on the PATH and the gallery calls are stubbed, then an image with many
+# choco packages and scripts is built and the time and memory of each build phase is reported.
+# Requires the bake extension's dependencies (azure-cli) to be installed in the current environment.
+
+import argparse
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pathlib import Path
+from types import SimpleNamespace
+
+TOOLS_DIR = Path(__file__).resolve().parent
+REPO_DIR = TOOLS_DIR.parent
+
+sys.path.insert(0, str(REPO_DIR / 'bake'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--packages', type=int, default=50, help='number of choco packages in the image')
+parser.add_argument('--scripts', type=int, default=20, help='number of powershell scripts in the image')
+parser.add_argument('--restart-every', type=int, default=5, help='restart after every n scripts (0 for never)')
+parser.add_argument('--group-size', type=int, default=0, help='run scripts in parallel groups of n (0 for never)')
+parser.add_argument('--runs', type=int, default=3, help='number of builds to run')
+parser.add_argument('--step-delay', default='0', help='seconds each fake packer provisioner step takes')
+parser.add_argument('--step-lines', default='50', help='lines of output each fake packer provisioner step writes')
+parser.add_argument('--output', choices=['files', 'archive'], default='files', help='builder output mode')
+parser.add_argument('--keep', action='store_true', help='keep the temporary repository')
+
+args = parser.parse_args()
+
+BAKE_YAML = '''version: 1
+sandbox:
+  resourceGroup: bench-sandbox
+  subscription: 00000000-0000-0000-0000-000000000000
+  virtualNetwork: bench-vnet
+  virtualNetworkResourceGroup: bench-sandbox
+  defaultSubnet: default
+  builderSubnet: builders
+  keyVault: bench-kv
+  storageAccount: benchstorage
+  identityId: /subscriptions/00000000-0000-0000-0000-000000000000/resourceGroups/bench-sandbox/providers/Microsoft.ManagedIdentity/userAssignedIdentities/bench
+gallery:
+  name: bench_gallery
+  resourceGroup: bench-gallery
+builder:
+  output: {output}
+'''
+
+IMAGE_YAML = '''publisher: Contoso
+offer: Bench
+sku: Bench
+version: 1.0.0
+os: Windows
+replicaLocations:
+  - eastus
+update: true
+install:
+  scripts:
+    powershell:
+{scripts}
+  choco:
+    packages:
+{packages}
+'''
+
+
+def create_repo(root: Path):
+    '''Creates a repository with a bake.yml and an image with many choco packages and scripts'''
+    (root / '.git').mkdir(parents=True)
+    (root / 'bake.yml').write_text(BAKE_YAML.format(output=args.output), encoding='utf-8')
+
+    image_dir = root / 'images' / 'BenchImage'
+    (image_dir / 'scripts').mkdir(parents=True)
+
+    scripts = []
+    for i in range(args.scripts):
+        name = f'scripts/Install-Thing{i}.ps1'
+        (image_dir / name).write_text(f'Write-Host "Installing thing {i}"\n' * 20, encoding='utf-8')
+        restart = args.restart_every and (i + 1) % args.restart_every == 0
+        scripts.append(f'      - path: {name}\n        restart: {str(bool(restart)).lower()}')
+        if args.group_size:
+            scripts[-1] += f'\n        group: group{i // args.group_size}'
+
+    packages = [f'      - id: bench-package-{i}\n        version: 1.0.{i}' for i in range(args.packages)]
+
+    (image_dir / 'image.yml').write_text(IMAGE_YAML.format(scripts='\n'.join(scripts),
+                                                           packages='\n'.join(packages)), encoding='utf-8')
+
+
+def install_fake_packer(bin_dir: Path):
+    '''Puts a packer executable on the PATH that runs tools/fake-packer.py'''
+    bin_dir.mkdir(parents=True)
+    packer = bin_dir / 'packer'
+    packer.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{TOOLS_DIR / "fake-packer.py"}" "$@"\n', encoding='utf-8')
+    packer.chmod(0o755)
+    os.environ['PATH'] = f'{bin_dir}{os.pathsep}{os.environ["PATH"]}'
+    os.environ['FAKE_PACKER_STEP_DELAY'] = args.step_delay
+    os.environ['FAKE_PACKER_STEP_LINES'] = args.step_lines
+
+
+def stub_azure(custom):
+    '''Stubs the gallery calls the builder makes so no azure resources are needed'''
+    custom.get_gallery = lambda *_: SimpleNamespace(location='eastus')
+    custom.get_image_definition = lambda *_: SimpleNamespace(name='BenchImage')
+    custom.image_version_exists = lambda *_: False
+    custom.delete_managed_image = lambda *_: False
+    custom.get_latest_image_version = lambda *_: None
+    custom.tag_image_version = lambda *_, **__: None
+    custom.replicate_image_version = lambda *_: (None, [])
+
+
+def track_phases(status_type, samples):
+    '''Records the time and peak python memory of each build phase'''
+    current = {}
+
+    def _end_phase():
+        if current:
+            _, peak = tracemalloc.get_traced_memory()
+            samples.setdefault(current['name'], []).append((time.perf_counter() - current['start'], peak))
+
+    start_phase = status_type.start_phase
+    finish = status_type.finish
+
+    def _start_phase(self, name):
+        _end_phase()
+        tracemalloc.reset_peak()
+        current.update(name=name, start=time.perf_counter())
+        start_phase(self, name)
+
+    def _finish(self, outcome):
+        _end_phase()
+        current.clear()
+        finish(self, outcome)
+
+    status_type.start_phase = _start_phase
+    status_type.finish = _finish
+
+
+def main():
+    temp_dir = Path(tempfile.mkdtemp(prefix='bake-bench-'))
+    repo_dir = temp_dir / 'repo'
+
+    create_repo(repo_dir)
+    install_fake_packer(temp_dir / 'bin')
+
+    from azext_bake import custom  # pylint: disable=import-outside-toplevel
+    from azext_bake._status import BuildStatus  # pylint: disable=import-outside-toplevel
+    from azext_bake._validators import bake_yaml_validator, repository_images_validator  # pylint: disable=import-outside-toplevel
+
+    stub_azure(custom)
+
+    samples = {}
+    track_phases(BuildStatus, samples)
+    totals = []
+
+    tracemalloc.start()
+
+    for run in range(args.runs):
+        ns = SimpleNamespace(repository_path=repo_dir, image_names=['BenchImage'], images=None,
+                             sandbox=None, gallery=None, builder=None)
+        start = time.perf_counter()
+        repository_images_validator(None, ns)
+        bake_yaml_validator(None, ns)
+        custom.bake_image_build(None, repo_dir, 'BenchImage', local=True, sandbox=ns.sandbox, gallery=ns.gallery,
+                                images=ns.images, builder=ns.builder)
+        totals.append(time.perf_counter() - start)
+        # builder runs are named with a timestamp (seconds)
+        if run < args.runs - 1:
+            time.sleep(1)
+
+    tracemalloc.stop()
+
+    print()
+    print(f'images: 1  packages: {args.packages}  scripts: {args.scripts}  runs: {args.runs}  output: {args.output}')
+    print()
+    print(f'{"phase":<16}{"median (s)":>12}{"max (s)":>12}{"peak py mem (MB)":>20}')
+    for name, values in samples.items():
+        times = [v[0] for v in values]
+        peak = max(v[1] for v in values) / 1024 / 1024
+        print(f'{name:<16}{statistics.median(times):>12.3f}{max(times):>12.3f}{peak:>20.2f}')
+    print(f'{"total":<16}{statistics.median(totals):>12.3f}{max(totals):>12.3f}')
+    print()
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f'max rss: builder {usage_self:.1f} MB, packer {usage_children:.1f} MB')
+
+    if args.keep:
+        print(f'repository: {repo_dir}')
+    else:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
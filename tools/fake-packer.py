@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+
+# Stand-in for the packer executable used to exercise and benchmark the builder without azure.
+# Emulates `packer init`, `packer inspect`, and `packer build` (with -machine-readable output) for the
+# provisioners in the image's build.pkr.hcl file. Behavior is configured with environment variables:
+#   FAKE_PACKER_STEP_DELAY  seconds each provisioner step takes (default: 0)
+#   FAKE_PACKER_STEP_LINES  lines of output each provisioner step writes (default: 10)
+#   FAKE_PACKER_INIT_DELAY  seconds packer init takes (default: 0)
+#   FAKE_PACKER_EXIT_CODE   exit code for packer build (default: 0)
+
+import os
+import re
+import sys
+import time
+
+from pathlib import Path
+
+STEP_DELAY = float(os.environ.get('FAKE_PACKER_STEP_DELAY', '0'))
+STEP_LINES = int(os.environ.get('FAKE_PACKER_STEP_LINES', '10'))
+INIT_DELAY = float(os.environ.get('FAKE_PACKER_INIT_DELAY', '0'))
+EXIT_CODE = int(os.environ.get('FAKE_PACKER_EXIT_CODE', '0'))
+
+TARGET = 'azure-arm.vm'
+
+
+def ui(message, target=TARGET, level='say'):
+    message = message.replace(',', '%!(PACKER_COMMA)').replace('\n', '\\n')
+    print(f'{int(time.time())},{target},ui,{level},{message}', flush=True)
+
+
+def step_output(lines=STEP_LINES):
+    for i in range(lines):
+        ui(f'    {TARGET}: output line {i + 1} of {lines}', level='message')
+    if STEP_DELAY:
+        time.sleep(STEP_DELAY)
+
+
+def step(message, lines=STEP_LINES):
+    ui(f'==> {TARGET}: {message}')
+    step_output(lines)
+
+
+def get_provisioners(image_dir: Path):
+    '''Gets the (type, names, markers, download) of each provisioner in the build file, scripts lists are expanded'''
+    build = (image_dir / 'build.pkr.hcl').read_text(encoding='utf-8')
+    build = '\n'.join(line for line in build.splitlines() if not line.strip().startswith(('#', '//')))
+    provisioners = []
+    for match in re.finditer(r'provisioner\s+"(?P<type>[^"]+)"\s*{', build):
+        block = build[match.end():]
+        block = block[:block.find('\n  }')]
+        scripts = re.search(r'scripts\s*=\s*\[(?P<scripts>[^\]]*)\]', block)
+        source = re.search(r'source\s*=\s*"(?P<source>[^"]+)"', block)
+        if scripts:
+            names = re.findall(r'"([^"]+)"', scripts.group('scripts'))
+        elif source:
+            names = [source.group('source').replace('${path.root}', str(image_dir))]
+        else:
+            names = []
+        markers = re.findall(r"Write-Host '>>> ([^']+)'", block)
+        download = re.search(r'direction\s*=\s*"download"', block) is not None
+        provisioners.append((match.group('type'), names, markers, download))
+    return provisioners
+
+
+def build(image_dir: Path):
+    step('Deploying deployment template ...', lines=2)
+    step('Waiting for WinRM to become available...', lines=2)
+
+    for index, (pkr_type, names, markers, download) in enumerate(get_provisioners(image_dir)):
+        if pkr_type == 'powershell':
+            ui(f'==> {TARGET}: Provisioning with Powershell...')
+            # inline powershell is written to a new temp file for each provisioner
+            for name in names or [f'/tmp/powershell-provisioner{1000 + index}']:
+                ui(f'==> {TARGET}: Provisioning with powershell script: {name}')
+                if not markers:
+                    step_output()
+            # inline provisioners injected by az bake write a marker before each step
+            for marker in markers:
+                ui(f'    {TARGET}: >>> {marker}', level='message')
+                step_output()
+        elif pkr_type == 'windows-update':
+            step('Running Windows update...', lines=1)
+            for _ in range(2):
+                ui(f'    {TARGET}: Searching for Windows updates...', level='message')
+                ui(f'    {TARGET}: Found Windows update (2022-12 Cumulative Update): installing it', level='message')
+            ui(f'    {TARGET}: Restarting the machine...', level='message')
+        elif pkr_type == 'windows-restart':
+            step('Restarting Machine', lines=1)
+        elif pkr_type == 'file':
+            for name in names:
+                step(f'{"Downloading" if download else "Uploading"} {name} => C:/Windows/Temp', lines=1)
+        else:
+            step(f'Provisioning with {pkr_type}...')
+
+    step("Querying the machine's properties ...", lines=1)
+    step('Publishing to Shared Image Gallery ...', lines=1)
+    step('Deleting individual resources ...', lines=1)
+
+    if EXIT_CODE:
+        ui(f'Build \'{TARGET}\' errored after 1 second: fake packer failure', level='error')
+        return EXIT_CODE
+
+    print(f'{int(time.time())},{TARGET},artifact,0,id,/subscriptions/fake/resourceGroups/fake/providers/'
+          'Microsoft.Compute/galleries/fake/images/fake/versions/1.0.0', flush=True)
+    ui(f'Build \'{TARGET}\' finished after 1 second.')
+    return 0
+
+
+def main(args):
+    if not args:
+        print('usage: packer [init|inspect|build] ... path', file=sys.stderr)
+        return 1
+
+    command = args[0]
+    image_dir = Path(args[-1])
+
+    if command == 'version':
+        print('Packer v1.8.5 (fake)')
+        return 0
+    if command == 'init':
+        time.sleep(INIT_DELAY)
+        print('Installed plugin github.com/hashicorp/azure (fake)')
+        return 0
+    if command == 'inspect':
+        for name in ['image', 'gallery', 'sandbox']:
+            print(f'{int(time.time())},,ui,say,var.{name}: "{{}}"')
+        return 0
+    if command == 'build':
+        return build(image_dir)
+
+    print(f'fake packer does not support: {command}', file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))